@@ -0,0 +1,94 @@
+"""
+Collection analytics over Resources (helpers.filter_collection) against
+ColumnarCollection backends
+    
+    python benchmarks/columns.py [rows ...] [--rounds=N]
+
+rows default to 10000 100000 1000000, 'columnar build' is the one-off cost of
+extracting the columns used by the queries
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from orm import helpers
+from orm.columns import BACKENDS
+from orm.resources import Resource
+from orm.tests.utils import Nodes
+
+
+def get_nodes(size):
+    url = 'http://controller.example.com/api/%s/%d/'
+    groups = [Resource(None, url=url % ('groups', i), name=u'group-%d' % i) for i in range(50)]
+    for group in groups:
+        group._has_retrieved = True
+    return Nodes([
+        Resource(None, url=url % ('nodes', i), id=i, name=u'node-%d' % i,
+                 arch=('x86_64', 'i686')[i % 2], load=(i * 7919 % 1000) / 10.0,
+                 set_state=('production', 'safe', 'failure')[i % 3], group=groups[i % 50])
+        for i in range(size)
+    ])
+
+
+QUERIES = [
+    ('filter', lambda c: c.filter(arch='x86_64', load__gt=50)),
+    ('filter join', lambda c: c.filter(group__name__in=[u'group-1', u'group-7'], load__lt=20)),
+    ('filter text', lambda c: c.filter(name__startswith=u'node-99')),
+    ('values_list', lambda c: c.filter(set_state='safe').values_list('load')),
+    ('count by', lambda c: c.count('set_state')),
+    ('order_by', lambda c: c.order_by('load', reverse=True)),
+]
+
+
+class ResourceQueries(object):
+    """ current path: filter_collection and per resource attribute access """
+    def __init__(self, collection):
+        self.collection = collection
+    
+    def filter(self, **kwargs):
+        new = Nodes(helpers.filter_collection(self.collection, **kwargs))
+        return ResourceQueries(new)
+    
+    def values_list(self, field):
+        accessor = helpers.compile_accessor(field)
+        return [accessor(resource) for resource in self.collection.resources]
+    
+    def count(self, field):
+        return {key: len(value) for key, value in self.collection.group_by(field).iteritems()}
+    
+    def order_by(self, field, reverse=False):
+        return sorted(self.collection.resources, key=helpers.compile_accessor(field),
+                reverse=reverse)
+
+
+def bench(name, func, rounds):
+    seconds = min(timeit.repeat(func, number=1, repeat=rounds))
+    print '    %-16s %10.2f ms' % (name, seconds*1000)
+
+
+def main(sizes=(10000, 100000, 1000000), rounds=3):
+    fields = ('arch', 'load', 'group__name', 'name', 'set_state')
+    for size in sizes:
+        nodes = get_nodes(size)
+        print '%d rows, best of %d rounds' % (size, rounds)
+        print '  resources'
+        queries = ResourceQueries(nodes)
+        for name, query in QUERIES:
+            bench(name, lambda: query(queries), rounds)
+        for backend in sorted(BACKENDS):
+            print '  columnar %s' % backend
+            bench('columnar build', lambda: nodes.columnar(*fields, backend=backend), 1)
+            columns = nodes.columnar(*fields, backend=backend)
+            for name, query in QUERIES:
+                bench(name, lambda: query(columns), rounds)
+
+
+if __name__ == '__main__':
+    options = [arg for arg in sys.argv[1:] if arg.startswith('--rounds=')]
+    sizes = [int(arg) for arg in sys.argv[1:] if arg not in options]
+    kwargs = {'sizes': sizes} if sizes else {}
+    if options:
+        kwargs['rounds'] = int(options[0].split('=')[1])
+    main(**kwargs)
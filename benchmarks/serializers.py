@@ -0,0 +1,74 @@
+"""
+Encode/decode throughput of the available codecs
+    
+    python benchmarks/serializers.py [objects] [rounds]
+
+'legacy' is the stdlib json with the default() fallback encoder that Api used
+before codecs
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from orm.api import Api
+from orm.resources import Resource
+from orm.serializers import CODECS, JSONCodec
+
+
+class LegacyCodec(JSONCodec):
+    name = 'legacy'
+    
+    def encode(self, content):
+        class ResourceJSONEncoder(json.JSONEncoder):
+            def default(self, obj):
+                try:
+                    return super(ResourceJSONEncoder, self).default(obj)
+                except TypeError:
+                    return obj.serialize()
+        return json.dumps(content, cls=ResourceJSONEncoder)
+
+
+def get_objects(size):
+    url = 'http://controller.example.com/api/%s/%d/'
+    return [{
+        'url': url % ('nodes', i),
+        'id': i,
+        'name': u'node-%d' % i,
+        'description': u'n\xf2de description ' * 4,
+        'arch': 'x86_64',
+        'group': {'url': url % ('groups', i % 10)},
+        'load': i / 7.0,
+        'sliver_pub_ipv4_range': '10.0.%d.0/24' % (i % 256),
+        'slivers': [{'url': url % ('slivers', i*10 + j)} for j in range(3)],
+    } for i in range(size)]
+
+
+def bench(name, func, rounds):
+    seconds = min(timeit.repeat(func, number=1, repeat=rounds))
+    print '    %-16s %8.2f ms' % (name, seconds*1000)
+
+
+def main(size=10000, rounds=5):
+    api = Api('http://controller.example.com/api/')
+    objects = get_objects(size)
+    # Related collections need the api managers, left out of resources
+    resources = [
+        Resource(api, **{k: v for k, v in obj.iteritems() if k != 'slivers'}) for obj in objects
+    ]
+    codecs = [LegacyCodec()] + [codec() for codec in CODECS.values()]
+    print '%d objects, best of %d rounds' % (size, rounds)
+    for codec in codecs:
+        content = codec.encode(objects)
+        chunks = [content[i:i+65536] for i in range(0, len(content), 65536)]
+        print '%s (%d bytes)' % (codec.name, len(content))
+        bench('encode', lambda: codec.encode(objects), rounds)
+        bench('encode resources', lambda: codec.encode(resources), rounds)
+        bench('decode', lambda: codec.decode(content), rounds)
+        bench('iter_decode', lambda: list(codec.iter_decode(chunks)), rounds)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,219 @@
+from itertools import islice
+
+from . import helpers
+
+
+# resources whose related fields are fetched in a single batch
+CHUNK_SIZE = 500
+
+
+class Aggregate(object):
+    """
+    Single pass reduction of a field, None values are ignored
+    
+    Aggregates are specifications, the running state is kept by Aggregation
+    so instances can be reused. Fields follow related resources and
+    collections like filter lookups, i.e. Sum('slivers__load').
+    """
+    name = None
+    
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.field)
+    
+    def __init__(self, field):
+        self.field = field
+    
+    @property
+    def default_alias(self):
+        return '%s__%s' % (self.field, self.name)
+    
+    def start(self):
+        return None
+    
+    def add(self, state, value):
+        raise NotImplementedError
+    
+    def result(self, state):
+        return state
+
+
+class Count(Aggregate):
+    """ number of values, number of resources when field is None """
+    name = 'count'
+    
+    def __init__(self, field=None):
+        super(Count, self).__init__(field)
+    
+    @property
+    def default_alias(self):
+        if self.field is None:
+            return self.name
+        return super(Count, self).default_alias
+    
+    def start(self):
+        return 0
+    
+    def add(self, state, value):
+        return state + 1
+
+
+class Sum(Aggregate):
+    name = 'sum'
+    
+    def add(self, state, value):
+        return value if state is None else state + value
+
+
+class Min(Aggregate):
+    name = 'min'
+    
+    def add(self, state, value):
+        return value if state is None or value < state else state
+
+
+class Max(Aggregate):
+    name = 'max'
+    
+    def add(self, state, value):
+        return value if state is None or value > state else state
+
+
+class Avg(Aggregate):
+    name = 'avg'
+    
+    def start(self):
+        return (0, 0)
+    
+    def add(self, state, value):
+        return (state[0] + value, state[1] + 1)
+    
+    def result(self, state):
+        total, count = state
+        return total / float(count) if count else None
+
+
+class Aggregation(object):
+    """
+    Running aggregates over any number of feed() calls, memory is constant
+    regardless of the number of resources (one state per group with group_by)
+        
+        aggregation = Aggregation(Count(), Avg('load'), max_load=Max('load'))
+        for page in pages:
+            aggregation.feed(page)
+        aggregation.result()
+        {'count': 3, 'load__avg': 1.5, 'max_load': 2.5}
+    """
+    def __init__(self, *args, **kwargs):
+        self.group_by = kwargs.pop('_group_by', None)
+        self.aliases = [aggregate.default_alias for aggregate in args] + kwargs.keys()
+        if len(set(self.aliases)) != len(self.aliases):
+            raise ValueError('duplicated aggregate aliases %s' % self.aliases)
+        self.aggregates = list(args) + kwargs.values()
+        self.values = [
+            compile_values(aggregate.field) if aggregate.field else None
+            for aggregate in self.aggregates
+        ]
+        self.group_key = helpers.compile_accessor(self.group_by) if self.group_by else None
+        self.states = {}
+        fields = [aggregate.field for aggregate in self.aggregates if aggregate.field]
+        if self.group_by:
+            fields.append(self.group_by)
+        self.related = []
+        for field in fields:
+            if '__' in field:
+                self.related.append(field.rsplit('__', 1)[0])
+    
+    def get_states(self, key=None):
+        try:
+            return self.states[key]
+        except KeyError:
+            states = [aggregate.start() for aggregate in self.aggregates]
+            self.states[key] = states
+            return states
+    
+    def feed(self, resources):
+        """ accumulates an iterable of resources, related fields are fetched in batches """
+        if not self.related:
+            return self._feed(resources)
+        resources = iter(resources)
+        while True:
+            chunk = list(islice(resources, CHUNK_SIZE))
+            if not chunk:
+                return
+            helpers.retrieve_related(chunk, *self.related, soft=True)
+            self._feed(chunk)
+    
+    def _feed(self, resources):
+        plan = zip(range(len(self.aggregates)), self.aggregates, self.values)
+        group_key = self.group_key
+        states = None if group_key else self.get_states()
+        for resource in resources:
+            if group_key:
+                states = self.get_states(group_key(resource))
+            for i, aggregate, values in plan:
+                if values is None:
+                    states[i] = aggregate.add(states[i], resource)
+                    continue
+                for value in values(resource):
+                    if value is not None:
+                        states[i] = aggregate.add(states[i], value)
+    
+    def _result(self, states):
+        return {
+            alias: aggregate.result(state)
+            for alias, aggregate, state in zip(self.aliases, self.aggregates, states)
+        }
+    
+    def result(self):
+        """ {alias: value}, {group value: {alias: value}} with group_by """
+        if self.group_by is None:
+            return self._result(self.get_states())
+        return {key: self._result(states) for key, states in self.states.iteritems()}
+    
+    def get_params(self):
+        """ server side aggregate lookups, i.e. load__sum """
+        return [aggregate.default_alias for aggregate in self.aggregates]
+    
+    def from_server(self, content):
+        """
+        result from a server response keyed by get_params() lookups, a list of
+        objects that also carry the group_by value when grouping
+        """
+        params = self.get_params()
+        def get_result(obj):
+            return {alias: obj.get(param) for alias, param in zip(self.aliases, params)}
+        if self.group_by is None:
+            return get_result(content)
+        return {obj[self.group_by]: get_result(obj) for obj in content}
+
+
+def compile_values(field):
+    """ values(resource) iterator of field, related collections yield all their values """
+    from .resources import Collection
+    def compile_path(attrs):
+        if not attrs:
+            return lambda current: (current,)
+        attr = attrs[0]
+        follow = compile_path(attrs[1:])
+        def values(current):
+            current = getattr(current, attr)
+            if isinstance(current, Collection):
+                if len(attrs) == 1:
+                    return current.resources
+                return (value for resource in current.resources for value in follow(resource))
+            return follow(current)
+        return values
+    return compile_path(field.split('__'))
+
+
+def aggregate(resources, *args, **kwargs):
+    """ {alias: value} of aggregates computed in a single pass over resources """
+    aggregation = Aggregation(*args, **kwargs)
+    aggregation.feed(resources)
+    return aggregation.result()
+
+
+def annotate(resources, field, *args, **kwargs):
+    """ {field value: {alias: value}} of aggregates computed per group """
+    kwargs['_group_by'] = field
+    return aggregate(resources, *args, **kwargs)
@@ -1,29 +1,31 @@
 import copy
-import json
+import inspect
 import logging
-import requests
-
-from gevent import monkey
+import weakref
 
 from . import status, exceptions, relations as rel
-from .caches import CacheDict
-from .resources import Resource, Collection
+from .caches import ResponseCache, find_urls
+from .engines import SingleFlight, get_engine
+from .files import MultipartStream, get_file_store
+from .managers import Manager
+from .resources import Resource, Collection, CollectionStream
+from .serializers import find_codec, get_codec
+from .transports import SessionTransport
 from .utils import ZeroDefaultDict
 
 
 #logging.basicConfig()
 log = logging.getLogger(__name__)
 
-if False: # TODO optionally disable gevent
-    monkey.patch_all(thread=False, select=False)
-
 
 class Api(Resource):
     """
     Represents a REST API encapsulating some assumptions about its behaviour
     
-     - application/json is the default content-type
+     - application/json is the default content-type, see orm.serializers
      - tokens is the default authentication mechanism
+     - concurrent operations run on a bounded thread pool, see orm.engines
+     - there is a single live Resource per url (identity map)
     
     However this tries to be a generic implementation, support for other methods
     and types can be achieved by means of subclassing and method overiding
@@ -31,76 +33,162 @@ class Api(Resource):
     CONTENT_TYPE = 'application/json'
     SERIALIZE_IGNORES = Resource.SERIALIZE_IGNORES + [
         'username', 'password', 'token', 'stats', 'cache_enabled', 'cache',
+        'transport', 'engine', 'cache_ttl', 'identity_map', 'codec', 'file_store',
     ]
     DEFAULT_HEADERS = {
         'accept': CONTENT_TYPE,
         'content-type': CONTENT_TYPE,
     }
+    STREAM_CHUNK_SIZE = 64*1024
+    # form field carrying the SHA-256 of uploaded files, None to not send it
+    UPLOAD_DIGEST_FIELD = None
     ResponseStatusError = exceptions.ResponseStatusError
     
-    def __init__(self, url, username='', password='', cache=False):
+    def __init__(self, url, username='', password='', cache=False, transport=None,
+                 engine='thread', cache_ttl=None, codec=None, file_store=None):
         super(Api, self).__init__(self, url=url)
         self.username = username
         self.password = password
-        self.cache_enabled = cache
-        self.cache = CacheDict()
+        if isinstance(cache, bool):
+            # cache=True enables the default in-memory cache
+            self.cache_enabled, self.cache = cache, ResponseCache()
+        else:
+            self.cache_enabled, self.cache = True, cache
+        self.cache_ttl = cache_ttl
         self.stats = ZeroDefaultDict()
+        # Defaults to the fastest codec available for CONTENT_TYPE, on first use
+        self._codec = get_codec(codec) if codec is not None else None
+        # serialize_response() overrides predating content types take content only
+        args, varargs = inspect.getargspec(self.serialize_response)[:2]
+        self._hook_content_type = varargs is not None or len(args) > 2
+        self.transport = transport or SessionTransport()
+        self.engine = get_engine(engine)
+        # Content-addressed store of downloaded files, see orm.files
+        self.file_store = get_file_store(file_store)
+        self._inflight = SingleFlight(self.engine, share=buffer_response)
+        self.identity_map = weakref.WeakValueDictionary({url: self})
+        self._identity_lock = self.engine.lock()
         self.last_response = None
     
-    def serialize_response(self, content):
+    @property
+    def codec(self):
+        """
+        codec of CONTENT_TYPE, subclasses with content types without a codec
+        override the serialization hooks instead
+        """
+        if self._codec is None:
+            try:
+                self._codec = get_codec(self.CONTENT_TYPE)
+            except ValueError:
+                msg = "serialization for '%s' not implemented"
+                raise NotImplementedError(msg % self.CONTENT_TYPE)
+        return self._codec
+    
+    def get_codec(self, content_type=None):
+        """ codec for a negotiated response content type, the api codec by default """
+        codec = find_codec(content_type)
+        if codec is None:
+            return self.codec
+        try:
+            current = self.codec
+        except NotImplementedError:
+            return codec()
+        return current if isinstance(current, codec) else codec()
+    
+    def get_default_headers(self):
+        """ DEFAULT_HEADERS plus the content negotiation headers of the codec """
+        try:
+            codec_headers = self.codec.headers
+        except NotImplementedError:
+            # DEFAULT_HEADERS of custom content types describe them already
+            codec_headers = {}
+        return dict(self.DEFAULT_HEADERS, **codec_headers)
+    
+    def serialize_response(self, content, content_type=None):
         """ hook for other content-type response serialization """
-        if self.CONTENT_TYPE == 'application/json':
-            return json.loads(content or '{}')
-        else:
-            msg = "serialization for '%s' response not implemented"
-            raise NotImplementedError(msg % self.CONTENT_TYPE)
+        return self.get_codec(content_type).decode(content)
+    
+    def response_content(self, response):
+        """ whole response content decoded by the serialize_response() hook """
+        if self._hook_content_type:
+            content_type = response.headers.get('content-type')
+            return self.serialize_response(response.content, content_type)
+        return self.serialize_response(response.content)
+    
+    def decode_response(self, response):
+        """
+        incrementally decoded response content, list responses are returned as
+        an iterator of objects decoded as soon as they arrive
+        """
+        if type(self).serialize_response.im_func is not Api.serialize_response.im_func:
+            # Custom serialize_response hooks get the whole content
+            content = self.response_content(response)
+            return iter(content) if isinstance(content, list) else content
+        chunks = response.iter_content(self.STREAM_CHUNK_SIZE)
+        content_type = response.headers.get('content-type')
+        return self.get_codec(content_type).iter_decode(chunks)
     
     def serialize_request(self, content):
         """ hook for other content-type request serialization """
-        if self.CONTENT_TYPE == 'application/json':
-            class ResourceJSONEncoder(json.JSONEncoder):
-                def default(self, obj):
-                    try:
-                        return super(ResourceJSONEncoder, self).default(obj)
-                    except TypeError:
-                        return obj.serialize()
-            return json.dumps(content, cls=ResourceJSONEncoder)
-        else:
-            msg = "serialization for '%s' request not implemented"
-            raise NotImplementedError(msg % self.CONTENT_TYPE)
+        return self.codec.encode(content)
+    
+    def send(self, method, *args, **kwargs):
+        """
+        hands the request to the transport, identical concurrent GET and HEAD
+        requests are collapsed into a single one sharing its response
+        """
+        if method in ['get', 'head'] and set(kwargs) <= set(['headers', 'stream']):
+            # stream is not part of the key, shared responses are buffered
+            key = (method, args, tuple(sorted(kwargs['headers'].items())))
+            response, shared = self._inflight.call(key, self._send, method, *args, **kwargs)
+            if shared:
+                self.stats['collapsed'] += 1
+            return response
+        return self._send(method, *args, **kwargs)
+    
+    def _send(self, method, *args, **kwargs):
+        with self.engine.limit(args[0]):
+            response = self.transport.request(method, *args, **kwargs)
+        self.stats.update(self.transport.get_stats())
+        return response
     
     def request(self, method, *args, **kwargs):
         """ request engine, everything goes through this path """
-        headers = kwargs.get('headers', dict(self.DEFAULT_HEADERS))
+        headers = kwargs['headers'] if 'headers' in kwargs else self.get_default_headers()
         headers.update(kwargs.pop('extra_headers', {}))
         kwargs['headers'] = headers
-        method_name = method.__name__.lower()
-        log.info('REQUEST: %s%s' % (method_name.upper(), str(args)))
-        self.stats[method_name] += 1
-        if method in [requests.get, requests.head] and self.cache_enabled:
+        if callable(method):
+            # requests.get and friends are still accepted
+            method = method.__name__
+        method = method.lower()
+        log.info('REQUEST: %s%s' % (method.upper(), str(args)))
+        self.stats[method] += 1
+        if method in ['get', 'head'] and self.cache_enabled and not kwargs.get('stream'):
             try:
                 response = self.cache.get(args, kwargs)
             except KeyError:
-                response = method(*args, **kwargs)
-                self.cache.put((args, kwargs), response)
+                response = self.send(method, *args, **kwargs)
+                self.cache.put((args, kwargs), response, ttl=self.get_cache_ttl(args[0]))
                 log_msg = ' '.join((str(response.status_code), response.reason))
             else:
-                # TODO inconsistency between invalidated entries and cache.hits counter
-                if not response.is_valid and 'If-None-Match' not in kwargs['headers']:
-                    # Invalidated cache entries perform as conditional requests
-                    kwargs['headers']['If-None-Match'] = response.headers['etag']
-                    cond_response = method(*args, **kwargs)
-                    status_code = cond_response.status_code
-                    log_msg = ' '.join((str(status_code), cond_response.reason))
-                    if status_code != status.HTTP_304_NOT_MODIFIED:
-                        response = cond_response
-                        self.cache.put((args, kwargs), response)
-                else:
+                if 'If-None-Match' in kwargs['headers'] or self.cache.is_fresh(response):
+                    log_msg = ' '.join((str(response.status_code), response.reason))
+                elif self.cache.is_stale_servable(response):
+                    # stale-while-revalidate: served as is and refreshed on the background
+                    response.revalidating = True
+                    background_kwargs = dict(kwargs, headers=dict(kwargs['headers']))
+                    self.engine.spawn(self.revalidate, method, args, background_kwargs, response)
+                    self.stats['stale'] += 1
                     log_msg = ' '.join((str(response.status_code), response.reason))
+                else:
+                    # Stale and invalidated cache entries perform as conditional requests
+                    response, cond_response = self.revalidate(method, args, kwargs, response)
+                    log_msg = ' '.join((str(cond_response.status_code), cond_response.reason))
         else:
-            response = method(*args, **kwargs)
+            response = self.send(method, *args, **kwargs)
             if self.cache_enabled and response.status_code/100 == 2:
-                self.cache.invalidate(url=args[0])
+                self.cache.invalidate_related(args[0], collection=(method == 'post'),
+                        links=find_urls(response.content))
             log_msg = ' '.join((str(response.status_code), response.reason))
         if 'If-None-Match' in kwargs['headers']:
             self.stats['conditional'] += 1
@@ -109,43 +197,79 @@ class Api(Resource):
         self.last_response = response
         return response
     
+    def revalidate(self, method, args, kwargs, response):
+        """ conditional request for a cached response, returns (response, cond_response) """
+        etag = response.headers.get('etag')
+        if etag:
+            kwargs['headers']['If-None-Match'] = etag
+        cond_response = self.send(method, *args, **kwargs)
+        ttl = self.get_cache_ttl(args[0])
+        if cond_response.status_code == status.HTTP_304_NOT_MODIFIED:
+            self.cache.refresh(response, cond_response.headers, ttl=ttl)
+        else:
+            response = cond_response
+            self.cache.put((args, kwargs), response, ttl=ttl)
+        return response, cond_response
+    
+    def get_cache_ttl(self, url):
+        """
+        client-side lifetime of responses without Cache-Control or Expires headers,
+        cache_ttl is either a number of seconds or a {manager name: seconds} dict
+        """
+        if not isinstance(self.cache_ttl, dict):
+            return self.cache_ttl
+        endpoint, ttl = '', None
+        for name, seconds in self.cache_ttl.iteritems():
+            manager = self.__dict__.get(name)
+            if isinstance(manager, Manager) and url.startswith(manager.endpoint):
+                if len(manager.endpoint) > len(endpoint):
+                    endpoint, ttl = manager.endpoint, seconds
+        return ttl
+    
     def get(self, url, **kwargs):
         """ low level get method """
-        return self.request(requests.get, url, **kwargs)
+        return self.request('get', url, **kwargs)
     
     def post(self, url, *args, **kwargs):
-        """ low level post method """
+        """
+        low level post method, file-like objects are uploaded as a streaming
+        multipart body and accept a progress(sent, total) callback
+        """
         if args:
             # File-like posting
             if hasattr(args[0], 'fileno'):
-                kwargs['files'] = {'file': args[0]}
+                upload = MultipartStream(args[0], digest_field=self.UPLOAD_DIGEST_FIELD,
+                        progress=kwargs.pop('progress', None))
                 kwargs['extra_headers'] = {
-                    'content-type': None
+                    'content-type': upload.content_type
                 }
-                args = args[1:]
+                response = self.request('post', url, upload, *args[1:], **kwargs)
+                # client side digest of the uploaded content
+                response.sha256 = upload.sha256
+                return response
             else:
                 args = (self.serialize_request(args[0]),) + args[1:]
-        return self.request(requests.post, url, *args, **kwargs)
+        return self.request('post', url, *args, **kwargs)
     
     def put(self, url, *args, **kwargs):
         """ low level put method """
         if args:
             args = (self.serialize_request(args[0]),) + args[1:]
-        return self.request(requests.put, url, *args, **kwargs)
+        return self.request('put', url, *args, **kwargs)
     
     def patch(self, url, *args, **kwargs):
         """ low level patch method """
         if args:
             args = (self.serialize_request(args[0]),) + args[1:]
-        return self.request(requests.patch, url, *args, **kwargs)
+        return self.request('patch', url, *args, **kwargs)
     
     def delete(self, url, **kwargs):
         """ low level delete method """
-        return self.request(requests.delete, url, **kwargs)
+        return self.request('delete', url, **kwargs)
     
     def head(self, url, **kwargs):
-        """ low level delete method """
-        return self.request(requests.head, url, **kwargs)
+        """ low level head method """
+        return self.request('head', url, **kwargs)
     
     def create(self, url, data=None, extra_headers={}, headers=None, **kwargs):
         """ high level api method for creating objects """
@@ -178,6 +302,22 @@ class Api(Resource):
         self.merge(base)
         self.process_links()
     
+    def get_url(self, url, kwargs):
+        """ url with id and server side filters popped out of kwargs """
+        # Hack to retrieve objects by id
+        pk = kwargs.pop('id', None)
+        if pk is not None:
+            url += '%d/' % pk
+        # Server side-filtering
+        filtering = []
+        for key in kwargs.keys():
+            if key not in ['extra_headers']:
+                value = kwargs.pop(key)
+                filtering.append('%s=%s' % (key,value))
+        if filtering:
+            url += '?' + '&'.join(filtering)
+        return url
+    
     def retrieve(self, *args, **kwargs):
         """ high level api method for retrieving objects """
         if not args:
@@ -185,42 +325,57 @@ class Api(Resource):
         elif len(args) != 1:
             raise ValueError('Too many positional arguments')
         else:
-            url = args[0]
-            # Hack to retrieve objects by id
-            pk = kwargs.pop('id', None)
-            if pk is not None:
-                url += '%d/' % pk
-            # Server side-filtering
-            filtering = []
-            for key in kwargs.keys():
-                if key not in ['extra_headers']:
-                    value = kwargs.pop(key)
-                    filtering.append('%s=%s' % (key,value))
-            if filtering:
-                url += '?' + '&'.join(filtering)
+            url = self.get_url(args[0], kwargs)
+            # Cached responses are buffered anyway
+            kwargs.setdefault('stream', not self.cache_enabled)
             response = self.get(url, **kwargs)
             expected = [status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED]
             self.validate_response(response, expected)
-            content = self.serialize_response(response.content)
+            content = self.decode_response(response)
             url = response.url.split('?')[0]
-            if isinstance(content, list):
-                resources = [Resource(self, **obj) for obj in content]
+            if not isinstance(content, dict):
+                resources = [Resource.build(self, **obj) for obj in content]
                 return Collection(resources, api=self, url=url)
-            return Resource(self, _headers=response.headers, **content)
+            return Resource.build(self, _headers=response.headers, **content)
+    
+    def retrieve_page(self, url, **kwargs):
+        """
+        retrieves a page of a list endpoint, returns an iterator of its objects
+        and the url of the next page, taken from a 'next' Link or a
+        {'next': , 'results': } body
+        """
+        kwargs.setdefault('stream', not self.cache_enabled)
+        response = self.get(url, **kwargs)
+        expected = [status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED]
+        self.validate_response(response, expected)
+        content = self.decode_response(response)
+        next_url = response.links.get('next', {}).get('url')
+        if isinstance(content, dict):
+            next_url = content.get('next', next_url)
+            content = content.get('results', [])
+        return content, next_url
+    
+    def stream(self, url, prefetch=True, **kwargs):
+        """
+        lazy collection fetched page by page on iteration, kwargs are server
+        side filters like in retrieve()
+        """
+        url = self.get_url(url, kwargs)
+        return CollectionStream(self, url, prefetch=prefetch, **kwargs)
     
     def update(self, url, data, **kwargs):
         """ high level api method for updating objects """
         response = self.put(url, data, **kwargs)
         self.validate_response(response, status.HTTP_200_OK)
-        content = self.serialize_response(response.content)
-        return Resource(self, **content)
+        content = self.response_content(response)
+        return Resource.build(self, **content)
         
     def partial_update(self, url, data, **kwargs):
         """ high level api method for partially updating objects """
         response = self.patch(url, data, **kwargs)
         self.validate_response(response, status.HTTP_200_OK)
-        content = self.serialize_response(response.content)
-        return Resource(self, **content)
+        content = self.response_content(response)
+        return Resource.build(self, **content)
     
     def destroy(self, url, **kwargs):
         """ high level api method for deleting objects """
@@ -233,7 +388,7 @@ class Api(Resource):
             codes = [codes]
         if response.status_code not in codes:
             try:
-                content = self.serialize_response(response.content)
+                content = self.response_content(response)
             except ValueError:
                 # Internal server error with a bunch of html most probably
                 content = {'detail': response.content[:200] + '[...]'}
@@ -265,8 +420,9 @@ class Api(Resource):
         self.DEFAULT_HEADERS.pop('authorization', None)
     
     def close(self):
-        """ close connection """
-        requests.post(self.url, headers={'Connection':'close'})
+        """ close pooled connections and workers """
+        self.transport.close()
+        self.engine.close()
     
     @classmethod
     def enable_logging(cls, *verbosity):
@@ -278,3 +434,57 @@ class Api(Resource):
     @classmethod
     def disable_logging(cls):
         cls.logger.setLevel(logging.ERROR)
+
+
+def buffer_response(response):
+    """ reads a possibly streamed response body so it can be consumed many times """
+    if response is not None:
+        response.content
+
+
+class AsyncApi(object):
+    """
+    Non-blocking counterpart of Api, high level methods return engine Tasks
+    
+        api = AsyncApi(url, engine=GeventEngine(size=1000))
+        nodes = api.nodes.retrieve().get()
+        for node in nodes.as_completed():
+            ...
+    
+    Link discovery and Manager proxying are those of the wrapped blocking Api,
+    resulting resources are bound to it and take async=True on retrieve(),
+    save() and delete()
+    """
+    def __init__(self, url, **kwargs):
+        self.api = Api(url, **kwargs)
+        self.engine = self.api.engine
+    
+    def __repr__(self):
+        return "<AsyncApi: %s>" % self.api.url
+    
+    def __getattr__(self, name):
+        """ managers are rebound to this api so proxied methods return tasks """
+        attr = getattr(self.api, name)
+        if isinstance(attr, Manager):
+            return Manager(attr.endpoint, attr.relation, self)
+        return attr
+    
+    def spawn(self, method, *args, **kwargs):
+        """ runs a blocking Api method on the engine """
+        self.api.stats['async'] += 1
+        return self.engine.spawn(method, *args, **kwargs)
+    
+    def retrieve(self, *args, **kwargs):
+        return self.spawn(self.api.retrieve, *args, **kwargs)
+    
+    def create(self, *args, **kwargs):
+        return self.spawn(self.api.create, *args, **kwargs)
+    
+    def update(self, *args, **kwargs):
+        return self.spawn(self.api.update, *args, **kwargs)
+    
+    def partial_update(self, *args, **kwargs):
+        return self.spawn(self.api.partial_update, *args, **kwargs)
+    
+    def destroy(self, *args, **kwargs):
+        return self.spawn(self.api.destroy, *args, **kwargs)
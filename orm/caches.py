@@ -1,33 +1,610 @@
-import cPickle
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse
 
+import requests
+from requests.structures import CaseInsensitiveDict
 
-class CacheDict(dict):
-    """ Key-value store """
-    hits = 0
-    misses = 0
+
+# Request headers that select a different representation of the same url
+KEY_HEADERS = ('accept', 'authorization')
+
+# Response headers updated by a 304 Not Modified revalidation
+FRESHNESS_HEADERS = ('cache-control', 'expires', 'date', 'age', 'etag')
+
+
+def cache_key(args, kwargs):
+    """ canonical and cheap key: url plus representation selecting headers """
+    headers = kwargs.get('headers', {})
+    return (args[0],) + tuple(headers.get(name) for name in KEY_HEADERS)
+
+
+def parse_cache_control(value):
+    """ {'max-age': '60', 'no-cache': ''} like dict of Cache-Control directives """
+    directives = {}
+    for directive in (value or '').split(','):
+        name, __, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+def parse_http_date(value):
+    parsed = parsedate_tz(value or '')
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
+
+
+def get_seconds(directives, name):
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, ValueError):
+        return None
+
+
+def freshness(headers, ttl=None, now=None):
+    """
+    (expires, stale_until) timestamps out of Cache-Control, Expires and Age
+    response headers, ttl is used when the server does not provide a lifetime.
+    expires is None when no lifetime is known at all: fresh until invalidated.
+    """
+    now = now or time.time()
+    directives = parse_cache_control(headers.get('cache-control'))
+    try:
+        age = max(0, int(headers.get('age', 0)))
+    except ValueError:
+        age = 0
+    lifetime = get_seconds(directives, 'max-age')
+    if 'no-cache' in directives:
+        lifetime = 0
+    elif lifetime is None and 'expires' in headers:
+        expires = parse_http_date(headers['expires'])
+        date = parse_http_date(headers.get('date')) or now
+        # Invalid dates, like "0", mean already expired
+        lifetime = max(0, expires - date) if expires is not None else 0
+    if lifetime is None:
+        if ttl is None:
+            return None, None
+        lifetime = ttl
+    expires = now + lifetime - age
+    stale = get_seconds(directives, 'stale-while-revalidate')
+    return expires, expires + stale if stale else None
+
+
+def is_storable(headers):
+    return 'no-store' not in parse_cache_control(headers.get('cache-control'))
+
+
+URL_RE = re.compile(r'"(https?://[^"\s]+)"')
+
+
+def find_urls(content):
+    """ urls referenced by a serialized response body """
+    return set(URL_RE.findall(content or ''))
+
+
+def join_path(segments):
+    """ normalized path prefix of split_url() segments """
+    return '/'.join(segments) + '/'
+
+
+def split_url(url):
+    """ ('http://host', 'api', 'nodes', '5') like path segments, query is ignored """
+    parsed = urlparse(url)
+    base = '%s://%s' % (parsed.scheme, parsed.netloc)
+    return (base,) + tuple(segment for segment in parsed.path.split('/') if segment)
+
+
+class PathNode(object):
+    """ url trie node, holds the keys of all query variants of its path """
+    __slots__ = ('segment', 'parent', 'children', 'keys')
+    
+    def __init__(self, segment=None, parent=None):
+        self.segment = segment
+        self.parent = parent
+        self.children = {}
+        self.keys = set()
     
+    def lookup(self, segments, create=False):
+        node = self
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                if not create:
+                    return None
+                child = PathNode(segment, node)
+                node.children[segment] = child
+            node = child
+        return node
+    
+    def subtree_keys(self):
+        keys = list(self.keys)
+        for child in self.children.itervalues():
+            keys.extend(child.subtree_keys())
+        return keys
+    
+    def prune(self):
+        """ removes empty nodes up to the root """
+        node = self
+        while node.parent is not None and not node.keys and not node.children:
+            node.parent.children.pop(node.segment)
+            node = node.parent
+
+
+class LRUPolicy(object):
+    """ least recently used eviction order """
+    def __init__(self):
+        self.order = OrderedDict()
+    
+    def add(self, key):
+        self.order[key] = None
+    
+    def touch(self, key):
+        self.order.pop(key)
+        self.order[key] = None
+    
+    def remove(self, key):
+        self.order.pop(key, None)
+    
+    def victim(self):
+        return next(iter(self.order))
+
+
+class LFUPolicy(object):
+    """ least frequently used eviction order, ties broken by recency """
+    def __init__(self):
+        self.frequencies = {}
+        self.buckets = {}
+        self.min_frequency = 0
+    
+    def add(self, key):
+        self.frequencies[key] = 0
+        self.buckets.setdefault(0, OrderedDict())[key] = None
+        self.min_frequency = 0
+    
+    def touch(self, key):
+        frequency = self.frequencies[key]
+        self._discard(key, frequency)
+        self.frequencies[key] = frequency + 1
+        self.buckets.setdefault(frequency + 1, OrderedDict())[key] = None
+        if self.min_frequency not in self.buckets:
+            self.min_frequency = frequency + 1
+    
+    def remove(self, key):
+        frequency = self.frequencies.pop(key, None)
+        if frequency is not None:
+            self._discard(key, frequency)
+            if self.buckets and self.min_frequency not in self.buckets:
+                self.min_frequency = min(self.buckets)
+    
+    def _discard(self, key, frequency):
+        bucket = self.buckets[frequency]
+        bucket.pop(key)
+        if not bucket:
+            self.buckets.pop(frequency)
+    
+    def victim(self):
+        return next(iter(self.buckets[self.min_frequency]))
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+}
+
+
+class BaseCache(object):
+    """ interface of Api response caches, freshness bookkeeping is shared """
     def get(self, args, kwargs):
-        try:
-            value = self[(args, cPickle.dumps(kwargs))]
-        except KeyError as e:
-            self.misses += 1
-            raise e
-        else:
+        """ cached response for a request, raises KeyError on miss """
+        raise NotImplementedError
+    
+    def put(self, args, value, ttl=None):
+        raise NotImplementedError
+    
+    def invalidate(self, url=None):
+        raise NotImplementedError
+    
+    def remove(self, url=None):
+        raise NotImplementedError
+    
+    def invalidate_related(self, url, collection=False, links=()):
+        """
+        write-through invalidation after a successful write on url:
+         - url with its query variants, and its sub resources unless url is a
+           collection (POST) whose items are not affected by the write
+         - the parent collection with its query variants
+         - entries whose body links to url
+         - linked resources (links of the written body) with their query variants
+        returns the number of invalidated entries
+        """
+        raise NotImplementedError
+    
+    def clear(self):
+        self.remove()
+    
+    def prepare(self, value, ttl):
+        """ initializes cache bookkeeping attributes of a new value """
+        value.is_valid = True
+        value.accesses = 0
+        value.cache_size = len(value.content or '')
+        value.revalidating = False
+        value.expires, value.stale_until = freshness(value.headers, ttl=ttl)
+    
+    def refresh(self, value, headers, ttl=None):
+        """ renews the lifetime of a revalidated value (304 response headers) """
+        for name in FRESHNESS_HEADERS:
+            if name in headers:
+                value.headers[name] = headers[name]
+        value.expires, value.stale_until = freshness(value.headers, ttl=ttl)
+        value.is_valid = True
+        value.revalidating = False
+    
+    def is_fresh(self, value):
+        """ value can be served without contacting the server """
+        return value.is_valid and (value.expires is None or time.time() < value.expires)
+    
+    def is_stale_servable(self, value):
+        """ value is stale but can be served while it is revalidated """
+        if not value.is_valid or value.stale_until is None or value.revalidating:
+            return False
+        return time.time() < value.stale_until
+
+
+class ResponseCache(BaseCache):
+    """
+    Bounded key-value store of responses
+    
+    Memory is bounded by number of entries (max_entries) and/or by the size of
+    the response bodies (max_bytes), None means unbounded. Entries are evicted
+    following the 'lru' or 'lfu' policy. Entries are indexed by url, url path
+    (trie) and linked urls, so invalidate(), invalidate_related() and remove()
+    only visit the affected entries.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, policy='lru'):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.policy = POLICIES[policy]()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        self._entries = {}
+        self._urls = {}
+        self._paths = PathNode()
+        self._dependents = {}
+        self._lock = threading.RLock()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def get(self, args, kwargs):
+        key = cache_key(args, kwargs)
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError as e:
+                self.misses += 1
+                raise e
             self.hits += 1
             value.accesses += 1
+            self.policy.touch(key)
             return value
     
-    def put(self, args, value):
-        self[(args[0], cPickle.dumps(args[1]))] = value
-        value.is_valid = True
-        value.accesses = 0
+    def put(self, args, value, ttl=None):
+        """ stores value, ttl is the lifetime used when headers do not provide one """
+        key = cache_key(*args)
+        self.prepare(value, ttl)
+        with self._lock:
+            self._pop(key)
+            if not is_storable(value.headers):
+                return
+            if self.max_bytes is not None and value.cache_size > self.max_bytes:
+                return
+            self._evict(value.cache_size)
+            self._entries[key] = value
+            self._urls.setdefault(key[0], set()).add(key)
+            self._paths.lookup(split_url(key[0]), create=True).keys.add(key)
+            value.cache_links = set(split_url(url) for url in find_urls(value.content))
+            for path in value.cache_links:
+                self._dependents.setdefault(path, set()).add(key)
+            self.policy.add(key)
+            self.size += value.cache_size
     
     def invalidate(self, url=None):
-        for key, response in self.iteritems():
-            if not url or (url and key[0] == url):
-                response.is_valid = False
-    
-    def remove(self, url=None, accesses=0):
-        for key, response in self.items():
-            if not url or (url and key[0] == url):
-                self.pop(key)
+        """ marks entries as stale, further hits will be revalidated """
+        with self._lock:
+            if url is None:
+                keys = self._entries.keys()
+            else:
+                keys = self._urls.get(url, ())
+            for key in keys:
+                self._entries[key].is_valid = False
+    
+    def invalidate_related(self, url, collection=False, links=()):
+        path = split_url(url)
+        with self._lock:
+            keys = set()
+            node = self._paths.lookup(path)
+            if node is not None:
+                keys.update(node.keys if collection else node.subtree_keys())
+            parent = self._paths.lookup(path[:-1])
+            if parent is not None:
+                keys.update(parent.keys)
+            keys.update(self._dependents.get(path, ()))
+            for link in links:
+                node = self._paths.lookup(split_url(link))
+                if node is not None:
+                    keys.update(node.keys)
+            count = 0
+            for key in keys:
+                value = self._entries[key]
+                count += value.is_valid
+                value.is_valid = False
+            return count
+    
+    def remove(self, url=None):
+        """ drops entries """
+        with self._lock:
+            if url is None:
+                keys = self._entries.keys()
+            else:
+                keys = list(self._urls.get(url, ()))
+            for key in keys:
+                self._pop(key)
+    
+    def _pop(self, key):
+        value = self._entries.pop(key, None)
+        if value is not None:
+            urls = self._urls[key[0]]
+            urls.discard(key)
+            if not urls:
+                self._urls.pop(key[0])
+            node = self._paths.lookup(split_url(key[0]))
+            node.keys.discard(key)
+            node.prune()
+            for path in value.cache_links:
+                dependents = self._dependents[path]
+                dependents.discard(key)
+                if not dependents:
+                    self._dependents.pop(path)
+            self.policy.remove(key)
+            self.size -= value.cache_size
+        return value
+    
+    def _evict(self, size):
+        """ makes room for a new entry of the given size """
+        while self._entries and (
+                (self.max_entries is not None and len(self._entries) >= self.max_entries) or
+                (self.max_bytes is not None and self.size + size > self.max_bytes)):
+            self._pop(self.policy.victim())
+            self.evictions += 1
+
+
+class SQLiteCache(BaseCache):
+    """
+    Persistent response cache stored on a sqlite database file
+    
+    Bodies, headers and ETags survive the process, so other processes sharing
+    the same path revalidate with 304s instead of downloading full payloads.
+    Concurrent readers and writers from multiple processes are serialized by
+    sqlite (write-ahead log journal), each thread uses its own connection.
+    Size bounds and policies are those of ResponseCache.
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            status_code INTEGER NOT NULL,
+            reason TEXT,
+            headers TEXT NOT NULL,
+            content BLOB,
+            etag TEXT,
+            is_valid INTEGER NOT NULL,
+            expires REAL,
+            stale_until REAL,
+            accesses INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            used REAL NOT NULL,
+            path TEXT NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS responses_url ON responses (url)',
+        'CREATE INDEX IF NOT EXISTS responses_used ON responses (used)',
+        'CREATE INDEX IF NOT EXISTS responses_path ON responses (path)',
+        'CREATE TABLE IF NOT EXISTS links (key TEXT NOT NULL, path TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS links_key ON links (key)',
+        'CREATE INDEX IF NOT EXISTS links_path ON links (path)',
+        """CREATE TRIGGER IF NOT EXISTS responses_links AFTER DELETE ON responses
+            BEGIN
+                DELETE FROM links WHERE key = OLD.key;
+            END""",
+    ]
+    EVICTION_ORDER = {
+        'lru': 'used',
+        'lfu': 'accesses, used',
+    }
+    
+    def __init__(self, path, max_entries=None, max_bytes=None, policy='lru', timeout=30):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction_order = self.EVICTION_ORDER[policy]
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._local = threading.local()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.transaction() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+    
+    @property
+    def connection(self):
+        """ per-thread autocommit connection, sqlite connections can not be shared """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                    isolation_level=None)
+            connection.text_factory = str
+            self._local.connection = connection
+        return connection
+    
+    def transaction(self):
+        """ write transaction, locks the database until it finishes """
+        return Transaction(self.connection)
+    
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+    
+    @property
+    def size(self):
+        return self.connection.execute('SELECT TOTAL(size) FROM responses').fetchone()[0]
+    
+    def get(self, args, kwargs):
+        key = json.dumps(cache_key(args, kwargs))
+        row = self.connection.execute(
+            'SELECT url, status_code, reason, headers, content, is_valid, expires, '
+            'stale_until, accesses, size FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.connection.execute(
+            'UPDATE responses SET accesses = accesses + 1, used = ? WHERE key = ?',
+            (time.time(), key)
+        )
+        self.hits += 1
+        value = requests.models.Response()
+        (value.url, value.status_code, value.reason, headers, content, is_valid,
+            value.expires, value.stale_until, accesses, value.cache_size) = row
+        value.headers = CaseInsensitiveDict(json.loads(headers))
+        value._content = str(content) if content is not None else None
+        # the body is already read, iter_content() serves it without raw
+        value._content_consumed = True
+        value.encoding = requests.utils.get_encoding_from_headers(value.headers)
+        value.request = requests.Request('GET', value.url).prepare()
+        value.is_valid = bool(is_valid)
+        value.accesses = accesses + 1
+        value.revalidating = False
+        value.cache_key = key
+        return value
+    
+    def put(self, args, value, ttl=None):
+        key = json.dumps(cache_key(*args))
+        self.prepare(value, ttl)
+        value.cache_key = key
+        with self.transaction() as connection:
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            if not is_storable(value.headers):
+                return
+            if self.max_bytes is not None and value.cache_size > self.max_bytes:
+                return
+            self._evict(connection, value.cache_size)
+            url = args[0][0]
+            connection.execute(
+                'INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, url, value.status_code, value.reason,
+                 json.dumps(dict(value.headers)), sqlite3.Binary(value.content or ''),
+                 value.headers.get('etag'), True, value.expires, value.stale_until,
+                 0, value.cache_size, time.time(), join_path(split_url(url)))
+            )
+            links = set(join_path(split_url(link)) for link in find_urls(value.content))
+            connection.executemany('INSERT INTO links VALUES (?, ?)',
+                    [(key, link) for link in links])
+    
+    def refresh(self, value, headers, ttl=None):
+        super(SQLiteCache, self).refresh(value, headers, ttl=ttl)
+        self.connection.execute(
+            'UPDATE responses SET headers = ?, etag = ?, is_valid = 1, expires = ?, '
+            'stale_until = ? WHERE key = ?',
+            (json.dumps(dict(value.headers)), value.headers.get('etag'), value.expires,
+             value.stale_until, value.cache_key)
+        )
+    
+    def invalidate(self, url=None):
+        if url is None:
+            self.connection.execute('UPDATE responses SET is_valid = 0')
+        else:
+            self.connection.execute('UPDATE responses SET is_valid = 0 WHERE url = ?', (url,))
+    
+    def invalidate_related(self, url, collection=False, links=()):
+        segments = split_url(url)
+        path = join_path(segments)
+        paths = [join_path(segments[:-1])] + [join_path(split_url(link)) for link in links]
+        query = 'UPDATE responses SET is_valid = 0 WHERE is_valid = 1 AND '
+        count = 0
+        with self.transaction() as connection:
+            if collection:
+                count += connection.execute(query + 'path = ?', (path,)).rowcount
+            else:
+                # Paths end with '/' and '0' is the next character: subtree range
+                count += connection.execute(query + 'path >= ? AND path < ?',
+                        (path, path[:-1] + '0')).rowcount
+            for related in paths:
+                count += connection.execute(query + 'path = ?', (related,)).rowcount
+            count += connection.execute(
+                query + 'key IN (SELECT key FROM links WHERE path = ?)', (path,)
+            ).rowcount
+        return count
+    
+    def remove(self, url=None):
+        if url is None:
+            self.connection.execute('DELETE FROM responses')
+        else:
+            self.connection.execute('DELETE FROM responses WHERE url = ?', (url,))
+    
+    def _evict(self, connection, size):
+        """ makes room for a new entry of the given size """
+        if self.max_entries is not None:
+            count = connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            excess = count + 1 - self.max_entries
+            if excess > 0:
+                connection.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    '  SELECT key FROM responses ORDER BY %s LIMIT ?'
+                    ')' % self.eviction_order, (excess,)
+                )
+                self.evictions += excess
+        if self.max_bytes is not None:
+            total = connection.execute('SELECT TOTAL(size) FROM responses').fetchone()[0]
+            cursor = connection.execute(
+                'SELECT key, size FROM responses ORDER BY %s' % self.eviction_order
+            )
+            victims = []
+            for key, entry_size in cursor:
+                if total + size <= self.max_bytes:
+                    break
+                victims.append((key,))
+                total -= entry_size
+            connection.executemany('DELETE FROM responses WHERE key = ?', victims)
+            self.evictions += len(victims)
+
+
+class Transaction(object):
+    """ BEGIN IMMEDIATE ... COMMIT / ROLLBACK context manager """
+    def __init__(self, connection):
+        self.connection = connection
+    
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+    
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+
+# Backwards compatibility
+CacheDict = ResponseCache
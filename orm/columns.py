@@ -0,0 +1,429 @@
+from copy import copy
+
+from . import helpers, exceptions
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NUMBERS = frozenset((int, long, float, bool))
+
+STRINGS = frozenset((str, unicode))
+
+COMPARISONS = ('default', 'exact', 'lt', 'lte', 'gt', 'gte')
+
+
+def prepare(lookup, value):
+    return helpers.PREPARE.get(lookup, lambda value: value)(value)
+
+
+def group_positions(values):
+    groups = {}
+    for position, value in enumerate(values):
+        groups.setdefault(value, []).append(position)
+    return groups
+
+
+def count_values(values):
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+class Backend(object):
+    """
+    Column storage and vectorized operations of ColumnarCollection
+    
+    Columns and masks are backend arrays, row positions are arrays of
+    integers into the resources the columns were built from
+    """
+    name = None
+    
+    def array(self, values):
+        raise NotImplementedError
+    
+    def arange(self, size):
+        raise NotImplementedError
+    
+    def take(self, values, positions):
+        """ values at positions """
+        raise NotImplementedError
+    
+    def compress(self, values, mask):
+        """ values where mask is true """
+        raise NotImplementedError
+    
+    def match(self, values, lookup, value):
+        """ mask of the values matching lookup=value """
+        raise NotImplementedError
+    
+    def ones(self, size):
+        raise NotImplementedError
+    
+    def invert(self, mask):
+        raise NotImplementedError
+    
+    def and_(self, mask, other):
+        raise NotImplementedError
+    
+    def or_(self, mask, other):
+        raise NotImplementedError
+    
+    def argsort(self, values, reverse=False):
+        """ stable sorting positions, equal values keep their order on reverse """
+        raise NotImplementedError
+    
+    def groups(self, values):
+        """ {value: positions} """
+        raise NotImplementedError
+    
+    def counts(self, values):
+        """ {value: occurrences} """
+        raise NotImplementedError
+    
+    def tolist(self, values):
+        raise NotImplementedError
+
+
+class ListBackend(Backend):
+    """ plain Python lists, always available """
+    name = 'list'
+    
+    def array(self, values):
+        return list(values)
+    
+    def arange(self, size):
+        return range(size)
+    
+    def take(self, values, positions):
+        return [values[i] for i in positions]
+    
+    def compress(self, values, mask):
+        return [value for value, selected in zip(values, mask) if selected]
+    
+    def match(self, values, lookup, value):
+        test = helpers.LOOKUPS[lookup]
+        value = prepare(lookup, value)
+        return [test(current, value) for current in values]
+    
+    def ones(self, size):
+        return [True] * size
+    
+    def invert(self, mask):
+        return [not selected for selected in mask]
+    
+    def and_(self, mask, other):
+        return [a and b for a, b in zip(mask, other)]
+    
+    def or_(self, mask, other):
+        return [a or b for a, b in zip(mask, other)]
+    
+    def argsort(self, values, reverse=False):
+        return sorted(range(len(values)), key=values.__getitem__, reverse=reverse)
+    
+    def groups(self, values):
+        return group_positions(values)
+    
+    def counts(self, values):
+        return count_values(values)
+    
+    def tolist(self, values):
+        return list(values)
+
+
+class NumPyBackend(Backend):
+    """
+    NumPy arrays, homogeneous string and number columns get a native dtype and
+    run lookups, sorting and grouping as vectorized operations; anything else
+    is stored as an object array and evaluated value by value
+    """
+    name = 'numpy'
+    
+    def array(self, values):
+        types = set(map(type, values))
+        if types and (types <= STRINGS or types <= NUMBERS):
+            return numpy.array(values)
+        # Resources are stored as they are, numpy would probe them for sequences
+        column = numpy.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+    
+    def arange(self, size):
+        return numpy.arange(size)
+    
+    def take(self, values, positions):
+        return values[positions]
+    
+    def compress(self, values, mask):
+        return values[mask]
+    
+    def _is_native(self, values, value):
+        """ value can be compared with values dtype without falling back to Python """
+        kind = values.dtype.kind
+        if kind in 'SU':
+            return type(value) in STRINGS
+        if kind in 'biuf':
+            return type(value) in NUMBERS
+        return False
+    
+    def match(self, values, lookup, value):
+        test = helpers.LOOKUPS[lookup]
+        value = prepare(lookup, value)
+        if lookup in COMPARISONS and self._is_native(values, value):
+            result = test(values, value)
+            # str and unicode dtypes do not compare elementwise
+            if isinstance(result, numpy.ndarray):
+                return result
+        elif lookup == 'in' and isinstance(value, frozenset):
+            if value and all(self._is_native(values, v) for v in value):
+                return numpy.in1d(values, list(value))
+        elif values.dtype.kind in 'SU' and isinstance(value, basestring):
+            if lookup in ('iexact', 'istartswith', 'icontains'):
+                values = numpy.char.lower(values)
+            if lookup in ('iexact',):
+                return values == value
+            elif lookup in ('startswith', 'istartswith'):
+                kind = values.dtype.kind
+                if not value:
+                    return self.ones(len(values))
+                elif (kind == 'U') == isinstance(value, unicode):
+                    # casting to the prefix length truncates, a vectorized comparison
+                    return values.astype('%s%d' % (kind, len(value))) == value
+                return numpy.char.startswith(values, value)
+            elif lookup in ('contains', 'icontains'):
+                return numpy.char.find(values, value) >= 0
+        return numpy.fromiter(
+            (test(current, value) for current in values.tolist()), dtype=bool, count=len(values)
+        )
+    
+    def ones(self, size):
+        return numpy.ones(size, dtype=bool)
+    
+    def invert(self, mask):
+        return ~mask
+    
+    def and_(self, mask, other):
+        return mask & other
+    
+    def or_(self, mask, other):
+        return mask | other
+    
+    def argsort(self, values, reverse=False):
+        if values.dtype.kind == 'O':
+            values = values.tolist()
+            return numpy.array(sorted(range(len(values)), key=values.__getitem__, reverse=reverse),
+                               dtype=int)
+        if not reverse:
+            return numpy.argsort(values, kind='mergesort')
+        # Stable on the reversed values, then reversed back
+        size = len(values)
+        return size - 1 - numpy.argsort(values[::-1], kind='mergesort')[::-1]
+    
+    def _unique(self, values):
+        keys, inverse = numpy.unique(values, return_inverse=True)
+        return keys.tolist(), inverse
+    
+    def groups(self, values):
+        if values.dtype.kind == 'O':
+            return group_positions(values.tolist())
+        keys, inverse = self._unique(values)
+        positions = numpy.argsort(inverse, kind='mergesort')
+        bounds = numpy.cumsum(numpy.bincount(inverse, minlength=len(keys)))[:-1]
+        return dict(zip(keys, numpy.split(positions, bounds)))
+    
+    def counts(self, values):
+        if values.dtype.kind == 'O':
+            return count_values(values.tolist())
+        keys, inverse = self._unique(values)
+        return dict(zip(keys, numpy.bincount(inverse, minlength=len(keys)).tolist()))
+    
+    def tolist(self, values):
+        return values.tolist()
+
+
+BACKENDS = {
+    ListBackend.name: ListBackend,
+}
+
+if numpy is not None:
+    BACKENDS[NumPyBackend.name] = NumPyBackend
+
+
+def get_backend(backend=None):
+    """ backend instance from a Backend or one of the BACKENDS names, numpy if available """
+    if isinstance(backend, Backend):
+        return backend
+    if backend is None:
+        backend = NumPyBackend.name if numpy is not None else ListBackend.name
+    try:
+        return BACKENDS[backend]()
+    except KeyError:
+        raise ValueError("unknown backend '%s', choices are %s" % (backend, BACKENDS.keys()))
+
+
+class ColumnarCollection(object):
+    """
+    Column oriented view of a Collection for analytic workloads
+        
+        nodes = api.nodes.retrieve().columnar()
+        nodes.filter(arch='x86_64', group__name__startswith='lab').count('set_state')
+    
+    Field values are stored once per field as backend arrays (NumPy when it is
+    installed) and filter, exclude, order_by, group_by, count and values_list
+    are evaluated over them. Derived collections share the columns and only
+    hold row positions, resources are materialized on iteration, indexing or
+    with to_collection(). Columns are snapshots, rebuild the view after the
+    resources change. Fields can follow related resources (group__name) but
+    not related collections.
+    """
+    def __repr__(self):
+        return '<ColumnarCollection: %d rows>' % len(self)
+    
+    def __init__(self, collection, fields=(), backend=None):
+        self.collection = collection
+        self.backend = get_backend(backend)
+        self.columns = {}
+        self.rows = None
+        for field in fields:
+            self.get_column(field)
+    
+    def __iter__(self):
+        return iter(self.resources)
+    
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self._derive(self.backend.arange(len(self))[k])
+        return self.resources[k]
+    
+    def __len__(self):
+        if self.rows is None:
+            return len(self.collection.resources)
+        return len(self.rows)
+    
+    def _derive(self, positions):
+        """ view of the rows at positions of this view """
+        new = copy(self)
+        if self.rows is None:
+            new.rows = positions
+        else:
+            new.rows = self.backend.take(self.rows, positions)
+        return new
+    
+    def get_column(self, field):
+        """ full column of field, built on first use """
+        from .resources import Collection
+        try:
+            return self.columns[field]
+        except KeyError:
+            pass
+        self.collection.retrieve_related(*self.collection._get_related(field), soft=True)
+        accessor = helpers.compile_accessor(field)
+        msg = "'%s' goes through a related collection, use Collection.filter()" % field
+        try:
+            values = [accessor(resource) for resource in self.collection.resources]
+        except AttributeError:
+            prefixes = ['__'.join(field.split('__')[:i]) for i in range(1, field.count('__') + 1)]
+            for resource in self.collection.resources:
+                for prefix in prefixes:
+                    if isinstance(helpers.get_attr(resource, prefix), Collection):
+                        raise ValueError(msg)
+            raise
+        if any(isinstance(value, Collection) for value in values):
+            raise ValueError(msg)
+        # views share the columns dict
+        self.columns[field] = self.backend.array(values)
+        return self.columns[field]
+    
+    def column(self, field):
+        """ field values of the rows in this view """
+        column = self.get_column(field)
+        if self.rows is None:
+            return column
+        return self.backend.take(column, self.rows)
+    
+    def mask(self, q):
+        """ backend mask of the rows matching a helpers.Q """
+        backend = self.backend
+        mask = None
+        for child in q.children:
+            if isinstance(child, helpers.Q):
+                current = self.mask(child)
+            else:
+                field, lookup = helpers.split_lookup(child[0])
+                current = backend.match(self.column(field), lookup, child[1])
+            if mask is None:
+                mask = current
+            elif q.connector == q.AND:
+                mask = backend.and_(mask, current)
+            else:
+                mask = backend.or_(mask, current)
+        if mask is None:
+            mask = backend.ones(len(self))
+        return backend.invert(mask) if q.negated else mask
+    
+    def _select(self, mask):
+        positions = self.backend.compress(self.backend.arange(len(self)), mask)
+        return self._derive(positions)
+    
+    def filter(self, *args, **kwargs):
+        """ accepts the same lookups and helpers.Q objects than Collection.filter() """
+        return self._select(self.mask(helpers.Q(*args, **kwargs)))
+    
+    def exclude(self, *args, **kwargs):
+        """ drops rows matching any of the lookups, like Collection.exclude() """
+        q = helpers.Q(*args, **kwargs)
+        q.connector = q.OR
+        return self._select(self.backend.invert(self.mask(q)))
+    
+    def get(self, *args, **kwargs):
+        resources = self.filter(*args, **kwargs)[:2].resources
+        relation = self.collection.manager.relation
+        if len(resources) > 1:
+            raise exceptions.MultipleObjects(
+                'More than one resource returned with "%s" on "%s"' % (str(kwargs), relation)
+            )
+        elif len(resources) < 1:
+            raise exceptions.DoesNotExist(
+                'Resource with "%s" do not exists on "%s"' % (str(kwargs), relation)
+            )
+        return resources[0]
+    
+    def order_by(self, field, reverse=False):
+        """ new view sorted by field, stable like sorted() """
+        return self._derive(self.backend.argsort(self.column(field), reverse=reverse))
+    
+    def group_by(self, field):
+        """ {value: ColumnarCollection} """
+        groups = self.backend.groups(self.column(field))
+        return {key: self._derive(positions) for key, positions in groups.iteritems()}
+    
+    def count(self, field=None):
+        """ number of rows, {value: rows} of field when provided """
+        if field is None:
+            return len(self)
+        return self.backend.counts(self.column(field))
+    
+    def values_list(self, field):
+        """ Collection of the field values, no resource is materialized """
+        new = copy(self.collection)
+        new.resources = self.backend.tolist(self.column(field))
+        new.__dict__.pop('_indexes', None)
+        return new
+    
+    @property
+    def resources(self):
+        resources = self.collection.resources
+        if self.rows is None:
+            return list(resources)
+        return [resources[i] for i in self.backend.tolist(self.rows)]
+    
+    def to_collection(self):
+        """ Collection of the resources in this view """
+        new = copy(self.collection)
+        new.resources = self.resources
+        new.__dict__.pop('_indexes', None)
+        return new
@@ -0,0 +1,310 @@
+import Queue
+import sys
+import threading
+import time
+from urlparse import urlparse
+
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
+import gevent.queue
+from gevent import monkey
+
+
+class Task(object):
+    """ outcome of a spawned call, errors are collected instead of propagated """
+    def __init__(self, done, func, *args, **kwargs):
+        self._done = done
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exception = None
+        self.exc_info = None
+    
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception as exc:
+            self.exception = exc
+            self.exc_info = sys.exc_info()
+        finally:
+            self._done.set()
+    
+    def ready(self):
+        return self._done.is_set()
+    
+    def successful(self):
+        return self.ready() and self.exception is None
+    
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.ready()
+    
+    def get(self, timeout=None):
+        """ waits for the result, re-raising the call exception if any """
+        if not self.wait(timeout):
+            raise RuntimeError('task did not finish in %s seconds' % timeout)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class NullLimit(object):
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class Engine(object):
+    """
+    Concurrency engine interface, one per Api
+    
+    size bounds the number of concurrent workers and host_limit the number of
+    concurrent requests per host (network location), None means no limit
+    """
+    name = None
+    
+    def __init__(self, size=10, host_limit=None):
+        self.size = size
+        self.host_limit = host_limit
+        self._limits = {}
+        self._lock = self.lock()
+    
+    def lock(self):
+        return threading.Lock()
+    
+    def event(self):
+        return threading.Event()
+    
+    def semaphore(self, value):
+        return threading.BoundedSemaphore(value)
+    
+    def queue(self):
+        return Queue.Queue()
+    
+    def sleep(self, seconds):
+        time.sleep(seconds)
+    
+    def derive(self, size):
+        """
+        new engine of the same kind, spawns from the workers of this engine
+        are not run inline on it
+        """
+        return type(self)(size=size, host_limit=self.host_limit)
+    
+    def spawn(self, func, *args, **kwargs):
+        """ schedules func(*args, **kwargs) returning a Task """
+        raise NotImplementedError
+    
+    def run(self, func, items):
+        """ applies func to every item concurrently, returns [(item, task)] """
+        tasks = [(item, self.spawn(func, item)) for item in items]
+        for item, task in tasks:
+            task.wait()
+        return tasks
+    
+    def as_completed(self, func, items):
+        """ applies func to every item concurrently, yields (item, task) as they finish """
+        finished = self.queue()
+        def call(item):
+            task = Task(self.event(), func, item)
+            task.run()
+            finished.put((item, task))
+        pending = 0
+        for item in items:
+            self.spawn(call, item)
+            pending += 1
+        for __ in range(pending):
+            yield finished.get()
+    
+    def offload(self, func, *args, **kwargs):
+        """
+        runs CPU bound func(*args, **kwargs) on a worker thread, threaded
+        engines run it inline since hashlib and zlib release the GIL
+        """
+        return func(*args, **kwargs)
+    
+    def limit(self, url):
+        """ context manager bounding concurrent requests to url's host """
+        if not self.host_limit:
+            return NullLimit()
+        host = urlparse(url).netloc
+        try:
+            return self._limits[host]
+        except KeyError:
+            with self._lock:
+                if host not in self._limits:
+                    self._limits[host] = self.semaphore(self.host_limit)
+            return self._limits[host]
+    
+    def close(self):
+        pass
+
+
+class SerialEngine(Engine):
+    """ runs everything on the calling thread, one call at a time """
+    name = 'serial'
+    
+    def spawn(self, func, *args, **kwargs):
+        task = Task(self.event(), func, *args, **kwargs)
+        task.run()
+        return task
+
+
+class ThreadEngine(Engine):
+    """ bounded pool of worker threads, no monkey patching required """
+    name = 'thread'
+    
+    def __init__(self, *args, **kwargs):
+        super(ThreadEngine, self).__init__(*args, **kwargs)
+        self._queue = Queue.Queue()
+        self._workers = []
+        self._local = threading.local()
+    
+    def _work(self):
+        self._local.is_worker = True
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            task.run()
+    
+    def spawn(self, func, *args, **kwargs):
+        task = Task(self.event(), func, *args, **kwargs)
+        if getattr(self._local, 'is_worker', False):
+            # Nested spawns are run inline, waiting on them would deadlock the pool
+            task.run()
+            return task
+        if len(self._workers) < self.size:
+            with self._lock:
+                if len(self._workers) < self.size:
+                    worker = threading.Thread(target=self._work)
+                    worker.daemon = True
+                    worker.start()
+                    self._workers.append(worker)
+        self._queue.put(task)
+        return task
+    
+    def close(self):
+        for worker in self._workers:
+            self._queue.put(None)
+        self._workers = []
+
+
+class GeventEngine(Engine):
+    """
+    bounded pool of greenlets
+    
+    Greenlets only overlap network I/O on a monkey patched stdlib, patch=True
+    calls gevent.monkey.patch_all() unless the socket module is already patched
+    """
+    name = 'gevent'
+    
+    def __init__(self, size=100, host_limit=None, patch=True):
+        if patch and not monkey.is_module_patched('socket'):
+            monkey.patch_all(thread=False, select=False)
+        super(GeventEngine, self).__init__(size=size, host_limit=host_limit)
+        self.pool = gevent.pool.Pool(size)
+    
+    def lock(self):
+        return gevent.lock.RLock()
+    
+    def event(self):
+        return gevent.event.Event()
+    
+    def semaphore(self, value):
+        return gevent.lock.BoundedSemaphore(value)
+    
+    def queue(self):
+        return gevent.queue.Queue()
+    
+    def sleep(self, seconds):
+        gevent.sleep(seconds)
+    
+    def derive(self, size):
+        return type(self)(size=size, host_limit=self.host_limit, patch=False)
+    
+    def offload(self, func, *args, **kwargs):
+        # the hub keeps serving greenlets while the thread pool computes
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    
+    def spawn(self, func, *args, **kwargs):
+        task = Task(self.event(), func, *args, **kwargs)
+        if gevent.getcurrent() in self.pool:
+            # Nested spawns are run inline, waiting on them would deadlock the pool
+            task.run()
+        else:
+            self.pool.spawn(task.run)
+        return task
+    
+    def close(self):
+        self.pool.kill()
+
+
+class SingleFlight(object):
+    """
+    coalesces concurrent calls sharing the same key into a single execution
+    
+    share(value) is applied to values that other callers waited for before
+    any of them gets it, i.e. buffering a streamed response
+    """
+    def __init__(self, engine, share=None):
+        self.engine = engine
+        self.share = share
+        self._lock = engine.lock()
+        self._calls = {}
+        self._waiters = {}
+    
+    def call(self, key, func, *args, **kwargs):
+        """ returns (value, shared), shared is True for callers that only waited """
+        with self._lock:
+            task = self._calls.get(key)
+            leader = task is None
+            if leader:
+                task = Task(self.engine.event(), self._lead, key, func, args, kwargs)
+                self._calls[key] = task
+                self._waiters[key] = 0
+            else:
+                self._waiters[key] += 1
+        if leader:
+            try:
+                task.run()
+            finally:
+                self._release(key, task)
+        return task.get(), not leader
+    
+    def _lead(self, key, func, args, kwargs):
+        value = func(*args, **kwargs)
+        # No caller can join once released, waiters only read value afterwards
+        if self._release(key) and self.share is not None:
+            self.share(value)
+        return value
+    
+    def _release(self, key, task=None):
+        """ stops sharing key, returns the number of waiting callers """
+        with self._lock:
+            if task is not None and self._calls.get(key) is not task:
+                return 0
+            self._calls.pop(key, None)
+            return self._waiters.pop(key, 0)
+
+
+ENGINES = {
+    SerialEngine.name: SerialEngine,
+    ThreadEngine.name: ThreadEngine,
+    GeventEngine.name: GeventEngine,
+}
+
+
+def get_engine(engine, **options):
+    """ engine instance from an Engine or one of the ENGINES names """
+    if isinstance(engine, Engine):
+        return engine
+    try:
+        return ENGINES[engine](**options)
+    except KeyError:
+        raise ValueError("unknown engine '%s', choices are %s" % (engine, ENGINES.keys()))
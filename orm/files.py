@@ -1,23 +1,43 @@
+import binascii
+import errno
 import hashlib
 import io
+import json
 import os
-
-import gevent
+import re
+import shutil
+import threading
+import uuid
+from urlparse import urlparse
 
 from . import status
 
 
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+SHA256 = re.compile(r'[0-9a-f]{64}\Z')
+
+
 class FileHandler(object):
     """
     Handles file objects with convenient methods.
     
-    Files are never loaded into memory and asynchronous downloading is supported
+    Files are never loaded into memory and asynchronous downloading is supported.
+    Content is hashed while it is downloaded and files are written to a
+    temporary file that is only renamed to its destination when the SHA-256
+    digest matches, so a failed download never replaces an existing file.
     """
+    # bytes read, hashed and written per iteration
+    CHUNK_SIZE = 1024*1024
+    # concurrent Range requests of big downloads
+    SEGMENTS = 4
+    MIN_SEGMENT_SIZE = 16*1024*1024
+    
     def __init__(self, parent, field_name):
         self.parent = parent
         self.field_name = field_name
         self.file = None
         self.content = None
+        self.digest = None
     
     @property
     def sha256(self):
@@ -35,39 +55,573 @@ class FileHandler(object):
     def uri(self, value):
         setattr(self.parent, '%s_uri' % self.field_name, value)
     
-    def retrieve(self, save_to=None, async=False):
+    def retrieve(self, save_to=None, async=False, chunk_size=None, segments=None,
+                 bandwidth=None, engine=None):
+        """
+        downloads the file to save_to (a directory when it ends with '/') or
+        into content, raises ValueError when the SHA-256 digest does not match
+        
+        Files are downloaded with concurrent Range requests of up to segments
+        (SEGMENTS by default) parts when the server supports them, interrupted
+        downloads are resumed on the next retrieve() to the same path.
+        bandwidth is an optional transfers.Bandwidth limit and engine the one
+        segments are fetched on, the api engine by default.
+        """
         def download(self, save_to=save_to):
-            response = self.parent.api.get(self.uri, stream=True)
-            self.parent.api.validate_response(response, status.HTTP_200_OK)
+            chunk_size_ = chunk_size or self.CHUNK_SIZE
+            segments_ = segments or self.SEGMENTS
+            if save_to and save_to.endswith('/'):
+                # filename not provided
+                file_name = urlparse(self.uri).path.split('/')[-1]
+                save_to = os.path.join(save_to, file_name)
+            store = self.parent.api.file_store
+            if store is not None and self.sha256:
+                return self.retrieve_stored(store, save_to, segments_, chunk_size_, bandwidth,
+                        engine)
             if save_to:
-                if save_to.endswith('/'):
-                    # filename not provided
-                    file_name = response.url.split('/')[-1]
-                    save_to = os.path.join(save_to, file_name)
-                with open(save_to, 'wb') as self.file:
-                    for chunk in response.iter_content():
-                        self.file.write(chunk)
-            else:
-                self.content = response.content
-            self.validate_sha256()
+                ranged = RangedDownload(self, save_to, segments_, chunk_size_, bandwidth, engine)
+                return ranged.run()
+            response = self.parent.api.get(self.uri, stream=True)
+            try:
+                self.parent.api.validate_response(response, status.HTTP_200_OK)
+                chunks = iter_content(response, chunk_size_, bandwidth)
+                self.load(chunks, size=get_content_length(response))
+            finally:
+                response.close()
         
         if async:
-            self.glet = gevent.spawn(download, self, save_to=save_to)
+            self.task = self.parent.api.engine.spawn(download, self, save_to=save_to)
             self.parent.api.stats['async'] += 1
-            return self.glet
+            return self.task
         return download(self, save_to=save_to)
     
-    def validate_sha256(self):
-        if self.file is None and self.content is None:
-            raise IOError('the file must be retrieved first')
-        if self.file is None:
-            sha256 = hashlib.sha256(self.content)
+    def retrieve_stored(self, store, save_to, segments, chunk_size, bandwidth=None,
+                        engine=None):
+        """
+        serves the file from the api file store, downloading it into the store
+        first when missing; concurrent downloads of the same file are shared
+        """
+        api = self.parent.api
+        digest = self.sha256
+        def fetch():
+            if not store.touch(digest):
+                store.prepare(digest)
+                path = store.get_path(digest)
+                RangedDownload(self, path, segments, chunk_size, bandwidth, engine).run()
+                store.add(digest)
+        # the file is not collected while it is being served
+        store.hold(digest)
+        try:
+            if store.touch(digest):
+                api.stats['stored'] += 1
+            else:
+                api._inflight.call(('file', digest), fetch)
+            try:
+                self.serve_stored(store, digest, save_to, chunk_size)
+            except (IOError, OSError) as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                # collected by another process sharing the store
+                api._inflight.call(('file', digest), fetch)
+                self.serve_stored(store, digest, save_to, chunk_size)
+        finally:
+            store.release(digest)
+    
+    def serve_stored(self, store, digest, save_to, chunk_size):
+        if save_to:
+            store.export(digest, save_to)
+            self.digest = digest
+            self.set_file(save_to)
         else:
-            block_size=2**20
+            with open(store.get_path(digest), 'rb') as stored:
+                chunks = iter(lambda: stored.read(chunk_size), b'')
+                self.load(chunks, size=os.fstat(stored.fileno()).st_size)
+    
+    def save(self, chunks, path):
+        """ writes chunks to path through a temporary file, hashing them on the way """
+        suffix = binascii.hexlify(os.urandom(4))
+        tmp_path = '%s.%s.part' % (path, suffix)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        try:
             sha256 = hashlib.sha256()
-            with open(self.file.name, 'rb') as self.file:
-                for chunk in iter(lambda: self.file.read(block_size), b''):
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in chunks:
                     sha256.update(chunk)
-        hexdigest = sha256.hexdigest()
-        if self.sha256 != hexdigest:
-            raise ValueError("'%s' != '%s'" % (self.sha256, hexdigest))
+                    tmp_file.write(chunk)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            self.digest = sha256.hexdigest()
+            self.validate_sha256()
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.set_file(path)
+    
+    def set_file(self, path):
+        # Closed file object of the destination, like the one used for writing
+        self.file = io.open(path, 'rb')
+        self.file.close()
+    
+    def load(self, chunks, size=None):
+        """
+        reads chunks into a bytearray, preallocated when size is known,
+        hashing them on the way
+        """
+        sha256 = hashlib.sha256()
+        content = bytearray(size or 0)
+        view = memoryview(content)
+        position = 0
+        for chunk in chunks:
+            sha256.update(chunk)
+            end = position + len(chunk)
+            if end <= len(content):
+                view[position:end] = chunk
+            else:
+                # Unknown or wrong size, bytearrays grow in place once unexported
+                del view
+                content[position:] = chunk
+                view = memoryview(content)
+            position = end
+        del view
+        del content[position:]
+        self.digest = sha256.hexdigest()
+        self.validate_sha256()
+        self.content = content
+    
+    def validate_sha256(self):
+        """ checks the digest computed while downloading against the expected one """
+        if self.digest is None:
+            raise IOError('the file must be retrieved first')
+        if self.sha256 != self.digest:
+            raise ValueError("'%s' != '%s'" % (self.sha256, self.digest))
+
+
+def iter_content(response, chunk_size, bandwidth=None):
+    """ response chunks, throttled when a bandwidth limit is given """
+    chunks = response.iter_content(chunk_size)
+    if bandwidth is None:
+        return chunks
+    return bandwidth.throttle(chunks)
+
+
+def hash_file(path, chunk_size):
+    """ SHA-256 hexdigest of the file in path """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as handler:
+        for chunk in iter(lambda: handler.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_content_length(response):
+    """ size of the decoded content, None when unknown """
+    encoding = response.headers.get('content-encoding', 'identity')
+    length = response.headers.get('content-length')
+    if encoding != 'identity' or not length or not length.isdigit():
+        return None
+    return int(length)
+
+
+class RangedDownload(object):
+    """
+    Multi-segment download of a FileHandler into path
+    
+    Segments are fetched concurrently on the engine and written in place
+    into a preallocated <path>.part file. Progress is recorded on a
+    <path>.journal file, so an interrupted download restarts every segment
+    where it stopped. The whole file is hashed before it is renamed to path.
+    Servers without Range support get a regular single stream download.
+    """
+    def __init__(self, handler, path, segments, chunk_size, bandwidth=None, engine=None):
+        self.handler = handler
+        self.api = handler.parent.api
+        self.engine = engine or self.api.engine
+        self.uri = handler.uri
+        self.path = path
+        self.part_path = '%s.part' % path
+        self.journal_path = '%s.journal' % path
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.bandwidth = bandwidth
+        self.size = None
+        self.ranges = []
+        self._lock = self.engine.lock()
+    
+    def run(self):
+        response = None
+        if not self.load_journal():
+            response = self.get(0, None)
+            content_range = CONTENT_RANGE.match(response.headers.get('content-range', ''))
+            if response.status_code != status.HTTP_206_PARTIAL_CONTENT or not content_range:
+                # Range requests not supported
+                try:
+                    return self.handler.save(self.iter_content(response), self.path)
+                finally:
+                    response.close()
+            self.size = int(content_range.group(3))
+            self.ranges = self.split(self.size)
+            if len(self.ranges) <= 1:
+                try:
+                    return self.handler.save(self.iter_content(response), self.path)
+                finally:
+                    response.close()
+            with open(self.part_path, 'wb') as part:
+                part.truncate(self.size)
+            self.save_journal()
+        # The first response is consumed by the first segment
+        tasks = []
+        for segment in self.ranges:
+            tasks.append(self.engine.spawn(self.fetch, segment, response))
+            response = None
+        for task in tasks:
+            task.wait()
+        for task in tasks:
+            task.get()
+        self.finish()
+    
+    def split(self, size):
+        """ [start, end, downloaded] of every segment """
+        count = min(self.segments, max(1, size // self.handler.MIN_SEGMENT_SIZE))
+        length = max(1, -(-size // count))
+        return [
+            [start, min(start + length, size) - 1, 0] for start in range(0, size, length)
+        ]
+    
+    def get(self, start, end):
+        headers = {'range': 'bytes=%d-%s' % (start, '' if end is None else end)}
+        response = self.api.get(self.uri, stream=True, extra_headers=headers)
+        if response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE and not start:
+            # Empty files have no satisfiable ranges
+            response.close()
+            response = self.api.get(self.uri, stream=True)
+        codes = [status.HTTP_200_OK, status.HTTP_206_PARTIAL_CONTENT]
+        try:
+            self.api.validate_response(response, codes)
+        except Exception:
+            response.close()
+            raise
+        return response
+    
+    def fetch(self, segment, response=None):
+        """ downloads the remaining bytes of segment """
+        start, end, downloaded = segment
+        offset = start + downloaded
+        if offset > end:
+            return
+        if response is None:
+            response = self.get(offset, end)
+            content_range = CONTENT_RANGE.match(response.headers.get('content-range', ''))
+            if not content_range or int(content_range.group(1)) != offset:
+                response.close()
+                # the file can not be resumed, next retrieve() starts over
+                self.discard()
+                raise IOError('%s: range requests are no longer supported' % self.uri)
+        try:
+            remaining = end - offset + 1
+            with open(self.part_path, 'r+b') as part:
+                part.seek(offset)
+                for chunk in self.iter_content(response):
+                    chunk = chunk[:remaining]
+                    part.write(chunk)
+                    part.flush()
+                    remaining -= len(chunk)
+                    segment[2] += len(chunk)
+                    self.save_journal()
+                    if not remaining:
+                        break
+        finally:
+            response.close()
+        if remaining:
+            raise IOError('%s: connection closed %d bytes before the end of %s' %
+                    (self.uri, remaining, segment))
+    
+    def iter_content(self, response):
+        return iter_content(response, self.chunk_size, self.bandwidth)
+    
+    def finish(self):
+        """ verifies the whole file and moves it to its destination """
+        with open(self.part_path, 'rb') as part:
+            os.fsync(part.fileno())
+        # hashing is CPU bound, it does not hold the engine workers
+        self.handler.digest = self.engine.offload(hash_file, self.part_path, self.chunk_size)
+        try:
+            self.handler.validate_sha256()
+        except ValueError:
+            self.discard()
+            raise
+        os.rename(self.part_path, self.path)
+        os.remove(self.journal_path)
+        self.handler.set_file(self.path)
+    
+    def load_journal(self):
+        """ resumes a previous download of the same file, False if there is none """
+        try:
+            with open(self.journal_path, 'rb') as journal:
+                state = json.load(journal)
+        except (IOError, ValueError):
+            return False
+        expected = (self.uri, self.handler.sha256)
+        if (state['uri'], state['sha256']) != expected or not os.path.exists(self.part_path):
+            self.discard()
+            return False
+        self.size = state['size']
+        self.ranges = state['segments']
+        return True
+    
+    def save_journal(self):
+        state = {
+            'uri': self.uri,
+            'sha256': self.handler.sha256,
+            'size': self.size,
+            'segments': self.ranges,
+        }
+        with self._lock:
+            tmp_path = '%s.tmp' % self.journal_path
+            with open(tmp_path, 'wb') as journal:
+                json.dump(state, journal)
+            os.rename(tmp_path, self.journal_path)
+    
+    def discard(self):
+        for path in (self.part_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class FileStore(object):
+    """
+    Content-addressed local store of downloaded files keyed by their SHA-256
+    
+        api = Api(url, file_store='/var/cache/orchestra/files/')
+    
+    FileHandler looks files up by digest before downloading them, files
+    found are hard linked (copied with link=False or across filesystems)
+    to their destination. Stored files are read-only, hard linked copies
+    share them and must not be modified in place. With max_size the least
+    recently used files are removed once the store grows beyond max_size bytes,
+    except those held by an ongoing retrieve. Digests that are not lowercase
+    hex SHA-256 digests are rejected with ValueError.
+    """
+    def __repr__(self):
+        return "<FileStore: %s>" % self.root
+    
+    def __init__(self, root, max_size=None, link=True):
+        self.root = root
+        self.max_size = max_size
+        self.link = link
+        self._held = {}
+        self._lock = threading.Lock()
+    
+    def __contains__(self, digest):
+        return os.path.exists(self.get_path(digest))
+    
+    def get_path(self, digest):
+        # digests come from the server, they must not escape root
+        if not isinstance(digest, basestring) or not SHA256.match(digest):
+            raise ValueError("invalid SHA-256 digest %r" % (digest,))
+        return os.path.join(self.root, digest[:2], digest)
+    
+    def hold(self, digest):
+        """ protects digest from collect() until release() """
+        self.get_path(digest)
+        with self._lock:
+            self._held[digest] = self._held.get(digest, 0) + 1
+    
+    def release(self, digest):
+        with self._lock:
+            self._held[digest] -= 1
+            if not self._held[digest]:
+                del self._held[digest]
+    
+    def prepare(self, digest):
+        """ creates the directory of digest """
+        try:
+            os.makedirs(os.path.dirname(self.get_path(digest)))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+    
+    def touch(self, digest):
+        """ marks digest as recently used, False if it is not stored """
+        try:
+            os.utime(self.get_path(digest), None)
+        except OSError:
+            return False
+        return True
+    
+    def add(self, digest, path=None):
+        """ stores the file at path (already in place by default) under digest """
+        target = self.get_path(digest)
+        if path is not None and path != target:
+            self.prepare(digest)
+            copy_file(path, target, link=self.link)
+        os.chmod(target, 0444)
+        self.touch(digest)
+        self.collect(keep=digest)
+    
+    def export(self, digest, path):
+        """ places the stored file of digest at path """
+        copy_file(self.get_path(digest), path, link=self.link)
+        self.touch(digest)
+    
+    def get_files(self):
+        """ [(last use, size, path)] of every stored file """
+        files = []
+        for directory in os.listdir(self.root):
+            directory = os.path.join(self.root, directory)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if '.' in name:
+                    # part files and journals of ongoing downloads
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+    
+    def collect(self, keep=None):
+        """ removes least recently used files until the store fits in max_size """
+        if self.max_size is None:
+            return
+        files = sorted(self.get_files())
+        size = sum(file_size for mtime, file_size, path in files)
+        with self._lock:
+            keep = set(self._held) | set([keep])
+        for mtime, file_size, path in files:
+            if size <= self.max_size:
+                return
+            if os.path.basename(path) not in keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= file_size
+
+
+def copy_file(source, path, link=True):
+    """ atomically hard links (or copies) source to path, replacing it """
+    tmp_path = '%s.%s.part' % (path, binascii.hexlify(os.urandom(4)))
+    try:
+        if not link:
+            raise OSError(errno.EXDEV, 'links disabled')
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copyfile(source, tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    finally:
+        # rename() is a no-op when path is already a link to source
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_file_store(file_store):
+    """ FileStore from a FileStore, a directory path or None """
+    if file_store is None or isinstance(file_store, FileStore):
+        return file_store
+    return FileStore(file_store)
+
+
+class MultipartStream(object):
+    """
+    Streaming multipart/form-data body of a file upload for requests
+    
+    The file is read in chunk_size blocks and hashed on the fly, memory does
+    not depend on the file size. Bodies of files with a known size are sent
+    with Content-Length, otherwise (i.e. text streams) with chunked transfer
+    encoding. With digest_field the SHA-256 of the file is appended as an
+    extra form field for the server to verify it. progress(sent, total) is
+    called as the body is consumed, total is None when the size is unknown.
+    """
+    def __init__(self, file, name='file', digest_field=None, progress=None,
+                 chunk_size=FileHandler.CHUNK_SIZE):
+        self.file = file
+        self.name = name
+        self.digest_field = digest_field
+        self.progress = progress
+        self.chunk_size = chunk_size
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.sha256 = None
+        self.sent = 0
+        file_name = os.path.basename(getattr(file, 'name', None) or name)
+        if not isinstance(file_name, unicode):
+            file_name = file_name.decode('utf-8', 'replace')
+        header = (
+            u'--%s\r\n'
+            u'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+            u'Content-Type: application/octet-stream\r\n\r\n'
+        ) % (self.boundary, name, file_name.replace('"', '\\"'))
+        self.header = header.encode('utf-8')
+        self.footer = self.get_footer('0'*64)
+        size = get_file_size(file)
+        # requests.utils.super_len() reads len, None means chunked encoding
+        self.len = None if size is None else len(self.header) + size + len(self.footer)
+        self._parts = self.iter_parts()
+        self._chunk = b''
+        self._position = 0
+    
+    def get_footer(self, hexdigest):
+        footer = '\r\n'
+        if self.digest_field:
+            footer += (
+                '--%s\r\n'
+                'Content-Disposition: form-data; name="%s"\r\n\r\n'
+                '%s\r\n'
+            ) % (self.boundary, self.digest_field, hexdigest)
+        footer += '--%s--\r\n' % self.boundary
+        return footer.encode('utf-8')
+    
+    def iter_parts(self):
+        yield self.header
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: self.file.read(self.chunk_size), ''):
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            sha256.update(chunk)
+            yield chunk
+        self.sha256 = sha256.hexdigest()
+        yield self.get_footer(self.sha256)
+    
+    def read(self, size=-1):
+        """ up to size bytes of the body, '' at the end """
+        while self._position >= len(self._chunk):
+            try:
+                self._chunk = next(self._parts)
+            except StopIteration:
+                return b''
+            self._position = 0
+        if size < 0:
+            size = len(self._chunk)
+        data = self._chunk[self._position:self._position+size]
+        self._position += len(data)
+        self.sent += len(data)
+        if self.progress is not None:
+            self.progress(self.sent, self.len)
+        return data
+    
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+
+def get_file_size(file):
+    """ remaining bytes of a binary file, None when unknown """
+    if isinstance(file, io.TextIOBase):
+        return None
+    try:
+        return os.fstat(file.fileno()).st_size - file.tell()
+    except (AttributeError, IOError, OSError):
+        pass
+    try:
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        size = file.tell() - position
+        file.seek(position)
+    except (AttributeError, IOError, OSError):
+        return None
+    return size
@@ -1,108 +1,414 @@
-import re
+import logging
+import operator
 
+from .engines import Task
+from .managers import Manager
 
+
+#logging.basicConfig()
+log = logging.getLogger(__name__)
+
+# Conservative limit for proxies and servers
+MAX_URL_LENGTH = 2000
+
+# lookup(attribute value, prepared filter value)
 LOOKUPS = {
-    'default': lambda a,b: a == b,
-    'lt': lambda a,b: a < b,
-    'lte': lambda a,b: a <= b,
-    'gt': lambda a,b: a > b,
-    'gte': lambda a,b: a >= b,
+    'default': operator.eq,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
     'in': lambda a,b: a in b,
-    'exact': lambda a,b: a == b,
-    'iexact': lambda a,b: a.lower() == b.lower(),
+    'exact': operator.eq,
+    'iexact': lambda a,b: a.lower() == b,
     'startswith': lambda a,b: a.startswith(b),
-    'istartswith': lambda a,b: a.lower().startswith(b.lower()),
+    'istartswith': lambda a,b: a.lower().startswith(b),
     'contains': lambda a,b: b in a,
-    'icontains': lambda a,b: b.lower() in a.lower(),
+    'icontains': lambda a,b: b in a.lower(),
 }
 
 
-def filter_collection(collection, **kwargs):
-    if not kwargs:
-        return list(collection.resources)
-    exclude = kwargs.pop('_exclude', False)
-    result = []
-    for resource in collection.resources:
-        for key, value in kwargs.iteritems():
-            include = False
-            attrs = key.split('__')
-            try:
-                lookup = LOOKUPS[attrs[-1]]
-            except KeyError:
-                lookup = LOOKUPS.get('default')
+def prepare_in(value):
+    value = list(value)
+    if all(isinstance(v, (basestring, int, long, float)) for v in value):
+        return frozenset(value)
+    # Resources compare by url
+    return value
+
+
+# filter values are prepared once per filter instead of once per resource
+PREPARE = {
+    'in': prepare_in,
+    'iexact': lambda b: b.lower(),
+    'istartswith': lambda b: b.lower(),
+    'icontains': lambda b: b.lower(),
+}
+
+
+def split_lookup(key):
+    """ 'group__name__icontains' -> ('group__name', 'icontains') """
+    attrs = key.split('__')
+    if len(attrs) > 1 and attrs[-1] in LOOKUPS:
+        return '__'.join(attrs[:-1]), attrs[-1]
+    return key, 'exact'
+
+
+def get_attr(resource, field):
+    """ follows related fields like group__name """
+    current = resource
+    for attr in field.split('__'):
+        current = getattr(current, attr)
+    return current
+
+
+def compile_accessor(field):
+    """ get_attr() of field with the lookup parsed once """
+    return operator.attrgetter(field.replace('__', '.'))
+
+
+class Q(object):
+    """
+    Composable filter for Collection.filter() and friends
+        
+        collection.filter(Q(arch='i686') | ~Q(name__startswith='node1'), group__name='g')
+    
+    Keyword arguments are ANDed, related collections match when any of their
+    resources does. compile() returns a predicate callable that is evaluated
+    without any further lookup parsing.
+    """
+    AND = 'AND'
+    OR = 'OR'
+    
+    def __repr__(self):
+        children = ', '.join(repr(child) for child in self.children)
+        return '<Q: %s%s(%s)>' % ('NOT ' if self.negated else '', self.connector, children)
+    
+    def __init__(self, *args, **kwargs):
+        self.children = list(args) + sorted(kwargs.items())
+        self.connector = self.AND
+        self.negated = False
+    
+    def _combine(self, other, connector):
+        if not isinstance(other, Q):
+            raise TypeError(other)
+        q = Q(self, other)
+        q.connector = connector
+        return q
+    
+    def __and__(self, other):
+        return self._combine(other, self.AND)
+    
+    def __or__(self, other):
+        return self._combine(other, self.OR)
+    
+    def __invert__(self):
+        q = Q(self)
+        q.negated = True
+        return q
+    
+    def get_lookups(self):
+        """ lookup keys of all children """
+        lookups = []
+        for child in self.children:
+            if isinstance(child, Q):
+                lookups += child.get_lookups()
+            else:
+                lookups.append(child[0])
+        return lookups
+    
+    def compile(self):
+        """ predicate(resource) plan of accessor chains and prepared lookups """
+        predicates = []
+        for child in self.children:
+            if isinstance(child, Q):
+                predicates.append(child.compile())
             else:
-                attrs = attrs[:-1]
-            current = resource
-            for attr in attrs:
-                current = getattr(current, attr)
-                if isinstance(current, type(collection)):
-                    # "joining" with currenr Collection
-                    attr = re.findall(r'%s__(.*)$' % attr, key)[0]
-                    partial_kwargs = {
-                        attr: value,
-                        '_exclude': exclude
-                    }
-                    include = bool(filter_collection(current, **partial_kwargs))
-                    break
-            if not isinstance(current, type(collection)):
-                if not exclude and lookup(current, value):
-                    include = True
-                elif exclude and not lookup(current, value):
-                    include = True
-            if not include:
-                break
-        if include:
-            result.append(resource)
-    return result
+                predicates.append(compile_lookup(*child))
+        if not predicates:
+            predicate = lambda resource: True
+        elif len(predicates) == 1:
+            predicate = predicates[0]
+        elif self.connector == self.AND:
+            def predicate(resource):
+                for test in predicates:
+                    if not test(resource):
+                        return False
+                return True
+        else:
+            def predicate(resource):
+                for test in predicates:
+                    if test(resource):
+                        return True
+                return False
+        if self.negated:
+            positive = predicate
+            return lambda resource: not positive(resource)
+        return predicate
 
 
-def retrieve_related(resources, *args, **kwargs):
-    soft = kwargs.get('soft', False)
-    def fetchable(r):
-        return getattr(r, 'uri', None) and not (soft and r._has_retrieved)
-    pool = {}
-    MAX_RECURSION = 10
-    args = list(args)
-    for i in range(0, MAX_RECURSION):
-        if not args:
-            return
-        related = {}
-        # Collect related objects that need to be retrieved
-        for resource in resources:
-            for attr in args:
-                try:
-                    field = attr.split('__')[i]
-                except IndexError:
-                    args.remove(attr)
-                else:
-                    current = getattr(resource, field)
-                    if not hasattr(current, '__iter__'):
-                        if fetchable(current):
-                            related[current.uri] = current
-                    else:
-                        for nested in current:
-                            if fetchable(nested):
-                                related[nested.uri] = nested
-        # Retrieve missing related objects
-        to_fetch = set(related.keys()) - set(pool.keys())
-        for url in to_fetch:
-            related[url].retrieve(async=True)
-            pool[url] = related[url]
-        next = []
-        # Update related objects with retrieved description
+def compile_lookup(key, value, negated=False):
+    """
+    predicate of a single lookup like group__name__icontains='x', negated
+    negates the final test so related collections match when any of their
+    resources does not
+    """
+    from .resources import Collection
+    field, lookup = split_lookup(key)
+    test = LOOKUPS[lookup]
+    value = PREPARE.get(lookup, lambda value: value)(value)
+    def compile_path(attrs):
+        if not attrs:
+            if negated:
+                return lambda current: not test(current, value)
+            return lambda current: test(current, value)
+        attr = attrs[0]
+        follow = compile_path(attrs[1:])
+        if len(attrs) == 1:
+            return lambda current: follow(getattr(current, attr))
+        def predicate(current):
+            current = getattr(current, attr)
+            if isinstance(current, Collection):
+                # "joining" with a related collection
+                for resource in current.resources:
+                    if follow(resource):
+                        return True
+                return False
+            return follow(current)
+        return predicate
+    return compile_path(field.split('__'))
+
+
+def filter_collection(collection, *args, **kwargs):
+    """
+    resources matching Q objects and lookups, _exclude=True drops resources
+    matching any of them (related collections are kept when any of their
+    resources does not match a lookup)
+    """
+    exclude = kwargs.pop('_exclude', False)
+    resources = collection.resources
+    if not exclude:
+        resources, kwargs = lookup_indexes(collection, kwargs)
+    if not args and not kwargs:
+        return list(resources)
+    if not exclude:
+        predicate = Q(*args, **kwargs).compile()
+        return [resource for resource in resources if predicate(resource)]
+    predicates = [(~q).compile() for q in args]
+    predicates += [compile_lookup(key, value, negated=True) for key, value in kwargs.iteritems()]
+    return [
+        resource for resource in resources if all(test(resource) for test in predicates)
+    ]
+
+
+def lookup_indexes(collection, kwargs):
+    """
+    narrows down collection resources using its indexes, returns the
+    candidates in collection order and the lookups not served by an index
+    """
+    positions = None
+    remaining = {}
+    for key, value in kwargs.iteritems():
+        index = collection.get_index(*split_lookup(key))
+        if index is None:
+            remaining[key] = value
+            continue
+        matches = index.lookup(split_lookup(key)[1], value)
+        positions = set(matches) if positions is None else positions.intersection(matches)
+    if positions is None:
+        return collection.resources, kwargs
+    resources = collection.resources
+    return [resources[i] for i in sorted(positions)], remaining
+
+
+def get_manager(api, url):
+    """ api manager of the list endpoint url belongs to, None if not found """
+    managers = [value for value in api.__dict__.values() if isinstance(value, Manager)]
+    if not managers and not api._has_retrieved:
+        api.retrieve()
+        return get_manager(api, url)
+    managers = [manager for manager in managers if url.startswith(manager.endpoint)]
+    if managers:
+        return max(managers, key=lambda manager: len(manager.endpoint))
+
+
+def chunk_ids(endpoint, ids, max_url_length=MAX_URL_LENGTH):
+    """ splits ids into chunks whose id__in list query fits max_url_length """
+    chunks = []
+    base_length = len(endpoint) + len('?id__in=')
+    length = base_length
+    chunk = []
+    for pk in ids:
+        # comma separators are sent percent encoded
+        size = len(str(pk)) + 3
+        if chunk and length + size > max_url_length:
+            chunks.append(chunk)
+            chunk = []
+            length = base_length
+        chunk.append(pk)
+        length += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def plan_fetches(api, resources, max_url_length=MAX_URL_LENGTH):
+    """
+    groups resources into fetch jobs: one id__in list query per endpoint chunk
+    when the endpoint can batch (see QuerySet.register), one GET otherwise
+    """
+    from .queries import QuerySet
+    batches = {}
+    jobs = []
+    for resource in resources:
+        endpoint, pk = resource.url.rstrip('/').rsplit('/', 1)
+        manager = get_manager(api, endpoint + '/') if pk.isdigit() else None
+        if manager is None or not QuerySet(manager).get_capabilities().get_param('id__in'):
+            jobs.append((None, None, [resource]))
+        else:
+            batches.setdefault(manager, {}).setdefault(int(pk), []).append(resource)
+    for manager, by_pk in batches.iteritems():
+        for chunk in chunk_ids(manager.endpoint, sorted(by_pk), max_url_length):
+            resources = [resource for pk in chunk for resource in by_pk[pk]]
+            jobs.append((manager, chunk, resources))
+    return jobs
+
+
+def fetch(job):
+    """
+    performs a plan_fetches() job, returns its resources; resources missing on
+    batched results are retrieved one by one
+    """
+    from .queries import QuerySet
+    manager, chunk, resources = job
+    if manager is None:
+        resources[0].retrieve()
+        resources[0].api.stats['async'] += 1
+        return resources
+    results = QuerySet(manager).filter(id__in=chunk).iterator()
+    manager.api.stats['batched'] += 1
+    found = {result.url: result for result in results}
+    for resource in resources:
+        current = found.get(resource.url)
+        if current is None:
+            resource.retrieve()
+            continue
+        if current is not resource:
+            resource.merge(current)
+        resource._has_retrieved = True
+    return resources
+
+
+def retrieve_batched(api, resources, max_url_length=MAX_URL_LENGTH):
+    """
+    retrieves resources with one id__in list query per endpoint chunked to
+    max_url_length, per-object GETs are only performed for resources whose
+    endpoint can not batch (see QuerySet.register) or missing on the results
+    """
+    jobs = plan_fetches(api, resources, max_url_length)
+    for job, task in api.engine.run(fetch, jobs):
+        if task.exception is not None:
+            log.error('%s: %s' % (job[2], task.exception))
+
+
+class RelatedWalker(object):
+    """
+    Prefetches related resources walking the relations graph of lookups like
+    slivers__node__group
+    
+    Fetches of the next level are scheduled as soon as their parent arrives
+    instead of waiting for the whole level, every url is fetched once across
+    all levels and paths, and no more than concurrency fetch jobs (engine size
+    by default) are in flight. Fetches are batched like retrieve_batched().
+    """
+    def __init__(self, api, lookups, soft=False, concurrency=None,
+                 max_url_length=MAX_URL_LENGTH):
+        self.api = api
+        self.soft = soft
+        self.concurrency = concurrency or api.engine.size
+        self.max_url_length = max_url_length
+        # lookups tree, i.e. {'slivers': {'node': {'group': {}}}}
+        self.tree = {}
+        for lookup in lookups:
+            node = self.tree
+            for field in lookup.split('__'):
+                node = node.setdefault(field, {})
+        self.queued = []
+        self.waiting = {}
+        self.fetched = {}
+        self.expanded = set()
+    
+    def walk(self, resources):
         for resource in resources:
-            for attr in args:
-                field = attr.split('__')[i]
-                current = getattr(resource, field)
-                if not hasattr(current, '__iter__'):
-                    if fetchable(current):
-                        pool[current.uri].wait_async()
-                        current.merge(pool[current.uri])
-                    next.append(current)
-                else:
-                    for nested in current:
-                        if fetchable(current):
-                            pool[nested.uri].wait_async()
-                            nested.merge(pool[nested.uri])
-                    next += current
-        resources = next
+            self.expand(resource, self.tree)
+        finished = self.api.engine.queue()
+        def run(job):
+            task = Task(self.api.engine.event(), fetch, job)
+            task.run()
+            finished.put((job, task))
+        in_flight = 0
+        while self.queued or in_flight:
+            if self.queued and in_flight < self.concurrency:
+                jobs = plan_fetches(self.api, self.queued, self.max_url_length)
+                self.queued = []
+                while jobs and in_flight < self.concurrency:
+                    self.api.engine.spawn(run, jobs.pop(0))
+                    in_flight += 1
+                # Jobs over budget are planned again with later arrivals
+                self.queued = [resource for job in jobs for resource in job[2]]
+            job, task = finished.get()
+            in_flight -= 1
+            if task.exception is not None:
+                log.error('%s: %s' % (job[2], task.exception))
+            for resource in job[2]:
+                self.fetched[resource.url] = resource
+                for related, tree in self.waiting.pop(resource.url, []):
+                    if related is not resource:
+                        related.merge(resource)
+                    if task.exception is None:
+                        self.expand(related, tree)
+    
+    def expand(self, resource, tree):
+        """ visits the related resources of an available resource """
+        for field, subtree in tree.iteritems():
+            current = getattr(resource, field)
+            if current is None:
+                continue
+            related = current if hasattr(current, '__iter__') else [current]
+            for nested in related:
+                self.visit(nested, subtree)
+    
+    def visit(self, resource, tree):
+        """ expands resource now or once it has been fetched """
+        url = getattr(resource, 'url', None)
+        if not isinstance(url, basestring):
+            return
+        key = (url, id(tree))
+        if key in self.expanded:
+            return
+        self.expanded.add(key)
+        if url in self.fetched or (self.soft and resource._has_retrieved):
+            current = self.fetched.get(url, resource)
+            if current is not resource:
+                resource.merge(current)
+            self.expand(resource, tree)
+        elif url in self.waiting:
+            self.waiting[url].append((resource, tree))
+        else:
+            self.waiting[url] = [(resource, tree)]
+            self.queued.append(resource)
+
+
+def retrieve_related(resources, *args, **kwargs):
+    """
+    prefetches related resources of lookups like slivers__node__group, see
+    RelatedWalker, soft=True skips already retrieved ones
+    """
+    resources = list(resources)
+    if not resources or not args:
+        return
+    api = resources[0].api
+    if api is None:
+        # Unbound resources can not be fetched
+        return
+    walker = RelatedWalker(api, args, **kwargs)
+    walker.walk(resources)
@@ -0,0 +1,138 @@
+import bisect
+
+from .helpers import compile_accessor
+
+
+class Index(object):
+    """
+    Collection field index, maps values to resource positions
+    
+    Indexes are built on a resources list and are maintained while resources
+    are appended through the Collection, they are not aware of attribute
+    changes of already indexed resources (rebuild them with Collection.index())
+    """
+    lookups = ()
+    
+    def __init__(self, field, resources):
+        self.field = field
+        self.accessor = compile_accessor(field)
+        self.resources = resources
+        self.size = 0
+        self.build(resources)
+    
+    def __len__(self):
+        return self.size
+    
+    def is_valid(self, resources):
+        """ the index still describes resources """
+        return self.resources is resources and self.size == len(resources)
+    
+    def build(self, resources):
+        """ indexes the initial resources """
+        for resource in resources:
+            self.add(resource)
+    
+    def add(self, resource):
+        """ indexes resource as the next position """
+        raise NotImplementedError
+    
+    def lookup(self, lookup, value):
+        """ positions of the resources matching field__lookup=value """
+        raise NotImplementedError
+
+
+class HashIndex(Index):
+    """
+    equality and membership index
+    
+    Unsaved resources are not hashed, their hash changes once they get a url,
+    they are kept apart and compared on lookups instead
+    """
+    lookups = ('exact', 'in')
+    
+    def __init__(self, field, resources):
+        self.positions = {}
+        self.unsaved = []
+        super(HashIndex, self).__init__(field, resources)
+    
+    def add(self, resource):
+        key = self.accessor(resource)
+        if is_unsaved(key):
+            self.unsaved.append((key, self.size))
+        else:
+            self.positions.setdefault(key, []).append(self.size)
+        self.size += 1
+    
+    def lookup(self, lookup, value):
+        values = [value] if lookup == 'exact' else set(value)
+        positions = []
+        for key in values:
+            if not is_unsaved(key):
+                positions += self.positions.get(key, ())
+            positions += [position for other, position in self.unsaved if other == key]
+        return positions
+    
+    def groups(self):
+        """ {value: positions} """
+        if not self.unsaved:
+            return self.positions
+        groups = {key: list(positions) for key, positions in self.positions.iteritems()}
+        for key, position in self.unsaved:
+            groups.setdefault(key, []).append(position)
+        for positions in groups.itervalues():
+            positions.sort()
+        return groups
+
+
+def is_unsaved(value):
+    from .resources import Resource
+    return isinstance(value, Resource) and not value.url
+
+
+class SortedIndex(Index):
+    """ equality, membership, range and top-k index """
+    lookups = ('exact', 'in', 'lt', 'lte', 'gt', 'gte')
+    
+    def build(self, resources):
+        # a single stable sort, inserting one by one is quadratic
+        keys = [self.accessor(resource) for resource in resources]
+        self.positions = sorted(xrange(len(keys)), key=keys.__getitem__)
+        self.keys = [keys[i] for i in self.positions]
+        self.size = len(keys)
+    
+    def add(self, resource):
+        key = self.accessor(resource)
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.positions.insert(i, self.size)
+        self.size += 1
+    
+    def lookup(self, lookup, value):
+        keys = self.keys
+        if lookup == 'exact':
+            return self.positions[bisect.bisect_left(keys, value):bisect.bisect_right(keys, value)]
+        elif lookup == 'in':
+            positions = []
+            for key in set(value):
+                positions += self.lookup('exact', key)
+            return positions
+        elif lookup == 'lt':
+            return self.positions[:bisect.bisect_left(keys, value)]
+        elif lookup == 'lte':
+            return self.positions[:bisect.bisect_right(keys, value)]
+        elif lookup == 'gt':
+            return self.positions[bisect.bisect_right(keys, value):]
+        return self.positions[bisect.bisect_left(keys, value):]
+    
+    def top(self, k=None, reverse=False):
+        """ positions of the k smallest (largest with reverse) values in order """
+        if not reverse:
+            return self.positions[:k]
+        # Equal values keep their original order, like a stable reverse sort
+        result = []
+        end = len(self.keys)
+        while end and (k is None or len(result) < k):
+            start = bisect.bisect_left(self.keys, self.keys[end-1], 0, end)
+            result += self.positions[start:end]
+            end = start
+        return result[:k]
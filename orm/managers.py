@@ -17,7 +17,10 @@ class Manager(object):
         """ action resource manager """
         from .resources import Resource
         # TODO move to an Action class, and Register(profiles.NODE)
-        if kwargs:
+        if args and hasattr(args[0], 'fileno'):
+            # file uploads accept a progress callback
+            response = self.api.post(self.endpoint, *args, **kwargs)
+        elif kwargs:
             response = self.api.post(self.endpoint, kwargs)
         else:
             response = self.api.post(self.endpoint, *args)
@@ -25,7 +28,7 @@ class Manager(object):
             status.HTTP_200_OK, status.HTTP_201_CREATED, status.HTTP_202_ACCEPTED
         ]
         self.api.validate_response(response, valid_codes)
-        content = self.api.serialize_response(response.content)
+        content = self.api.response_content(response)
         return Resource(self, _headers=response.headers, **content)
     
     def __getattr__(self, name):
@@ -39,6 +42,32 @@ class Manager(object):
             method = getattr(self.api, name)
         return functools.partial(method, self.endpoint)
     
+    def all(self):
+        """ lazy QuerySet of the endpoint resources """
+        from .queries import QuerySet
+        return QuerySet(self)
+    
+    def filter(self, *args, **kwargs):
+        return self.all().filter(*args, **kwargs)
+    
+    def exclude(self, *args, **kwargs):
+        return self.all().exclude(*args, **kwargs)
+    
+    def order_by(self, *fields):
+        return self.all().order_by(*fields)
+    
+    def only(self, *fields):
+        return self.all().only(*fields)
+    
+    def defer(self, *fields):
+        return self.all().defer(*fields)
+    
+    def aggregate(self, *args, **kwargs):
+        return self.all().aggregate(*args, **kwargs)
+    
+    def annotate(self, field, *args, **kwargs):
+        return self.all().annotate(field, *args, **kwargs)
+    
     @classmethod
     def register(cls, relation):
         """ register decorator @Manager.register(rel.SERVER_USERS) """
@@ -0,0 +1,376 @@
+import urllib
+from copy import copy
+from itertools import islice
+
+from . import aggregates, helpers, exceptions, status
+from .resources import Resource, Collection, CollectionStream
+
+
+def project(obj, only=None, defer=()):
+    """ drops unused fields before any nested structure is built """
+    if only is not None:
+        return {name: value for name, value in obj.iteritems() if name in only}
+    if defer:
+        return {name: value for name, value in obj.iteritems() if name not in defer}
+    return obj
+
+
+def get_param_value(value):
+    """
+    query parameter value of a filter value, resources are sent as their id
+    (url otherwise), None when the value can only be checked on the client
+    """
+    if isinstance(value, Resource):
+        data = value._data
+        value = data.get('id', data.get('url'))
+    elif isinstance(value, (list, tuple, set)):
+        values = [get_param_value(v) for v in value]
+        return None if None in values else ','.join(values)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (str, int, long, float)):
+        return str(value)
+    return None
+
+
+class Capabilities(object):
+    """
+    Server side querying supported by a list endpoint
+     
+     - lookups that can be filtered remotely, exact means field=value
+     - fields that accept them (including joins like group__name), None means any
+     - ordering, limit and offset query parameter names, None when unsupported
+     - only and defer query parameter names for sparse fieldsets, i.e. 'fields'
+       and 'omit', None when unsupported
+     - aggregate and group_by query parameter names of an aggregate endpoint,
+       ?aggregate=load__sum,count&group_by=arch answers {'load__sum': , 'count': }
+       or a list of them including the arch value when grouping
+     - recheck, pushed filters are also applied on the client, for servers
+       that may ignore unknown query parameters
+    """
+    def __init__(self, lookups=('exact',), fields=None, ordering=None, limit=None,
+                 offset=None, only=None, defer=None, aggregate=None, group_by=None,
+                 recheck=False):
+        self.lookups = lookups
+        self.fields = fields
+        self.ordering = ordering
+        self.limit = limit
+        self.offset = offset
+        self.only = only
+        self.defer = defer
+        self.aggregate = aggregate
+        self.group_by = group_by
+        self.recheck = recheck
+    
+    def get_param(self, key):
+        """ query parameter name for a filter key, None if it can not be pushed """
+        field, lookup = helpers.split_lookup(key)
+        if lookup not in self.lookups:
+            return None
+        if self.fields is None:
+            if '__' in field:
+                return None
+        elif field not in self.fields:
+            return None
+        return field if lookup == 'exact' else '%s__%s' % (field, lookup)
+    
+    def has_fields(self, fields):
+        if self.fields is None:
+            return not any('__' in field for field in fields)
+        return all(field in self.fields for field in fields)
+    
+    def can_order(self, fields):
+        if not self.ordering:
+            return False
+        return self.has_fields([field.lstrip('-') for field in fields])
+    
+    def can_aggregate(self, aggregation):
+        if not self.aggregate or (aggregation.group_by and not self.group_by):
+            return False
+        fields = [aggregate.field for aggregate in aggregation.aggregates if aggregate.field]
+        if aggregation.group_by:
+            fields.append(aggregation.group_by)
+        return self.has_fields(fields)
+
+
+class QuerySet(object):
+    """
+    Lazy collection query, no request is performed until it is evaluated
+        
+        api.nodes.all().filter(arch='x86_64').exclude(name='node1').order_by('-id')[:10]
+    
+    Filters, ordering, slices and field projections are sent as query parameters
+    when the endpoint capabilities allow it, see QuerySet.register(), and applied
+    on the client otherwise. Evaluated querysets proxy Collection methods.
+    """
+    registry = {}
+    # Unregistered endpoints may ignore the exact lookups sent to them
+    default_capabilities = Capabilities(recheck=True)
+    
+    def __repr__(self):
+        return "<QuerySet: %s>" % self.get_url()
+    
+    def __init__(self, manager):
+        self.manager = manager
+        self.api = manager.api
+        self.filters = []
+        self.ordering = []
+        self.low = 0
+        self.high = None
+        self.only_fields = None
+        self.deferred = ()
+        self._result = None
+    
+    def __iter__(self):
+        return iter(self.collection)
+    
+    def __len__(self):
+        return len(self.collection)
+    
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            if k.step is not None:
+                raise ValueError('slice steps are not supported')
+            start, stop = k.start, k.stop
+        else:
+            start, stop = k, k + 1
+        if (start is not None and start < 0) or (stop is not None and stop < 0):
+            raise ValueError('negative indexing is not supported')
+        if self._result is not None:
+            return self._result[k]
+        new = self._clone()
+        if stop is not None:
+            new.high = min(new.high, new.low + stop) if new.high is not None else new.low + stop
+        if start is not None:
+            new.low = min(new.low + start, new.high) if new.high is not None else new.low + start
+        if isinstance(k, slice):
+            return new
+        return list(new)[0]
+    
+    def __getattr__(self, name):
+        """ proxies evaluated collection methods """
+        if name.startswith('_'):
+            raise AttributeError("'QuerySet' object has no attribute '%s'" % name)
+        return getattr(self.collection, name)
+    
+    @classmethod
+    def register(cls, relation, **capabilities):
+        """ declares server side querying support, i.e. register('node-list', ordering='ordering') """
+        cls.registry[relation] = Capabilities(**capabilities)
+    
+    @classmethod
+    def unregister(cls, relation):
+        cls.registry.pop(relation, None)
+    
+    def get_capabilities(self):
+        return type(self).registry.get(self.manager.relation, self.default_capabilities)
+    
+    def _clone(self):
+        new = copy(self)
+        new.filters = list(self.filters)
+        new.ordering = list(self.ordering)
+        new._result = None
+        return new
+    
+    def all(self):
+        return self._clone()
+    
+    def filter(self, *args, **kwargs):
+        """ keyword lookups can be pushed to the server, Q objects are applied on the client """
+        new = self._clone()
+        new.filters += [(q, False) for q in args]
+        if kwargs:
+            new.filters.append((kwargs, False))
+        return new
+    
+    def exclude(self, *args, **kwargs):
+        new = self._clone()
+        new.filters += [(q, True) for q in args]
+        if kwargs:
+            new.filters.append((kwargs, True))
+        return new
+    
+    def order_by(self, *fields):
+        new = self._clone()
+        new.ordering = list(fields)
+        return new
+    
+    def only(self, *fields):
+        """ resources are built with these fields only, the rest are loaded on access """
+        new = self._clone()
+        new.only_fields = tuple(field.split('__')[0] for field in fields)
+        return new
+    
+    def defer(self, *fields):
+        """ resources are built without these fields, they are loaded on access """
+        new = self._clone()
+        new.deferred = new.deferred + tuple(field.split('__')[0] for field in fields)
+        return new
+    
+    def get(self, *args, **kwargs):
+        resources = list(self.filter(*args, **kwargs)[:2])
+        if not resources:
+            raise exceptions.DoesNotExist(
+                'Resource with "%s" do not exists on "%s"' % (kwargs, self.manager.relation)
+            )
+        elif len(resources) > 1:
+            raise exceptions.MultipleObjects(
+                'More than one resource returned with "%s" on "%s"' % (kwargs, self.manager.relation)
+            )
+        return resources[0]
+    
+    def compile(self):
+        """
+        splits the query into server query parameters and the remaining client
+        side work, returns (params, filters, ordering, (low, high))
+        """
+        capabilities = self.get_capabilities()
+        params = {}
+        filters = []
+        for kwargs, exclude in self.filters:
+            if isinstance(kwargs, helpers.Q):
+                filters.append((kwargs, exclude))
+                continue
+            remaining = {}
+            for key, value in kwargs.iteritems():
+                param = None if exclude else capabilities.get_param(key)
+                param_value = None if param is None else get_param_value(value)
+                if param_value is None or param in params:
+                    remaining[key] = value
+                else:
+                    params[param] = param_value
+                    if capabilities.recheck:
+                        remaining[key] = value
+            if remaining:
+                filters.append((remaining, exclude))
+        ordering = self.ordering
+        if ordering and capabilities.can_order(ordering):
+            params[capabilities.ordering] = ','.join(ordering)
+            ordering = []
+        low, high = self.low, self.high
+        if capabilities.limit and not filters and not ordering:
+            if low and capabilities.offset:
+                params[capabilities.offset] = low
+                low, high = 0, (high - low if high is not None else None)
+            if high is not None:
+                params[capabilities.limit] = high
+        only, defer = self.get_projection(filters, ordering)
+        if only is not None and capabilities.only:
+            params[capabilities.only] = ','.join(sorted(only))
+        if defer and capabilities.defer:
+            params[capabilities.defer] = ','.join(sorted(defer))
+        return params, filters, ordering, (low, high)
+    
+    def get_projection(self, filters, ordering):
+        """
+        fields to keep (None for all) and fields to drop from every object,
+        fields needed by the client side filters and ordering are always kept
+        """
+        required = set(['url'])
+        for kwargs, exclude in filters:
+            lookups = kwargs.get_lookups() if isinstance(kwargs, helpers.Q) else kwargs
+            required.update(key.split('__')[0] for key in lookups)
+        required.update(field.lstrip('-').split('__')[0] for field in ordering)
+        only = None
+        if self.only_fields is not None:
+            only = set(self.only_fields) | required
+        return only, set(self.deferred) - required
+    
+    def get_url(self, params=None):
+        """ endpoint url with the server side part of the query """
+        if params is None:
+            params = self.compile()[0]
+        if not params:
+            return self.manager.endpoint
+        return '%s?%s' % (self.manager.endpoint, urllib.urlencode(sorted(params.items())))
+    
+    def iterator(self):
+        """ evaluates the query without caching its results """
+        params, filters, ordering, (low, high) = self.compile()
+        # Following pages are only prefetched when all of them will be needed
+        stream = CollectionStream(self.api, self.get_url(params), prefetch=high is None)
+        resources = self._iter_filtered(stream, filters, ordering)
+        if ordering:
+            resources = list(resources)
+            for field in reversed(ordering):
+                key = lambda resource: helpers.get_attr(resource, field.lstrip('-'))
+                resources.sort(key=key, reverse=field.startswith('-'))
+        return islice(resources, low, high)
+    
+    def _iter_filtered(self, stream, filters, ordering):
+        """ applies the projection and client side filters page by page """
+        only, defer = self.get_projection(filters, ordering)
+        collection = Collection([], api=self.api, url=self.manager.endpoint)
+        for content in stream.iter_pages():
+            page = copy(collection)
+            page.resources = [
+                Resource.build(self.api, **project(obj, only, defer)) for obj in content
+            ]
+            for q, exclude in filters:
+                args, kwargs = ((q,), {}) if isinstance(q, helpers.Q) else ((), q)
+                if exclude:
+                    page = page.exclude(*args, **kwargs)
+                else:
+                    page = page.filter(*args, **kwargs)
+            for resource in page.resources:
+                yield resource
+    
+    @property
+    def collection(self):
+        """ evaluated Collection, cached """
+        if self._result is None:
+            collection = Collection([], api=self.api, url=self.manager.endpoint)
+            collection.resources = list(self.iterator())
+            self._result = collection
+        return self._result
+    
+    def aggregate(self, *args, **kwargs):
+        """
+        {alias: value} of aggregates.Count, Sum, Min, Max and Avg, computed by
+        the server when it has an aggregate endpoint, streamed otherwise
+        """
+        return self._aggregate(aggregates.Aggregation(*args, **kwargs))
+    
+    def annotate(self, field, *args, **kwargs):
+        """ aggregates per value of field, {value: {alias: value}} """
+        kwargs['_group_by'] = field
+        return self._aggregate(aggregates.Aggregation(*args, **kwargs))
+    
+    def _aggregate(self, aggregation):
+        # ordering is irrelevant, it would only keep resources in memory
+        qs = self.order_by()
+        params, filters, ordering, (low, high) = qs.compile()
+        capabilities = self.get_capabilities()
+        if not filters and not low and high is None and capabilities.can_aggregate(aggregation):
+            params[capabilities.aggregate] = ','.join(aggregation.get_params())
+            if aggregation.group_by:
+                params[capabilities.group_by] = aggregation.group_by
+            response = self.api.get(qs.get_url(params))
+            self.api.validate_response(response, [status.HTTP_200_OK])
+            content = self.api.response_content(response)
+            return aggregation.from_server(content)
+        aggregation.feed(qs.iterator())
+        return aggregation.result()
+    
+    def values_list(self, value):
+        """
+        values of a field, only the needed fields are requested and no resource
+        is built for plain values
+        """
+        qs = self.only(value)
+        params, filters, ordering, (low, high) = qs.compile()
+        if '__' in value or filters or ordering:
+            return qs.collection.values_list(value)
+        stream = CollectionStream(self.api, qs.get_url(params), prefetch=high is None)
+        objs = islice((obj for content in stream.iter_pages() for obj in content), low, high)
+        values = []
+        for obj in objs:
+            current = obj.get(value)
+            if value not in obj or isinstance(current, (dict, list)):
+                # Nested structures and missing fields go through Resource
+                obj = project(obj, set(qs.only_fields) | set(['url']))
+                current = getattr(Resource.build(self.api, **obj), value)
+            values.append(current)
+        collection = Collection([], api=self.api, url=self.manager.endpoint)
+        collection.resources = values
+        return collection
@@ -1,14 +1,16 @@
 import json
 import logging
 import re
+import weakref
 from copy import copy
 
-import gevent
-
-from . import helpers, exceptions, relations as rel
+from . import aggregates, helpers, exceptions, relations as rel
+from .columns import ColumnarCollection
+from .engines import SerialEngine
 from .files import FileHandler
+from .indexes import HashIndex, SortedIndex
 from .managers import Manager
-from .utils import DisabledStderr
+from .transfers import Transfers
 
 
 #logging.basicConfig()
@@ -53,10 +55,13 @@ class Resource(object):
 #                        value = [ Resource(*args, url=url) for url in value ]
                     # [{'url': 'http://example.com/resources/1'}]
                     if value and isinstance(value[0], dict) and 'url' in value[0]:
-                        value = [ Resource(*args, **r) for r in value ]
+                        value = [ Resource.build(self.api, **r) for r in value ]
                     value = RelatedCollection(value, parent=self, related_name=name)
 #                elif isinstance(value, dict):
 #                    value = Resource(*args, **value)
+                elif isinstance(value, dict) and 'url' in value:
+                    # {'url': 'http://example.com/resources/1'}
+                    value = Resource.build(self.api, **value)
                 setattr(self, name, value)
                     # TODO remove forever
 #                .__dict__[name] = value
@@ -79,22 +84,53 @@ class Resource(object):
             return False
         return self._data == other._data
     
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        """
+        consistent with __eq__: resources are identified by url, unsaved ones
+        compare by content and only their manager is hashed
+        """
+        return hash(self.url) if self.url else hash(self.manager)
+    
     def _set_file_handlers(self):
         """ adds a file handler for related resource files """
         data = self._data
         for name, value in data.iteritems():
-            if name.endswith('_url'):
-                field_name = name.replace('_url', '')
+            if name.endswith('_uri'):
+                field_name = name[:-len('_uri')]
                 sha256_field_name = '%s_sha256' % field_name
                 if sha256_field_name in data:
                     setattr(self, field_name, FileHandler(self, field_name))
                     self._serialize_ignores.append(field_name)
     
+    @classmethod
+    def build(cls, api, **kwargs):
+        """
+        constructor honouring the api identity map: there is only one live
+        resource per url, new representations are merged into it
+        """
+        identity_map = api.__dict__.get('identity_map') if api is not None else None
+        url = kwargs.get('url')
+        if identity_map is None or url is None:
+            return cls(api, **kwargs)
+        resource = cls(api, **kwargs)
+        with api._identity_lock:
+            current = identity_map.get(url)
+            if current is None:
+                identity_map[url] = resource
+                return resource
+        current.merge(resource)
+        if resource._headers:
+            current.process_links()
+        return current
+    
     @classmethod
     def from_response(cls, api, response):
         """ constructor method accepting a response object """
-        content = api.serialize_response(response.content)
-        resource = cls(api, _headers=response.headers, **content)
+        content = api.response_content(response)
+        resource = cls.build(api, _headers=response.headers, **content)
         return resource
     
     @property
@@ -145,28 +181,36 @@ class Resource(object):
             return name
         raise ValueError("don't know the name")
     
-    def save(self):
+    def save(self, async=False):
         """ saves object on remote and update field values from response """
-        if self.url:
-            self.validate_binding()
-            resource = self.api.update(self.url, self.serialize())
-        else:
-            self.validate_binding()
-            resource = self.manager.create(self.serialize())
-        self.merge(resource)
+        self.validate_binding()
+        def do_save():
+            if self.url:
+                resource = self.api.update(self.url, self.serialize())
+            else:
+                resource = self.manager.create(self.serialize())
+            self.merge(resource)
+        
+        if async:
+            return self._spawn(do_save)
+        do_save()
     
     def merge(self, resource):
         """  merges input resource attributes to current resource """
         for key, value in resource._data.iteritems():
+            if isinstance(value, RelatedCollection):
+                value.parent = self
             setattr(self, key, value)
         self._set_file_handlers()
         self._headers.update(resource._headers)
         if not self._has_retrieved:
             self._has_retrieved = resource._has_retrieved
     
-    def delete(self):
+    def delete(self, async=False):
         """ deletes remote object """
         self.validate_binding(url=True)
+        if async:
+            return self._spawn(self.api.destroy, self.url)
         self.api.destroy(self.url)
     
     # TODO replace by save(update_field=[])
@@ -176,11 +220,20 @@ class Resource(object):
         resource = self.api.partial_update(self.url, kwargs)
         self.merge(resource)
     
+    def _spawn(self, func, *args, **kwargs):
+        """ runs func on the api engine, wait_async() collects the outcome """
+        self._task = self.api.engine.spawn(func, *args, **kwargs)
+        self.api.stats['async'] += 1
+        return self._task
+    
     def wait_async(self):
-        with DisabledStderr():
-            self._glet.get()
-        if self._glet._exception:
-            log.error(glet._exception)
+        """ waits for a pending async operation, returns its exception if any """
+        task = self.__dict__.pop('_task', None)
+        if task is not None:
+            task.wait()
+            if task.exception is not None:
+                log.error('%s: %s' % (repr(self), task.exception))
+            return task.exception
     
     def retrieve(self, conditional=True, async=False):
         """ retrieves remote state of this object """
@@ -197,11 +250,9 @@ class Resource(object):
                 self.process_links()
             self._has_retrieved = True
         
-        if async and False: # TODO gevent option
-            self._glet = gevent.spawn(do_retrieve, conditional, async)
-            self.api.stats['async'] += 1
-        else:
-            do_retrieve(conditional, async)
+        if async:
+            return self._spawn(do_retrieve, conditional, async)
+        do_retrieve(conditional, async)
     
     def serialize(self, isnested=False):
         """ serializes object for storing in remote server """
@@ -293,26 +344,34 @@ class Collection(object):
                 resource.wait_async()
                 yield resource
     
-    def filter(self, **kwargs):
-        """ client-side filtering method """
+    def as_completed(self):
+        """ retrieves resources concurrently, yielding them as soon as they arrive """
+        engine = self.api.engine
+        for resource, task in engine.as_completed(lambda r: r.retrieve(), self.resources):
+            self.api.stats['async'] += 1
+            if task.exception is not None:
+                log.error('%s: %s' % (repr(resource), task.exception))
+            yield resource
+    
+    def filter(self, *args, **kwargs):
+        """ client-side filtering method, accepts helpers.Q objects """
         related = []
-        for field in kwargs:
-            relations = field.split('__')
-            if relations[-1] in helpers.LOOKUPS:
-                relations = relations[:-1]
-            if len(relations) > 1:
-                related.append('__'.join(relations))
-        self.retrieve_related(*related, soft=True)
+        for key in helpers.Q(*args, **kwargs).get_lookups():
+            field, lookup = helpers.split_lookup(key)
+            if '__' in field:
+                related.append(field.rsplit('__', 1)[0])
+        if related:
+            self.retrieve_related(*related, soft=True)
         new = copy(self)
-        new.resources = helpers.filter_collection(self, **kwargs)
+        new.resources = helpers.filter_collection(self, *args, **kwargs)
         return new
     
-    def get(self, **kwargs):
-        resource = helpers.filter_collection(self, **kwargs)
+    def get(self, *args, **kwargs):
+        resource = helpers.filter_collection(self, *args, **kwargs)
         manager = self.manager.relation
         if len(resource) > 1:
-            raise exceptions.DoesNotExist(
-                'More than one resource returned with "%s" on "%s"' % (str(kwargs)), manager
+            raise exceptions.MultipleObjects(
+                'More than one resource returned with "%s" on "%s"' % (str(kwargs), manager)
             )
         elif len(resource) < 1:
             raise exceptions.DoesNotExist(
@@ -320,57 +379,116 @@ class Collection(object):
             )
         return resource[0]
     
-    def exclude(self, **kwargs):
+    def exclude(self, *args, **kwargs):
         kwargs['_exclude'] = True
         new = copy(self)
-        new.resources = helpers.filter_collection(self, **kwargs)
+        new.resources = helpers.filter_collection(self, *args, **kwargs)
         return new
     
     def group_by(self, field):
-        self.retrieve_related(field, soft=True)
+        index = self.get_index(field)
+        if index is not None:
+            resources = self.resources
+            return {
+                key: [resources[i] for i in positions] for key, positions in index.groups().iteritems()
+            }
+        self.retrieve_related(*self._get_related(field), soft=True)
+        accessor = helpers.compile_accessor(field)
         groups = {}
         for resource in self.resources:
-            current = resource
-            for related in field.split('__'):
-                current = getattr(current, related)
-            groups.setdefault(current, [])
-            groups[current].append(resource)
+            groups.setdefault(accessor(resource), []).append(resource)
         return groups
     
-    def order_by(self, filed, reverse=False):
-        self.retrieve_related(field, soft=True)
-        def sort_by(resource):
-            current = resource
-            for related in field.slit('__'):
-                current = getattr(current, related)
-            return current
-        self.resources.sort(key=sort_by)
-        if reverse:
-            self.resources.reverse()
+    def order_by(self, field, reverse=False):
+        index = self.get_index(field, 'lt')
+        if index is not None:
+            self.resources = [self.resources[i] for i in index.top(reverse=reverse)]
+            return
+        self.retrieve_related(*self._get_related(field), soft=True)
+        self.resources = sorted(self.resources, key=helpers.compile_accessor(field),
+                reverse=reverse)
+    
+    def top(self, field, k, reverse=False):
+        """ k resources with the smallest (largest) field values, uses sorted indexes """
+        index = self.get_index(field, 'lt')
+        if index is None:
+            index = SortedIndex(field, self.resources)
+        return [self.resources[i] for i in index.top(k, reverse=reverse)]
+    
+    def _get_related(self, field):
+        if '__' in field:
+            return [field.rsplit('__', 1)[0]]
+        return []
+    
+    def index(self, field, sorted=False):
+        """
+        indexes field values for get, filter, group_by and order_by; hash
+        indexes serve exact and in lookups, sorted ones range lookups as well
+        """
+        self.retrieve_related(*self._get_related(field), soft=True)
+        index = (SortedIndex if sorted else HashIndex)(field, self.resources)
+        # copies of the collection share the original indexes dict
+        self._indexes = dict(self.__dict__.get('_indexes', {}), **{field: index})
+        self._indexes_owner = weakref.ref(self)
+        return index
+    
+    def get_index(self, field, lookup='exact'):
+        """
+        valid index of field supporting lookup, None otherwise; indexes are
+        rebuilt once the resources list is replaced, by order_by() for instance
+        """
+        index = self.__dict__.get('_indexes', {}).get(field)
+        if index is None or lookup not in index.lookups:
+            return None
+        if not index.is_valid(self.resources):
+            if self._indexes_owner() is not self:
+                # copies do not use indexes built on other resources lists
+                return None
+            index = self.index(field, sorted=isinstance(index, SortedIndex))
+        return index
+    
+    def update_indexes(self, resource):
+        """ indexes a just appended resource """
+        for index in self.__dict__.get('_indexes', {}).values():
+            if index.resources is self.resources and index.size == len(self.resources) - 1:
+                index.add(resource)
+    
+    def columnar(self, *fields, **kwargs):
+        """ ColumnarCollection of these resources, backend='list' avoids NumPy """
+        return ColumnarCollection(self, fields, backend=kwargs.get('backend'))
+    
+    def transfers(self, field, concurrency=None, bandwidth=None):
+        """ Transfers of the field FileHandlers, i.e. transfers('image') """
+        handlers = [getattr(resource, field, None) for resource in self.resources]
+        handlers = [handler for handler in handlers if isinstance(handler, FileHandler)]
+        return Transfers(handlers, concurrency=concurrency, bandwidth=bandwidth)
     
     def bulk(self, method, merge=True, async=True):
-        if async and False: # TODO gevent option
-            glets = []
-            for resource in self.resources:
-                glets.append(gevent.spawn(method(resource)))
-            total = len(glets)
-            successes = []
-            failures = []
-            for glet, resource in zip(glets, self.resources):
+        """
+        applies method to every resource using its api engine
+        returns successful resources and (resource, exception) failures
+        """
+        serial = SerialEngine()
+        tasks = []
+        for resource in self.resources:
+            if async:
+                engine = resource.api.engine
                 resource.api.stats['async'] += 1
-                with DisabledStderr():
-                    glet.get()
-                if glet._exception:
-                    log.error(glet._exception)
-                    failures.append(resource)
-                else:
-                    if merge:
-                        resource.merge(glet.value)
-                    successes.append(resource)
-            return successes, failures
-        else:
-            for resource in self.resources:
-                method(resource)
+            else:
+                engine = serial
+            tasks.append((resource, engine.spawn(method, resource)))
+        successes = []
+        failures = []
+        for resource, task in tasks:
+            task.wait()
+            if task.exception is not None:
+                log.error('%s: %s' % (repr(resource), task.exception))
+                failures.append((resource, task.exception))
+            else:
+                if merge and task.value is not None:
+                    resource.merge(task.value)
+                successes.append(resource)
+        return successes, failures
     
     def delete(self):
         return self.bulk(lambda r: r.api.destroy(r.url), merge=False)
@@ -380,7 +498,7 @@ class Collection(object):
     
     def update(self, **kwargs):
         """ performs remote update of all set elements """
-        return self.bulk(lambda r: r.partial_update(r.url, **kwargs))
+        return self.bulk(lambda r: r.api.partial_update(r.url, kwargs))
     
     def retrieve(self, async=True, **kwargs):
         self.resources = [resource for resource in self.iterator(async=async)]
@@ -389,6 +507,14 @@ class Collection(object):
         """ fetches related elements in batch """
         helpers.retrieve_related(self.resources, *args, **kwargs)
     
+    def aggregate(self, *args, **kwargs):
+        """ {alias: value} of aggregates.Count, Sum, Min, Max and Avg in a single pass """
+        return aggregates.aggregate(self.resources, *args, **kwargs)
+    
+    def annotate(self, field, *args, **kwargs):
+        """ aggregates per value of field, {value: {alias: value}} """
+        return aggregates.annotate(self.resources, field, *args, **kwargs)
+    
     def values_list(self, value):
         result = []
         values = value.split('__')
@@ -413,19 +539,81 @@ class Collection(object):
         # TODO consistent model for returning new objects or just perform operation
         new = copy(self)
         new.resources = list()
-        map(lambda x: not x in new.resources and new.resources.append(x), self.resources)
+        seen = set()
+        for resource in self.resources:
+            try:
+                if resource in seen:
+                    continue
+                seen.add(resource)
+            except TypeError:
+                # unhashable values
+                if resource in new.resources:
+                    continue
+            new.resources.append(resource)
         return new
     
     def append(self, resource):
         self.resources.append(resource)
+        self.update_indexes(resource)
     
     def create(self, **kwargs):
         """ create can not be proxied """
         resource = self.manager.create(**kwargs)
-        self.resources.append(resource)
+        self.append(resource)
         return resource
 
 
+class CollectionStream(object):
+    """
+    Lazy collection of a paginated list endpoint
+    
+    Pages are fetched on demand following 'next' links and resources are
+    yielded as soon as they are built, the stream does not hold them so memory
+    is constant regardless of the collection size. With prefetch the next page
+    is retrieved on the api engine while the current one is being consumed.
+    """
+    def __repr__(self):
+        return "<CollectionStream: %s>" % self.url
+    
+    def __init__(self, api, url, prefetch=True, **kwargs):
+        self.api = api
+        self.url = url
+        self.prefetch = prefetch
+        self.kwargs = kwargs
+        self.pages = 0
+    
+    def __iter__(self):
+        return self.iterator()
+    
+    def iter_pages(self):
+        """ yields the raw objects of every page """
+        content, next_url = self.api.retrieve_page(self.url, **self.kwargs)
+        while True:
+            self.pages += 1
+            task = None
+            if next_url and self.prefetch:
+                task = self.api.engine.spawn(self.api.retrieve_page, next_url, **self.kwargs)
+            yield content
+            if not next_url:
+                return
+            if task is not None:
+                content, next_url = task.get()
+            else:
+                content, next_url = self.api.retrieve_page(next_url, **self.kwargs)
+    
+    def iterator(self):
+        for content in self.iter_pages():
+            for obj in content:
+                yield Resource.build(self.api, **obj)
+    
+    def aggregate(self, *args, **kwargs):
+        """ aggregates computed while streaming, no page is kept in memory """
+        return aggregates.aggregate(self.iterator(), *args, **kwargs)
+    
+    def annotate(self, field, *args, **kwargs):
+        return aggregates.annotate(self.iterator(), field, *args, **kwargs)
+
+
 class RelatedCollection(Collection):
     """ represents a subcollection related to a parent object """
     def __init__(self, resources, parent, related_name):
@@ -445,7 +633,7 @@ class RelatedCollection(Collection):
         """ applies related object as attributes of new resource """
         kwargs[self.parent.get_name()] = self.parent
         resource = self.manager.create(**kwargs)
-        self.resources.append(resource)
+        self.append(resource)
         return resource
     
     def retrieve(self):
@@ -459,6 +647,7 @@ class RelatedCollection(Collection):
         if isinstance(resource, Resource):
             setattr(resource, self.parent.get_name(), self.parent)
         self.resources.append(resource)
+        self.update_indexes(resource)
 
 
 class ResourceSet(Collection):
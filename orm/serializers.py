@@ -0,0 +1,254 @@
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+WHITESPACE = ' \t\n\r'
+
+
+class JSONStream(object):
+    """
+    Incremental decoder of a JSON document fed by chunks of bytes
+    
+    Elements of a top level array are decoded and yielded as soon as they are
+    complete, only the undecoded tail of the document is kept in memory, i.e.
+        stream = JSONStream(response.iter_content(64*1024))
+        if stream.is_array:
+            for obj in stream:
+                ...
+        else:
+            obj = stream.value()
+    """
+    def __init__(self, chunks, decoder=None):
+        self.chunks = iter(chunks)
+        self.decoder = decoder or json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.is_array = self._skip() == '['
+    
+    def _read(self):
+        """ appends the next chunk to the buffer, False when exhausted """
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+        return False
+    
+    def _skip(self):
+        """ skips whitespace, returns the next character or '' at the end """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ''
+    
+    def _decode(self):
+        """ decodes the value starting at the current position """
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._read():
+                    raise
+                continue
+            if end == len(self.buffer) and self._read():
+                # Numbers and literals may continue on the next chunk
+                continue
+            self.pos = end
+            return value
+    
+    def __iter__(self):
+        if not self.is_array:
+            raise ValueError('not a JSON array')
+        self.pos += 1
+        if self._skip() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._decode()
+            char = self._skip()
+            self.pos += 1
+            if char == ']':
+                return
+            elif char != ',':
+                raise ValueError("expecting ',' delimiter: %r" % char)
+            self._skip()
+    
+    def value(self):
+        """ decodes the whole (non array) document """
+        content = self.buffer[self.pos:] + ''.join(self.chunks)
+        self.buffer, self.pos = '', 0
+        return self.decoder.decode(content or '{}')
+
+
+def native(obj):
+    """ default() hook of encoders for Resources and Collections """
+    serialize = getattr(obj, 'serialize', None)
+    if serialize is None:
+        raise TypeError('%r is not serializable' % obj)
+    return serialize()
+
+
+class ResourceJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return native(obj)
+
+
+class Codec(object):
+    """ encodes request and decodes response bodies of a given content type """
+    name = None
+    content_type = None
+    content_types = ()
+    
+    @property
+    def headers(self):
+        return {
+            'accept': self.content_type,
+            'content-type': self.content_type,
+        }
+    
+    def encode(self, content):
+        raise NotImplementedError
+    
+    def decode(self, content):
+        raise NotImplementedError
+    
+    def iter_decode(self, chunks):
+        """ iterator of objects for arrays, the decoded object otherwise """
+        content = self.decode(''.join(chunks))
+        return iter(content) if isinstance(content, list) else content
+
+
+class JSONCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+    encoder = ResourceJSONEncoder()
+    
+    def encode(self, content):
+        return self.encoder.encode(content)
+    
+    def decode(self, content):
+        return json.loads(content or '{}')
+    
+    def iter_decode(self, chunks):
+        content = JSONStream(chunks)
+        return iter(content) if content.is_array else content.value()
+
+
+class UJSONCodec(JSONCodec):
+    """
+    JSON codec decoding with ujson, arrays are still decoded incrementally
+    
+    Encoding stays on the stdlib C encoder: ujson has no default() hook and
+    probes unknown objects for toDict(), which triggers a retrieve() of lazy
+    Resources
+    """
+    name = 'ujson'
+    
+    def decode(self, content):
+        return ujson.loads(content or '{}')
+
+
+class MsgPackCodec(Codec):
+    """
+    Compact binary codec, JSON is still accepted for servers without msgpack
+    support
+    """
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    content_types = ('application/x-msgpack',)
+    
+    @property
+    def headers(self):
+        return {
+            'accept': '%s, %s;q=0.5' % (self.content_type, JSONCodec.content_type),
+            'content-type': self.content_type,
+        }
+    
+    def encode(self, content):
+        # py2 str is text like in JSON, packing it as bin would hand peers bytes
+        return msgpack.packb(content, default=native, use_bin_type=False)
+    
+    def decode(self, content):
+        if not content:
+            return {}
+        return msgpack.unpackb(content, raw=False)
+    
+    def iter_decode(self, chunks):
+        chunks = iter(chunks)
+        unpacker = msgpack.Unpacker(raw=False)
+        for chunk in chunks:
+            if chunk:
+                unpacker.feed(chunk)
+                # fixarray, array 16 and array 32 markers
+                if ord(chunk[0]) & 0xf0 == 0x90 or chunk[0] in '\xdc\xdd':
+                    return self._iter_array(unpacker, chunks)
+                break
+        else:
+            return {}
+        for chunk in chunks:
+            unpacker.feed(chunk)
+        return unpacker.unpack()
+    
+    def _iter_array(self, unpacker, chunks):
+        length = self._unpack(unpacker, chunks, unpacker.read_array_header)
+        for __ in xrange(length):
+            yield self._unpack(unpacker, chunks, unpacker.unpack)
+    
+    def _unpack(self, unpacker, chunks, unpack):
+        while True:
+            try:
+                return unpack()
+            except msgpack.OutOfData:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError('truncated msgpack content')
+                unpacker.feed(chunk)
+
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+}
+
+if ujson is not None:
+    CODECS[UJSONCodec.name] = UJSONCodec
+
+if msgpack is not None:
+    CODECS[MsgPackCodec.name] = MsgPackCodec
+
+
+def find_codec(content_type):
+    """
+    codec class for a content type, the fastest one when there are
+    alternatives, None when not supported
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type == JSONCodec.content_type:
+        return CODECS.get(UJSONCodec.name, JSONCodec)
+    for codec in CODECS.itervalues():
+        if content_type == codec.content_type or content_type in codec.content_types:
+            return codec
+
+
+def get_codec(codec):
+    """ codec instance from a Codec, one of the CODECS names or a content type """
+    if isinstance(codec, Codec):
+        return codec
+    try:
+        return CODECS[codec]()
+    except KeyError:
+        codec_class = find_codec(codec)
+        if codec_class is None:
+            raise ValueError("unknown codec '%s', choices are %s" % (codec, CODECS.keys()))
+        return codec_class()
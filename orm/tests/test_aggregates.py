@@ -0,0 +1,48 @@
+import unittest
+
+from orm.aggregates import Aggregation, Avg, Count, Max, Min, Sum
+from orm.resources import Resource
+from orm.tests.test_columns import Nodes
+
+
+class AggregateTests(unittest.TestCase):
+    def setUp(self):
+        url = 'http://example.com/api/%s/%d/'
+        self.nodes = Nodes([
+            Resource(None, url=url % ('nodes', i), id=i, arch=('i686', 'x86_64')[i % 2],
+                     load=None if i == 3 else i / 2.0, slivers=[
+                        {'url': url % ('slivers', i*10 + j), 'cpus': j} for j in range(i % 3)
+                     ]) for i in range(6)
+        ])
+        for node in self.nodes:
+            for sliver in node.slivers:
+                sliver._has_retrieved = True
+    
+    def test_aggregate(self):
+        result = self.nodes.aggregate(Count(), Count('load'), Sum('load'), Avg('load'),
+                Min('load'), top=Max('load'))
+        self.assertEqual({
+            'count': 6, 'load__count': 5, 'load__sum': 6.0, 'load__avg': 1.2, 'load__min': 0.0,
+            'top': 2.5
+        }, result)
+        self.assertEqual({'count': 0, 'load__sum': None, 'load__avg': None},
+                Nodes([]).aggregate(Count(), Sum('load'), Avg('load')))
+        self.assertRaises(ValueError, self.nodes.aggregate, Sum('load'), load__sum=Max('id'))
+    
+    def test_related_collections(self):
+        result = self.nodes.aggregate(Count('slivers'), Max('slivers__cpus'))
+        self.assertEqual({'slivers__count': 6, 'slivers__cpus__max': 1}, result)
+    
+    def test_annotate(self):
+        self.assertEqual({
+            'i686': {'count': 3, 'load__max': 2.0, 'slivers__cpus__sum': 1},
+            'x86_64': {'count': 3, 'load__max': 2.5, 'slivers__cpus__sum': 1},
+        }, self.nodes.annotate('arch', Count(), Max('load'), Sum('slivers__cpus')))
+    
+    def test_feed(self):
+        aggregation = Aggregation(Count(), Sum('id'))
+        for resources in (self.nodes[:2], iter(self.nodes[2:])):
+            aggregation.feed(resources)
+        self.assertEqual({'count': 6, 'id__sum': 15}, aggregation.result())
+        content = {'count': 6, 'id__sum': 15}
+        self.assertEqual({'count': 6, 'id__sum': 15}, aggregation.from_server(content))
@@ -1,9 +1,14 @@
+import json
 import os
+import time
 import unittest
 
-from orm.api import Api
+from orm.api import Api, AsyncApi
+from orm.engines import ThreadEngine
+from orm.managers import Manager
+from orm.transports import SessionTransport
 
-from .utils import random_ascii
+from .utils import RangeServer, random_ascii
 
 
 class ApiTests(unittest.TestCase):
@@ -81,3 +86,140 @@ class ApiTests(unittest.TestCase):
         self.assertEqual(len(nodes), api.stats['conditional'])
         self.assertEqual((2*len(nodes))+1, api.cache.hits)
         self.assertEqual((2*len(nodes))+2, api.cache.misses)
+    
+    def test_pooled_transport(self):
+        self.api.retrieve()
+        self.api.nodes.retrieve()
+        self.assertEqual(1, self.api.stats['pool_hosts'])
+        self.assertLess(0, self.api.stats['pool_reused'])
+        self.api.close()
+    
+    def test_stream(self):
+        nodes = self.api.nodes.retrieve()
+        stream = self.api.nodes.stream()
+        self.assertEqual([node.url for node in nodes], [node.url for node in stream])
+        self.assertLessEqual(1, stream.pages)
+
+
+class AsyncApiTests(unittest.TestCase):
+    def setUp(self):
+        self.api = AsyncApi(os.environ['CONFINE_SERVER_API'])
+    
+    def test_retrieve(self):
+        task = self.api.nodes.retrieve()
+        nodes = task.get()
+        self.assertEqual(1, self.api.stats['async'])
+        retrieved = [node for node in nodes.as_completed()]
+        self.assertEqual(len(nodes), len(retrieved))
+        self.assertEqual(len(nodes)+1, self.api.stats['async'])
+    
+    def test_errors(self):
+        task = self.api.retrieve(self.api.url + 'rata/')
+        task.wait()
+        self.assertIsInstance(task.exception, Api.ResponseStatusError)
+        self.assertRaises(Api.ResponseStatusError, task.get)
+
+
+class LocalApiTests(unittest.TestCase):
+    """ Api against a local server """
+    def setUp(self):
+        self.server = RangeServer('')
+        self.addCleanup(self.server.shutdown)
+        self.api = self.get_api()
+    
+    def get_api(self, **kwargs):
+        api = Api(self.server.url, engine=ThreadEngine(size=2), **kwargs)
+        self.addCleanup(api.close)
+        api._has_retrieved = True
+        api.nodes = Manager(self.server.url + 'nodes/', 'node-list', api)
+        return api
+    
+    def serve(self, path, content, **headers):
+        self.server.pages['/' + path] = (json.dumps(content), headers)
+    
+    def node(self, i, **fields):
+        return dict(url=self.server.url + 'nodes/%d/' % i, id=i, **fields)
+    
+    def wait_paths(self, count, timeout=2):
+        start = time.time()
+        while len(self.server.paths) < count and time.time() - start < timeout:
+            time.sleep(0.01)
+        return self.server.paths
+    
+    def test_cache(self):
+        api = self.get_api(cache=True, cache_ttl={'nodes': 60})
+        # fresh for the client side nodes ttl
+        self.serve('nodes/1/', self.node(1, name='node1'), etag='"1"')
+        self.serve('nodes/2/', self.node(2, name='node2'), etag='"2"',
+                **{'cache-control': 'max-age=0, stale-while-revalidate=60'})
+        self.serve('nodes/3/', self.node(3, name='node3'), etag='"3"',
+                **{'cache-control': 'max-age=0'})
+        for i in range(2):
+            self.assertEqual('node1', api.retrieve(self.server.url + 'nodes/1/').name)
+        self.assertEqual(['/nodes/1/'], self.server.paths)
+        self.assertEqual(1, api.cache.hits)
+        # stale entries are served while revalidated on the background
+        for i in range(2):
+            self.assertEqual('node2', api.retrieve(self.server.url + 'nodes/2/').name)
+        self.assertEqual(1, api.stats['stale'])
+        self.assertEqual(['/nodes/2/'] * 2, self.wait_paths(3)[1:])
+        response = api.last_response
+        start = time.time()
+        while response.revalidating and time.time() - start < 2:
+            time.sleep(0.01)
+        self.assertFalse(response.revalidating)
+        self.assertTrue(response.is_valid)
+        # stale entries without stale-while-revalidate are revalidated first
+        self.assertEqual('node3', api.retrieve(self.server.url + 'nodes/3/').name)
+        response = api.last_response
+        self.assertEqual('node3', api.retrieve(self.server.url + 'nodes/3/').name)
+        # 304 Not Modified, the cached response is kept
+        self.assertIs(response, api.last_response)
+        self.assertEqual(['/nodes/3/'] * 2, self.server.paths[3:])
+        self.assertEqual(1, api.stats['conditional'])
+        self.serve('nodes/3/', self.node(3, name='renamed'), etag='"4"')
+        self.assertEqual('renamed', api.retrieve(self.server.url + 'nodes/3/').name)
+        self.assertEqual(6, len(self.server.paths))
+        self.assertEqual(2, api.stats['conditional'])
+        self.assertEqual('renamed', api.retrieve(self.server.url + 'nodes/3/').name)
+        self.assertEqual(6, len(self.server.paths))
+    
+    def test_pooled_transport(self):
+        self.serve('nodes/1/', self.node(1))
+        prefix = self.server.url[len('http://'):]
+        api = self.get_api(transport=SessionTransport(host_pool_sizes={prefix: 2}))
+        for i in range(3):
+            api.retrieve(self.server.url + 'nodes/1/')
+        # a single keep-alive connection
+        self.assertEqual(1, api.stats['pool_hosts'])
+        self.assertEqual(1, api.stats['pool_connections'])
+        self.assertEqual(3, api.stats['pool_requests'])
+        self.assertEqual(2, api.stats['pool_reused'])
+        adapter = api.transport.session.get_adapter(self.server.url)
+        self.assertEqual(2, adapter._pool_maxsize)
+        api.transport.close()
+        self.assertEqual(0, api.transport.get_stats()['pool_hosts'])
+    
+    def test_stream(self):
+        url = self.server.url + 'nodes/?page=%d'
+        self.serve('nodes/', [self.node(0), self.node(1)], link='<%s>; rel="next"' % url % 2)
+        self.serve('nodes/?page=2', {'next': url % 3, 'results': [self.node(2), self.node(3)]})
+        self.serve('nodes/?page=3', [self.node(4)])
+        paths = ['/nodes/', '/nodes/?page=2', '/nodes/?page=3']
+        stream = self.api.nodes.stream(prefetch=False)
+        resources = iter(stream)
+        self.assertEqual(0, next(resources).id)
+        self.assertEqual(paths[:1], self.wait_paths(2, timeout=0.2))
+        self.assertEqual(range(1, 5), [node.id for node in resources])
+        self.assertEqual(3, stream.pages)
+        # Link header, then {'next': , 'results': } body, up to the last page
+        self.assertEqual(paths, self.server.paths)
+        del self.server.paths[:]
+        stream = self.api.nodes.stream()
+        resources = iter(stream)
+        self.assertEqual(0, next(resources).id)
+        # the next page is requested while the current one is consumed
+        self.assertEqual(paths[:2], self.wait_paths(2))
+        self.assertEqual(1, stream.pages)
+        self.assertEqual(range(1, 5), [node.id for node in resources])
+        self.assertEqual(paths, self.server.paths)
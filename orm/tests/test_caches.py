@@ -0,0 +1,244 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import requests
+
+from orm.api import Api
+from orm.caches import ResponseCache, SQLiteCache, find_urls, freshness
+from orm.engines import ThreadEngine
+from orm.managers import Manager
+
+from .utils import RangeServer
+
+
+class FakeResponse(object):
+    def __init__(self, content, **headers):
+        self.content = content
+        self.headers = headers
+
+
+def request(url, **headers):
+    return ((url,), {'headers': headers})
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def test_get(self):
+        cache = ResponseCache()
+        self.assertRaises(KeyError, cache.get, *request('http://a/'))
+        cache.put(request('http://a/'), FakeResponse('a'))
+        self.assertEqual('a', cache.get(*request('http://a/')).content)
+        self.assertRaises(KeyError, cache.get, *request('http://a/', authorization='Token 1'))
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(2, cache.misses)
+    
+    def test_key_ignores_conditional_headers(self):
+        cache = ResponseCache()
+        cache.put(request('http://a/'), FakeResponse('a'))
+        response = cache.get(*request('http://a/', **{'If-None-Match': '"1"'}))
+        self.assertEqual(1, response.accesses)
+    
+    def test_max_entries_lru(self):
+        cache = ResponseCache(max_entries=2)
+        cache.put(request('http://a/'), FakeResponse('a'))
+        cache.put(request('http://b/'), FakeResponse('b'))
+        cache.get(*request('http://a/'))
+        cache.put(request('http://c/'), FakeResponse('c'))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertRaises(KeyError, cache.get, *request('http://b/'))
+        cache.get(*request('http://a/'))
+    
+    def test_max_entries_lfu(self):
+        cache = ResponseCache(max_entries=2, policy='lfu')
+        cache.put(request('http://a/'), FakeResponse('a'))
+        cache.put(request('http://b/'), FakeResponse('b'))
+        cache.get(*request('http://a/'))
+        cache.get(*request('http://a/'))
+        cache.get(*request('http://b/'))
+        cache.put(request('http://c/'), FakeResponse('c'))
+        cache.put(request('http://d/'), FakeResponse('d'))
+        self.assertRaises(KeyError, cache.get, *request('http://c/'))
+        self.assertEqual('a', cache.get(*request('http://a/')).content)
+        self.assertEqual('d', cache.get(*request('http://d/')).content)
+    
+    def test_max_bytes(self):
+        cache = ResponseCache(max_entries=None, max_bytes=10)
+        cache.put(request('http://a/'), FakeResponse('a'*6))
+        cache.put(request('http://b/'), FakeResponse('b'*6))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(6, cache.size)
+        cache.remove('http://b/')
+        self.assertEqual(0, cache.size)
+    
+    def test_invalidate(self):
+        cache = ResponseCache()
+        cache.put(request('http://a/'), FakeResponse('a'))
+        cache.put(request('http://a/', authorization='Token 1'), FakeResponse('a'))
+        cache.put(request('http://b/'), FakeResponse('b'))
+        cache.invalidate('http://a/')
+        self.assertFalse(cache.get(*request('http://a/')).is_valid)
+        self.assertFalse(cache.get(*request('http://a/', authorization='Token 1')).is_valid)
+        self.assertTrue(cache.get(*request('http://b/')).is_valid)
+        cache.invalidate()
+        self.assertFalse(cache.get(*request('http://b/')).is_valid)
+        cache.remove()
+        self.assertEqual(0, len(cache))
+    
+    def test_freshness(self):
+        now = time.time()
+        self.assertEqual((None, None), freshness({}))
+        self.assertEqual((now+10, None), freshness({}, ttl=10, now=now))
+        headers = {'cache-control': 'max-age=60, stale-while-revalidate=30', 'age': '20'}
+        self.assertEqual((now+40, now+70), freshness(headers, now=now))
+        headers = {'cache-control': 'no-cache, max-age=60'}
+        self.assertEqual((now, None), freshness(headers, ttl=10, now=now))
+        headers = {
+            'date': 'Thu, 01 Jan 2015 00:00:00 GMT',
+            'expires': 'Thu, 01 Jan 2015 00:02:00 GMT',
+        }
+        self.assertEqual((now+120, None), freshness(headers, now=now))
+        self.assertEqual((now, None), freshness({'expires': '0'}, now=now))
+    
+    def test_is_fresh(self):
+        cache = ResponseCache()
+        cache.put(request('http://a/'), FakeResponse('a'))
+        cache.put(request('http://b/'), FakeResponse('b', **{'cache-control': 'max-age=0'}))
+        cache.put(request('http://c/'), FakeResponse('c', **{'cache-control': 'no-store'}))
+        self.assertTrue(cache.is_fresh(cache.get(*request('http://a/'))))
+        response = cache.get(*request('http://b/'))
+        self.assertFalse(cache.is_fresh(response))
+        cache.refresh(response, {'cache-control': 'max-age=60'})
+        self.assertTrue(cache.is_fresh(response))
+        self.assertRaises(KeyError, cache.get, *request('http://c/'))
+        cache.invalidate()
+        self.assertFalse(cache.is_fresh(cache.get(*request('http://a/'))))
+    
+    def test_invalidate_related(self):
+        cache = ResponseCache()
+        fill_related(cache, lambda url, content: FakeResponse(content))
+        assert_invalidate_related(self, cache)
+
+
+def fill_related(cache, response):
+    urls = {
+        'http://a/nodes/': '[{"url": "http://a/nodes/1/"}, {"url": "http://a/nodes/2/"}]',
+        'http://a/nodes/?group=1': '[{"url": "http://a/nodes/1/"}]',
+        'http://a/nodes/1/': '{"url": "http://a/nodes/1/", "group": {"url": "http://a/groups/1/"}}',
+        'http://a/nodes/1/?fields=url': '{"url": "http://a/nodes/1/"}',
+        'http://a/nodes/1/slivers/': '[]',
+        'http://a/nodes/2/': '{"url": "http://a/nodes/2/"}',
+        'http://a/nodes/20/': '{"url": "http://a/nodes/20/"}',
+        'http://a/groups/1/': '{"url": "http://a/groups/1/", "nodes": [{"url": "http://a/nodes/1/"}]}',
+        'http://a/groups/2/': '{"url": "http://a/groups/2/"}',
+    }
+    for url, content in urls.iteritems():
+        cache.put(request(url), response(url, content))
+
+
+def assert_invalidate_related(test, cache):
+    def valid(url):
+        return cache.get(*request(url)).is_valid
+    test.assertEqual(6, cache.invalidate_related('http://a/nodes/1/'))
+    for url in ['http://a/nodes/', 'http://a/nodes/?group=1', 'http://a/nodes/1/',
+                'http://a/nodes/1/?fields=url', 'http://a/nodes/1/slivers/',
+                'http://a/groups/1/']:
+        test.assertFalse(valid(url), url)
+    for url in ['http://a/nodes/2/', 'http://a/nodes/20/', 'http://a/groups/2/']:
+        test.assertTrue(valid(url), url)
+    cache.invalidate()
+    cache.remove()
+    fill_related(cache, response)
+    content = '{"url": "http://a/nodes/3/", "group": {"url": "http://a/groups/2/"}}'
+    test.assertEqual(3, cache.invalidate_related('http://a/nodes/', collection=True,
+            links=find_urls(content)))
+    test.assertFalse(valid('http://a/groups/2/'))
+    test.assertTrue(valid('http://a/nodes/1/'))
+
+
+def response(url, content, **headers):
+    value = requests.models.Response()
+    value.url = url
+    value.status_code = 200
+    value.reason = 'OK'
+    value._content = content
+    value.headers = requests.structures.CaseInsensitiveDict(headers)
+    return value
+
+
+class SQLiteCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.sqlite')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    def test_persistence(self):
+        cache = SQLiteCache(self.path)
+        cache.put(request('http://a/'), response('http://a/', '{"a": 1}', etag='"1"'))
+        other = SQLiteCache(self.path)
+        value = other.get(*request('http://a/'))
+        self.assertEqual({'a': 1}, value.json())
+        self.assertEqual('"1"', value.headers['ETag'])
+        self.assertTrue(other.is_fresh(value))
+        self.assertRaises(KeyError, other.get, *request('http://a/', authorization='Token 1'))
+        self.assertEqual((1, 1), (other.hits, other.misses))
+    
+    def test_invalidate(self):
+        cache = SQLiteCache(self.path)
+        cache.put(request('http://a/'), response('http://a/', 'a', etag='"1"'))
+        SQLiteCache(self.path).invalidate('http://a/')
+        value = cache.get(*request('http://a/'))
+        self.assertFalse(cache.is_fresh(value))
+        cache.refresh(value, {'etag': '"1"', 'cache-control': 'max-age=60'})
+        value = cache.get(*request('http://a/'))
+        self.assertTrue(cache.is_fresh(value))
+        self.assertEqual('max-age=60', value.headers['cache-control'])
+        cache.remove('http://a/')
+        self.assertEqual(0, len(cache))
+    
+    def test_bounded(self):
+        cache = SQLiteCache(self.path, max_entries=2, max_bytes=10)
+        cache.put(request('http://a/'), response('http://a/', 'a'*4))
+        cache.put(request('http://b/'), response('http://b/', 'b'*4))
+        cache.get(*request('http://a/'))
+        cache.put(request('http://c/'), response('http://c/', 'c'*4))
+        self.assertEqual(2, len(cache))
+        self.assertRaises(KeyError, cache.get, *request('http://b/'))
+        cache.put(request('http://d/'), response('http://d/', 'd'*8))
+        self.assertEqual(1, len(cache))
+        self.assertEqual(8, cache.size)
+    
+    def test_invalidate_related(self):
+        cache = SQLiteCache(self.path)
+        fill_related(cache, response)
+        assert_invalidate_related(self, cache)
+    
+    def test_api(self):
+        server = RangeServer('')
+        self.addCleanup(server.shutdown)
+        url = server.url + 'nodes/%d/'
+        server.pages['/nodes/'] = (json.dumps([{'url': url % i, 'id': i} for i in range(3)]),
+                {'cache-control': 'max-age=60'})
+        server.pages['/nodes/1/'] = (json.dumps({'url': url % 1, 'id': 1, 'name': 'node1'}),
+                {'cache-control': 'max-age=60', 'etag': '"1"'})
+        def get_api():
+            api = Api(server.url, cache=SQLiteCache(self.path), engine=ThreadEngine(size=2))
+            api._has_retrieved = True
+            api.nodes = Manager(server.url + 'nodes/', 'node-list', api)
+            return api
+        api = get_api()
+        for i in range(2):
+            self.assertEqual(range(3), [node.id for node in api.retrieve(server.url + 'nodes/')])
+            self.assertEqual('node1', api.retrieve(url % 1).name)
+        self.assertEqual(2, len(server.paths))
+        # hits of a fresh Api sharing the sqlite file
+        other = get_api()
+        self.assertEqual(range(3), [node.id for node in other.retrieve(server.url + 'nodes/')])
+        self.assertEqual('node1', other.retrieve(url % 1).name)
+        self.assertEqual(2, len(server.paths))
+        self.assertEqual(2, other.cache.hits)
@@ -0,0 +1,64 @@
+import unittest
+
+from orm.columns import BACKENDS, ColumnarCollection
+from orm.helpers import Q
+from orm.resources import Resource
+
+from .utils import Nodes
+
+
+class ColumnarTests(unittest.TestCase):
+    def setUp(self):
+        url = 'http://example.com/api/%s/%d/'
+        self.groups = [
+            Resource(None, url=url % ('groups', i), id=i, name=u'Group%d' % i) for i in range(3)
+        ]
+        for group in self.groups:
+            group._has_retrieved = True
+        self.nodes = Nodes([
+            Resource(None, url=url % ('nodes', i), id=i, name=u'node%d' % (i % 7),
+                     load=(i * 7 % 10) / 2.0, group=self.groups[i % 3]) for i in range(30)
+        ])
+    
+    def assertColumnar(self, method, *args, **kwargs):
+        expected = getattr(self.nodes, method)(*args, **kwargs).resources
+        for backend in BACKENDS:
+            columns = self.nodes.columnar(backend=backend)
+            self.assertEqual(expected, getattr(columns, method)(*args, **kwargs).resources)
+    
+    def test_filter(self):
+        self.assertColumnar('filter', name='node1')
+        self.assertColumnar('filter', name__in=['node1', 'node3'], load__gte=2)
+        self.assertColumnar('filter', name__istartswith='NODE1', id__lt=20)
+        self.assertColumnar('filter', group__name__icontains='p1')
+        self.assertColumnar('filter', name__startswith=u'node1')
+        self.assertColumnar('filter', name__startswith='')
+        self.assertColumnar('filter', group=self.groups[2], load__lt=3.5)
+        self.assertColumnar('filter', Q(id=1) | ~Q(load__gt=1), name__contains='4')
+        self.assertColumnar('exclude', name='node1', id__gt=5)
+        self.assertColumnar('filter', name=1)
+        for backend in BACKENDS:
+            nodes = self.nodes.columnar(backend=backend).filter(id__gte=10)
+            self.assertEqual(self.nodes[12], nodes.get(id=12))
+            self.assertEqual(range(20, 30), nodes.filter(id__gte=20).values_list('id').resources)
+    
+    def test_order_and_group(self):
+        for backend in BACKENDS:
+            nodes = self.nodes.columnar('load', backend=backend)
+            for field, reverse in (('load', False), ('load', True), ('group', True)):
+                expected = sorted(self.nodes.resources, key=lambda node: getattr(node, field),
+                        reverse=reverse)
+                self.assertEqual(expected, nodes.order_by(field, reverse=reverse).resources)
+            ordered = nodes.filter(id__lt=10).order_by('load', reverse=True)
+            self.assertEqual([7, 4, 1], [node.id for node in ordered[:3]])
+            self.assertEqual(
+                {key: len(value) for key, value in self.nodes.group_by('group__name').items()},
+                nodes.count('group__name')
+            )
+            groups = nodes.filter(id__gte=15).group_by('name')
+            self.assertEqual([15, 22, 29], [node.id for node in groups['node1']])
+            self.assertEqual(3, groups['node1'].count())
+    
+    def test_related_collections(self):
+        nodes = ColumnarCollection(Nodes([Resource(None, id=1, slivers=[])]))
+        self.assertRaises(ValueError, nodes.filter, slivers__id=1)
@@ -0,0 +1,84 @@
+import threading
+import time
+import unittest
+
+from orm.engines import SerialEngine, ThreadEngine, GeventEngine, SingleFlight, get_engine
+
+
+class EngineTests(unittest.TestCase):
+    def test_get_engine(self):
+        self.assertIsInstance(get_engine('serial'), SerialEngine)
+        engine = ThreadEngine(size=2)
+        self.assertIs(engine, get_engine(engine))
+        self.assertRaises(ValueError, get_engine, 'rata')
+    
+    def test_serial(self):
+        task = SerialEngine().spawn(lambda a, b: a+b, 1, b=2)
+        self.assertTrue(task.ready())
+        self.assertEqual(3, task.get())
+    
+    def test_errors(self):
+        for engine in (SerialEngine(), ThreadEngine(size=2)):
+            tasks = engine.run(lambda x: 1/x, [1, 0, 2])
+            failures = [item for item, task in tasks if not task.successful()]
+            self.assertEqual([0], failures)
+            self.assertIsInstance(tasks[1][1].exception, ZeroDivisionError)
+            self.assertRaises(ZeroDivisionError, tasks[1][1].get)
+    
+    def test_bounded_pool(self):
+        engine = ThreadEngine(size=3)
+        engine.run(time.sleep, [0.01]*10)
+        self.assertEqual(3, len(engine._workers))
+    
+    def test_nested_spawn(self):
+        engine = ThreadEngine(size=1)
+        task = engine.spawn(lambda: engine.spawn(lambda: 'nested').get())
+        self.assertEqual('nested', task.get(timeout=1))
+    
+    def test_host_limit(self):
+        engine = ThreadEngine(size=10, host_limit=2)
+        current = []
+        peak = []
+        lock = threading.Lock()
+        def request(url):
+            with engine.limit(url):
+                with lock:
+                    current.append(url)
+                    peak.append(len(current))
+                time.sleep(0.01)
+                with lock:
+                    current.remove(url)
+        engine.run(request, ['http://example.com/%d/' % i for i in range(10)])
+        self.assertEqual(2, max(peak))
+    
+    def test_gevent(self):
+        engine = GeventEngine(size=2, patch=False)
+        tasks = engine.run(lambda x: x*2, range(5))
+        self.assertEqual(range(0, 10, 2), [task.get() for item, task in tasks])
+        # offloaded calls run on the hub thread pool
+        thread = engine.offload(lambda: threading.current_thread())
+        self.assertIsNot(threading.current_thread(), thread)
+    
+    def test_as_completed(self):
+        engine = ThreadEngine(size=3)
+        delays = [0.06, 0.01, 0.03]
+        finished = [item for item, task in engine.as_completed(time.sleep, delays)]
+        self.assertEqual(sorted(delays), finished)
+    
+    def test_single_flight(self):
+        engine = ThreadEngine(size=5)
+        shared = []
+        flight = SingleFlight(engine, share=shared.append)
+        calls = []
+        def fetch(url):
+            calls.append(url)
+            time.sleep(0.05)
+            return url.upper()
+        tasks = engine.run(lambda i: flight.call('key', fetch, 'url'), range(5))
+        results = [task.get() for i, task in tasks]
+        self.assertEqual(['url'], calls)
+        self.assertEqual([('URL', False)], [r for r in results if not r[1]])
+        self.assertEqual(4, len([r for r in results if r[1]]))
+        self.assertEqual(('URL', False), flight.call('key', fetch, 'url'))
+        # values are only shared when some caller waited for them
+        self.assertEqual(['URL'], shared)
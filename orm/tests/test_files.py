@@ -1,11 +1,18 @@
 from __future__ import unicode_literals
 
+import hashlib
 import io
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
 from orm.api import Api
+from orm.engines import ThreadEngine
+from orm.files import FileHandler, FileStore, MultipartStream
 
-from .utils import login, random_ascii
+from .utils import RangeServer, login, random_ascii
 
 
 class FileHandlerTests(unittest.TestCase):
@@ -27,7 +34,7 @@ class FileHandlerTests(unittest.TestCase):
         template.retrieve()
         template.image.retrieve()
         template.image.validate_sha256()
-        self.assertEqual(content, template.image.content)
+        self.assertEqual(content, template.image.content.decode('ascii'))
         template.delete()
         template.image.retrieve(save_to='/dev/shm/')
         with open(template.image.file.name, 'ru') as f:
@@ -37,3 +44,206 @@ class FileHandlerTests(unittest.TestCase):
         async.get()
         template.image.sha256 += '1'
         self.assertRaises(ValueError, template.image.validate_sha256)
+
+
+class Template(object):
+    def __init__(self, content, api=None):
+        self.api = api
+        self.image_sha256 = hashlib.sha256(content).hexdigest()
+
+
+class DownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(2**20 + 7)
+        self.image = FileHandler(Template(self.content), 'image')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+    
+    def get_chunks(self, size=2**16):
+        return (self.content[i:i+size] for i in range(0, len(self.content), size))
+    
+    def get_image(self, api=None, **kwargs):
+        server = RangeServer(self.content, **kwargs)
+        self.addCleanup(server.shutdown)
+        api = api or Api(server.url)
+        image = FileHandler(Template(self.content, api=api), 'image')
+        image.uri = server.url + 'image.tgz'
+        image.MIN_SEGMENT_SIZE = 2**18
+        return server, image
+
+
+class DownloadTests(DownloadTestCase):
+    def test_load(self):
+        for size in (len(self.content), None, 100):
+            self.image.load(self.get_chunks(), size=size)
+            self.assertEqual(self.content, self.image.content)
+        self.image.sha256 = hashlib.sha256(b'').hexdigest()
+        self.assertRaises(ValueError, self.image.load, self.get_chunks())
+    
+    def test_save(self):
+        path = os.path.join(self.directory, 'image.tgz')
+        self.image.save(self.get_chunks(), path)
+        self.assertEqual(path, self.image.file.name)
+        with open(path, 'rb') as handler:
+            self.assertEqual(self.content, handler.read())
+        # the existing file is kept when the new one is corrupted
+        self.image.sha256 = hashlib.sha256(b'').hexdigest()
+        self.assertRaises(ValueError, self.image.save, self.get_chunks(), path)
+        self.assertEqual(['image.tgz'], os.listdir(self.directory))
+        with open(path, 'rb') as handler:
+            self.assertEqual(self.content, handler.read())
+    
+    def test_ranges(self):
+        server, image = self.get_image()
+        image.retrieve(save_to=self.directory + '/', segments=3)
+        self.assertEqual(os.path.join(self.directory, 'image.tgz'), image.file.name)
+        with open(image.file.name, 'rb') as handler:
+            self.assertEqual(self.content, handler.read())
+        self.assertEqual(3, len(server.ranges))
+        self.assertEqual(['image.tgz'], os.listdir(self.directory))
+        # no range support
+        server.accept_ranges = False
+        image.retrieve(save_to=image.file.name)
+        self.assertEqual(4, len(server.ranges))
+    
+    def test_resume(self):
+        server, image = self.get_image()
+        path = os.path.join(self.directory, 'image.tgz')
+        server.fail_after = 2**16
+        self.assertRaises(IOError, image.retrieve, save_to=path, chunk_size=2**14)
+        self.assertEqual(['image.tgz.journal', 'image.tgz.part'], sorted(os.listdir(self.directory)))
+        server.fail_after = None
+        del server.ranges[:]
+        image.retrieve(save_to=path, chunk_size=2**14)
+        # downloaded bytes are not requested again
+        starts = sorted(int(r.split('=')[1].split('-')[0]) for r in server.ranges)
+        length = -(-len(self.content) // 4)
+        self.assertEqual([i*length + 2**16 for i in range(4)], starts)
+        with open(path, 'rb') as handler:
+            self.assertEqual(self.content, handler.read())
+        self.assertEqual(['image.tgz'], os.listdir(self.directory))
+        # corrupted downloads are discarded
+        image.sha256 = hashlib.sha256(b'').hexdigest()
+        self.assertRaises(ValueError, image.retrieve, save_to=path + '2')
+        self.assertEqual(['image.tgz'], os.listdir(self.directory))
+
+
+class FileStoreTests(DownloadTestCase):
+    def setUp(self):
+        super(FileStoreTests, self).setUp()
+        self.store = FileStore(tempfile.mkdtemp(), max_size=3*2**20)
+        self.addCleanup(shutil.rmtree, self.store.root)
+    
+    def test_store(self):
+        api = Api('http://example.com/api/', file_store=self.store, engine=ThreadEngine(size=4))
+        server, image = self.get_image(api=api)
+        path = os.path.join(self.directory, 'image.tgz')
+        images = [FileHandler(image.parent, 'image') for i in range(4)]
+        for handler in images:
+            handler.MIN_SEGMENT_SIZE = image.MIN_SEGMENT_SIZE
+        tasks = [
+            handler.retrieve(save_to=path + str(i), async=True) for i, handler in enumerate(images)
+        ]
+        for task in tasks:
+            task.get()
+        # the file has been downloaded once
+        self.assertEqual(4, len(server.ranges))
+        self.assertIn(image.sha256, self.store)
+        hits = api.stats['stored']
+        image.retrieve(save_to=path)
+        image.retrieve()
+        self.assertEqual(self.content, image.content)
+        self.assertEqual(4, len(server.ranges))
+        self.assertEqual(hits + 2, api.stats['stored'])
+        stored = os.stat(self.store.get_path(image.sha256))
+        self.assertEqual(stored.st_ino, os.stat(path).st_ino)
+        with open(path, 'rb') as handler:
+            self.assertEqual(self.content, handler.read())
+    
+    def test_collect(self):
+        digests = []
+        for i in range(4):
+            content = os.urandom(2**20)
+            digest = hashlib.sha256(content).hexdigest()
+            path = os.path.join(self.directory, digest)
+            with open(path, 'wb') as handler:
+                handler.write(content)
+            os.utime(path, (i, i))
+            self.store.add(digest, path)
+            digests.append(digest)
+        # oldest first
+        self.assertEqual([False, True, True, True], [digest in self.store for digest in digests])
+        self.store.touch(digests[1])
+        # file timestamps are coarse, digests[0] must be used after digests[1]
+        time.sleep(0.05)
+        self.store.add(digests[0], os.path.join(self.directory, digests[0]))
+        self.assertEqual([True, True, False, True], [digest in self.store for digest in digests])
+        # held files are not collected
+        self.store.hold(digests[3])
+        self.store.add(digests[2], os.path.join(self.directory, digests[2]))
+        self.assertEqual([True, False, True, True], [digest in self.store for digest in digests])
+        self.store.release(digests[3])
+        self.store.add(digests[1], os.path.join(self.directory, digests[1]))
+        self.assertEqual([True, True, True, False], [digest in self.store for digest in digests])
+    
+    def test_digests(self):
+        for digest in ('../../' + 'a'*58, 'A'*64, 'a'*63, 'a'*64 + '\n', None):
+            self.assertRaises(ValueError, self.store.get_path, digest)
+        api = Api('http://example.com/api/', file_store=self.store)
+        server, image = self.get_image(api=api)
+        image.sha256 = '../../' + image.sha256[6:]
+        self.assertRaises(ValueError, image.retrieve, save_to=self.directory + '/')
+        self.assertEqual([], os.listdir(self.store.root))
+        self.assertEqual([], server.ranges)
+
+
+class UploadTests(DownloadTestCase):
+    def get_form(self, headers, body):
+        boundary = headers['content-type'].split('boundary=')[1].encode('ascii')
+        parts = body.split(b'--' + boundary)
+        self.assertEqual(b'--\r\n', parts[-1])
+        form = {}
+        for part in parts[1:-1]:
+            head, value = part.split(b'\r\n\r\n', 1)
+            name = head.split(b'name="')[1].split(b'"')[0]
+            form[name] = value[:-2]
+        return form
+    
+    def test_stream(self):
+        progress = []
+        stream = MultipartStream(io.BytesIO(self.content), digest_field='sha256',
+                progress=lambda sent, total: progress.append((sent, total)), chunk_size=2**16)
+        body = b''.join(iter(lambda: stream.read(8192), b''))
+        self.assertEqual(len(body), stream.len)
+        self.assertEqual((len(body), len(body)), progress[-1])
+        sha256 = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(sha256, stream.sha256)
+        form = self.get_form({'content-type': stream.content_type}, body)
+        self.assertEqual({b'file': self.content, b'sha256': sha256.encode('ascii')}, form)
+        # text streams have unknown size
+        stream = MultipartStream(io.StringIO('content'), chunk_size=3)
+        self.assertIsNone(stream.len)
+        self.assertEqual({b'file': b'content'}, self.get_form(
+                {'content-type': stream.content_type}, b''.join(stream)))
+    
+    def test_upload(self):
+        server, image = self.get_image(api=Api('http://example.com/api/', engine=ThreadEngine(size=4)))
+        api = image.parent.api
+        api.UPLOAD_DIGEST_FIELD = 'sha256'
+        path = os.path.join(self.directory, 'image.tgz')
+        with open(path, 'wb') as handler:
+            handler.write(self.content)
+        def upload(stream):
+            with stream:
+                return api.post(server.url + 'upload/', stream)
+        streams = [open(path, 'rb') for i in range(3)] + [io.StringIO('content')]
+        responses = [task.get() for stream, task in api.engine.run(upload, streams)]
+        self.assertEqual(image.sha256, responses[0].sha256)
+        self.assertEqual(4, len(server.uploads))
+        for headers, body in server.uploads:
+            form = self.get_form(headers, body)
+            if 'transfer-encoding' in headers:
+                self.assertEqual({b'file': b'content', b'sha256': hashlib.sha256(
+                        b'content').hexdigest().encode('ascii')}, form)
+            else:
+                self.assertEqual({b'file': self.content, b'sha256': image.sha256.encode('ascii')}, form)
@@ -0,0 +1,143 @@
+import json
+import time
+import unittest
+
+from orm.api import Api
+from orm.engines import ThreadEngine
+from orm.helpers import Q, chunk_ids, filter_collection, split_lookup, retrieve_related
+from orm.managers import Manager
+from orm.queries import QuerySet
+from orm.resources import Collection, Resource
+from orm.utils import ZeroDefaultDict
+
+from .utils import RangeServer
+
+
+class FakeApi(object):
+    _has_retrieved = True
+    
+    def __init__(self):
+        self.engine = ThreadEngine(size=4)
+        self.stats = ZeroDefaultDict()
+
+
+class FakeCollection(Collection):
+    def __init__(self, resources):
+        self.resources = resources
+
+
+class FakeResource(object):
+    """ related fields become available after a retrieve() of delay seconds """
+    def __init__(self, api, url, delay=0, **related):
+        self.api = api
+        self.url = url
+        self.delay = delay
+        self.related = related
+        self.retrieves = 0
+        self._has_retrieved = False
+    
+    def retrieve(self):
+        time.sleep(self.delay)
+        self.retrieves += 1
+        self.__dict__.update(self.related)
+        self._has_retrieved = True
+    
+    def merge(self, resource):
+        self.__dict__.update(resource.related)
+
+
+class HelpersTests(unittest.TestCase):
+    def test_split_lookup(self):
+        self.assertEqual(('group__name', 'icontains'), split_lookup('group__name__icontains'))
+        self.assertEqual(('name', 'exact'), split_lookup('name'))
+    
+    def test_chunk_ids(self):
+        endpoint = 'http://example.com/api/groups/'
+        chunks = chunk_ids(endpoint, range(1000), max_url_length=200)
+        self.assertEqual(range(1000), sum(chunks, []))
+        for chunk in chunks:
+            query = '%s?id__in=%s' % (endpoint, '%2C'.join(map(str, chunk)))
+            self.assertLessEqual(len(query), 200)
+        self.assertEqual([[1]], chunk_ids(endpoint, [1], max_url_length=10))
+    
+    def test_retrieve_related(self):
+        api = FakeApi()
+        url = 'http://example.com/api/nodes/%s/'
+        shared = FakeResource(api, url % 'shared')
+        slow = FakeResource(api, url % 'slow', delay=0.2, child=shared)
+        fast = FakeResource(api, url % 'fast', child=FakeResource(api, url % 'deep', delay=0.1))
+        roots = [
+            FakeResource(api, url % 1, parent=slow, others=[shared]),
+            FakeResource(api, url % 2, parent=fast, others=[]),
+        ]
+        for root in roots:
+            root.retrieve()
+        start = time.time()
+        retrieve_related(roots, 'parent__child', 'others')
+        # Pipelined: max(0.2, 0.1) instead of 0.2 + 0.1 with level barriers
+        self.assertLess(time.time() - start, 0.27)
+        self.assertEqual(1, shared.retrieves)
+        self.assertTrue(fast.child._has_retrieved)
+        self.assertEqual(4, api.stats['async'])
+    
+    def test_retrieve_batched(self):
+        server = RangeServer('')
+        self.addCleanup(server.shutdown)
+        url = server.url + 'groups/%d/'
+        server.content = json.dumps([
+            {'url': url % i, 'id': i, 'name': 'group%d' % i} for i in range(300)
+        ])
+        api = Api(server.url, engine=ThreadEngine(size=4))
+        api._has_retrieved = True
+        api.groups = Manager(server.url + 'groups/', 'group-list', api)
+        QuerySet.register('group-list', lookups=('exact', 'in'))
+        self.addCleanup(QuerySet.unregister, 'group-list')
+        # groups are shared through the identity map like on retrieved nodes
+        nodes = [
+            Resource(api, url=server.url + 'nodes/%d/' % i,
+                     group=Resource.build(api, url=url % (i % 300)))
+            for i in range(2000)
+        ]
+        for node in nodes:
+            node._has_retrieved = True
+        retrieve_related(nodes, 'group')
+        # 300 groups in a single id__in query
+        self.assertEqual(1, len(server.ranges))
+        self.assertEqual(1, api.stats['batched'])
+        self.assertEqual('group199', nodes[1999].group.name)
+    
+    def test_q(self):
+        api = FakeApi()
+        url = 'http://example.com/api/nodes/%d/'
+        nodes = [FakeResource(api, url % i, name='node%d' % i, arch=arch, group=None)
+                 for i, arch in enumerate(['i686', 'x86_64', 'i686', 'x86_64'])]
+        for node in nodes:
+            node.retrieve()
+        collection = FakeCollection(nodes)
+        match = lambda *args, **kwargs: [n.name for n in filter_collection(collection, *args, **kwargs)]
+        self.assertEqual(['node0', 'node2'], match(arch='i686'))
+        self.assertEqual(['node0', 'node3'], match(Q(name='node0') | Q(name__in=['node3'])))
+        self.assertEqual(['node1', 'node3'], match(~Q(arch__iexact='I686')))
+        self.assertEqual(['node2'], match(Q(arch='i686') & ~Q(name__startswith='node0')))
+        self.assertEqual(['node2'], match(Q(arch='i686'), name__gt='node1'))
+        self.assertEqual(['node1', 'node2', 'node3'], match(name='node0', _exclude=True))
+        # excluded when any lookup matches
+        self.assertEqual(['node2'], match(name='node0', arch='x86_64', _exclude=True))
+        self.assertEqual(['node1', 'node3'], match(Q(arch='i686'), name='node5', _exclude=True))
+    
+    def test_q_join(self):
+        api = FakeApi()
+        nodes = [FakeResource(api, 'http://example.com/api/nodes/%s/' % name, name=name)
+                 for name in 'abc']
+        groups = [
+            FakeResource(api, 'http://example.com/api/groups/1/', nodes=FakeCollection(nodes[:2])),
+            FakeResource(api, 'http://example.com/api/groups/2/', nodes=FakeCollection(nodes[2:])),
+        ]
+        for resource in nodes + groups:
+            resource.retrieve()
+        predicate = Q(nodes__name='b').compile()
+        self.assertEqual([True, False], map(predicate, groups))
+        # exclude keeps groups with any node not matching
+        collection = FakeCollection(groups)
+        self.assertEqual(groups, filter_collection(collection, nodes__name='b', _exclude=True))
+        self.assertEqual(groups[:1], filter_collection(collection, nodes__name='c', _exclude=True))
@@ -0,0 +1,100 @@
+import unittest
+
+from orm.helpers import Q
+from orm.indexes import SortedIndex
+from orm.resources import Resource, ResourceSet
+
+from .utils import Nodes
+
+
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        url = 'http://example.com/api/%s/%d/'
+        self.groups = [Resource(None, url=url % ('groups', i), id=i) for i in range(3)]
+        for group in self.groups:
+            group._has_retrieved = True
+        self.nodes = Nodes([
+            Resource(None, url=url % ('nodes', i), id=i, name='node%d' % (i % 7),
+                     group=self.groups[i % 3]) for i in range(30)
+        ])
+    
+    def assertFilter(self, *args, **kwargs):
+        expected = self.nodes.filter(*args, **kwargs).resources
+        self.assertEqual(expected, Nodes(list(self.nodes.resources)).filter(*args, **kwargs).resources)
+        return expected
+    
+    def test_hash_index(self):
+        index = self.nodes.index('name')
+        self.assertEqual([0, 7, 14, 21, 28], index.lookup('exact', 'node0'))
+        resources = self.nodes.filter(name__in=['node1', 'node2'], id__gt=20).resources
+        self.assertEqual([22, 23, 29], [node.id for node in resources])
+        self.assertEqual(self.nodes[3], self.nodes.get(name='node3', group__id=0, id__lt=10))
+        self.assertEqual(2, len(self.nodes.filter(Q(id=1) | Q(id=9), name__in=['node1', 'node2'])))
+    
+    def test_sorted_index(self):
+        self.nodes.index('group__id', sorted=True)
+        self.assertEqual(range(20, 30), [node.id for node in self.nodes.filter(id__gte=20)])
+        self.nodes.index('id', sorted=True)
+        self.assertEqual([3, 4, 5], [node.id for node in self.nodes.filter(id__gt=2, id__lt=6)])
+        self.assertEqual([29, 28], [node.id for node in self.nodes.top('id', 2, reverse=True)])
+        self.assertEqual([2, 5, 8], [n.id for n in self.nodes.filter(group__id=2)][:3])
+        self.nodes.order_by('group__id', reverse=True)
+        self.assertEqual([2, 5, 8], [node.id for node in self.nodes[:3]])
+    
+    def test_maintenance(self):
+        index = self.nodes.index('name')
+        node = Resource(None, url='http://example.com/api/nodes/30/', id=30, name='node0')
+        self.nodes.append(node)
+        self.assertEqual(6, len(self.nodes.filter(name='node0')))
+        self.assertEqual(31, len(index))
+        # copies do not use indexes built on other resources lists
+        subset = self.nodes.filter(id__lt=10)
+        self.assertEqual(2, len(subset.filter(name='node0')))
+        self.assertIsNone(subset.get_index('name'))
+    
+    def test_build(self):
+        # sorted once on build, appended resources are bisected in
+        index = SortedIndex('name', [])
+        for node in self.nodes:
+            index.add(node)
+        built = SortedIndex('name', self.nodes.resources)
+        self.assertEqual(index.positions, built.positions)
+        self.assertEqual(index.keys, built.keys)
+    
+    def test_rebuild(self):
+        names = self.nodes.index('name')
+        self.nodes.index('id', sorted=True)
+        self.nodes.order_by('name')
+        # indexes of a replaced resources list are rebuilt on use
+        self.assertEqual([0, 1, 2, 3, 4], self.nodes.get_index('name').lookup('exact', 'node0'))
+        self.assertIsNot(names, self.nodes.get_index('name'))
+        self.assertIs(self.nodes.resources, self.nodes.get_index('id', 'lt').resources)
+        self.assertEqual([0, 7, 14, 21, 28], [node.id for node in self.nodes.filter(name='node0')])
+        self.assertEqual([29, 28], [node.id for node in self.nodes.top('id', 2, reverse=True)])
+        resources = ResourceSet(list(self.nodes))
+        resources.index('id')
+        resources.append(Resource(None, url='http://example.com/api/nodes/30/', id=30))
+        self.assertEqual(31, len(resources.get_index('id')))
+        self.assertEqual([30], [node.id for node in resources.filter(id=30)])
+    
+    def test_distinct(self):
+        nodes = Nodes(self.nodes.resources + self.nodes.resources[:10])
+        self.assertEqual(self.nodes.resources, nodes.distinct().resources)
+        self.assertEqual(3, len(set(node.group for node in self.nodes)))
+        groups = self.nodes.group_by('group')
+        self.nodes.index('group')
+        self.assertEqual(groups, self.nodes.group_by('group'))
+    
+    def test_unsaved(self):
+        first, second = Resource(None, name='x'), Resource(None, name='x')
+        self.assertEqual(hash(first), hash(second))
+        self.assertEqual([first], Nodes([first, second]).distinct().resources)
+        nodes = Nodes([Resource(None, id=i, group=(first, second)[i % 2]) for i in range(4)])
+        index = nodes.index('group')
+        self.assertEqual([0, 1, 2, 3], sorted(index.lookup('exact', first)))
+        # saving changes the hash of the indexed value
+        second.name = 'y'
+        first.url = 'http://example.com/api/groups/3/'
+        self.assertEqual([0, 2], [node.id for node in nodes.filter(group=first)])
+        self.assertEqual([1, 3], [node.id for node in nodes.filter(group__in=[second])])
+        self.assertEqual({first: [0, 2], second: [1, 3]}, index.groups())
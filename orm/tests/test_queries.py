@@ -0,0 +1,173 @@
+import json
+import unittest
+
+from orm.aggregates import Aggregation, Count, Sum
+from orm.api import Api
+from orm.engines import ThreadEngine
+from orm.managers import Manager
+from orm.queries import QuerySet, project
+from orm.resources import Resource
+
+from .utils import RangeServer
+
+
+class QuerySetTests(unittest.TestCase):
+    def setUp(self):
+        api = Api('http://example.com/api/')
+        self.nodes = Manager('http://example.com/api/nodes/', 'node-list', api)
+        self.addCleanup(QuerySet.unregister, 'node-list')
+    
+    def test_lazy(self):
+        qs = self.nodes.filter(arch='i686').exclude(name='node1').order_by('name')[:10]
+        params, filters, ordering, limits = qs.compile()
+        self.assertEqual({'arch': 'i686'}, params)
+        # unregistered endpoints may ignore arch, it is checked on the client too
+        self.assertEqual([({'arch': 'i686'}, False), ({'name': 'node1'}, True)], filters)
+        self.assertEqual(['name'], ordering)
+        self.assertEqual((0, 10), limits)
+        self.assertEqual('http://example.com/api/nodes/?arch=i686', qs.get_url())
+    
+    def test_values(self):
+        QuerySet.register('node-list', lookups=('exact', 'in'))
+        api = self.nodes.api
+        group = Resource(api, url='http://example.com/api/groups/1/', id=1)
+        unsaved = Resource(api, name='group')
+        qs = self.nodes.filter(group=group, id__in=[group, 2], set_state=None)
+        params, filters, ordering, limits = qs.compile()
+        self.assertEqual({'group': '1', 'id__in': '1,2'}, params)
+        self.assertEqual([({'set_state': None}, False)], filters)
+        group = Resource(api, url='http://example.com/api/groups/1/')
+        params, filters, ordering, limits = self.nodes.filter(group=group, node=unsaved).compile()
+        self.assertEqual({'group': group.url}, params)
+        self.assertEqual([({'node': unsaved}, False)], filters)
+    
+    def test_capabilities(self):
+        QuerySet.register('node-list', lookups=('exact', 'in'), ordering='ordering',
+                limit='limit', offset='offset')
+        qs = self.nodes.filter(id__in=[1, 2], name__icontains='x', group__name='g')
+        params, filters, ordering, limits = qs.compile()
+        self.assertEqual({'id__in': '1,2'}, params)
+        self.assertEqual([({'name__icontains': 'x', 'group__name': 'g'}, False)], filters)
+        qs = self.nodes.order_by('-id')[5:15][2:4]
+        params, filters, ordering, limits = qs.compile()
+        self.assertEqual({'ordering': '-id', 'offset': 7, 'limit': 2}, params)
+        self.assertEqual((0, 2), limits)
+        # Client side filters can not be combined with server side slicing
+        params, filters, ordering, limits = qs.filter(name__icontains='x').compile()
+        self.assertEqual({'ordering': '-id'}, params)
+        self.assertEqual((7, 9), limits)
+    
+    def test_aggregate_capabilities(self):
+        aggregation = Aggregation(Count(), Sum('load'), _group_by='group__name')
+        self.assertFalse(QuerySet.default_capabilities.can_aggregate(aggregation))
+        QuerySet.register('node-list', aggregate='aggregate', group_by='group_by')
+        capabilities = self.nodes.all().get_capabilities()
+        self.assertFalse(capabilities.can_aggregate(aggregation))
+        self.assertTrue(capabilities.can_aggregate(Aggregation(Count(), Sum('load'))))
+        QuerySet.register('node-list', aggregate='aggregate', group_by='group_by',
+                fields=('load', 'group__name'))
+        capabilities = self.nodes.all().get_capabilities()
+        self.assertTrue(capabilities.can_aggregate(aggregation))
+    
+    def test_slicing(self):
+        self.assertEqual((3, 5), self.nodes.all()[3:][:2].compile()[3])
+        self.assertEqual((3, 3), self.nodes.all()[:3][5:].compile()[3])
+        self.assertRaises(ValueError, self.nodes.all().__getitem__, slice(-1, None))
+    
+    def test_projection(self):
+        QuerySet.register('node-list', only='fields', defer='omit')
+        qs = self.nodes.only('name', 'group__name').exclude(arch='i686')
+        self.assertEqual('arch,group,name,url', qs.compile()[0]['fields'])
+        self.assertEqual(({'arch', 'group', 'name', 'url'}, set()), qs.get_projection(*qs.compile()[1:3]))
+        qs = self.nodes.defer('slivers', 'group').order_by('group__name')
+        self.assertEqual({'omit': 'slivers'}, qs.compile()[0])
+        obj = {'url': 'http://example.com/api/nodes/1/', 'name': 'node1', 'slivers': []}
+        self.assertEqual({'url': obj['url'], 'name': 'node1'}, project(obj, defer={'slivers'}))
+        self.assertEqual({'name': 'node1'}, project(obj, only={'name'}))
+
+
+class EvaluationTests(unittest.TestCase):
+    """ querysets evaluated against a local server """
+    def setUp(self):
+        self.server = RangeServer('')
+        self.addCleanup(self.server.shutdown)
+        self.api = Api(self.server.url, engine=ThreadEngine(size=2))
+        self.api._has_retrieved = True
+        self.nodes = self.api.nodes = Manager(self.server.url + 'nodes/', 'node-list', self.api)
+        self.addCleanup(QuerySet.unregister, 'node-list')
+    
+    def serve(self, path, content):
+        self.server.pages['/' + path] = json.dumps(content)
+    
+    def node(self, i, **fields):
+        return dict(url=self.server.url + 'nodes/%d/' % i, id=i, **fields)
+    
+    def get_nodes(self):
+        arches = ['i686', 'x86_64', 'i686']
+        return [self.node(i, name='node%d' % i, arch=arches[i % 3]) for i in range(12)]
+    
+    def test_pushdown(self):
+        QuerySet.register('node-list', lookups=('exact', 'in'))
+        nodes = self.get_nodes()
+        self.serve('nodes/?arch=i686', [node for node in nodes if node['arch'] == 'i686'])
+        qs = self.nodes.filter(arch='i686', id__lt=9).exclude(id=3)
+        # arch on the server, the rest on the client
+        self.assertEqual([0, 2, 5, 6, 8], [node.id for node in qs])
+        self.assertEqual(['/nodes/?arch=i686'], self.server.paths)
+        # same result as a client side only evaluation
+        self.serve('nodes/', nodes)
+        qs = self.nodes.filter(id__lt=9).filter(arch__iexact='I686').exclude(id=3)
+        self.assertEqual([0, 2, 5, 6, 8], [node.id for node in qs])
+        self.assertEqual('/nodes/', self.server.paths[-1])
+    
+    def test_recheck(self):
+        nodes = self.get_nodes()
+        # unregistered endpoints may ignore arch, pushed filters are checked again
+        self.serve('nodes/?arch=i686', nodes)
+        qs = self.nodes.filter(arch='i686', id__lt=9)
+        self.assertEqual([0, 2, 3, 5, 6, 8], [node.id for node in qs])
+        self.serve('nodes/', nodes)
+        self.assertEqual([1, 4, 7], [node.id for node in self.nodes.exclude(arch='i686')[:3]])
+        self.assertEqual(['/nodes/?arch=i686', '/nodes/'], self.server.paths)
+    
+    def test_aggregate(self):
+        QuerySet.register('node-list', aggregate='aggregate', group_by='group_by')
+        self.serve('nodes/?aggregate=count%2Cload__sum&arch=i686', {'count': 8, 'load__sum': 4.0})
+        self.serve('nodes/?aggregate=count&group_by=arch', [
+            {'arch': 'i686', 'count': 8}, {'arch': 'x86_64', 'count': 4}
+        ])
+        # computed by the server
+        result = self.nodes.filter(arch='i686').aggregate(Count(), total=Sum('load'))
+        self.assertEqual({'count': 8, 'total': 4.0}, result)
+        result = self.nodes.annotate('arch', Count())
+        self.assertEqual({'i686': {'count': 8}, 'x86_64': {'count': 4}}, result)
+        self.assertEqual(2, len(self.server.paths))
+        # client side filters can not be aggregated by the server
+        nodes = self.get_nodes()
+        self.serve('nodes/?arch=i686', [node for node in nodes if node['arch'] == 'i686'])
+        result = self.nodes.filter(arch='i686', id__lt=6).aggregate(Count())
+        self.assertEqual({'count': 4}, result)
+        self.assertEqual('/nodes/?arch=i686', self.server.paths[-1])
+    
+    def test_aggregate_client(self):
+        nodes = self.get_nodes()
+        for node in nodes:
+            node['load'] = node['id'] * 0.5
+        self.serve('nodes/', nodes)
+        # without aggregate support resources are streamed
+        result = self.nodes.aggregate(Count(), total=Sum('load'))
+        self.assertEqual({'count': 12, 'total': 33.0}, result)
+        result = self.nodes.annotate('arch', Count(), Sum('load'))
+        expected = {
+            'i686': {'count': 8, 'load__sum': 22.0}, 'x86_64': {'count': 4, 'load__sum': 11.0}
+        }
+        self.assertEqual(expected, result)
+        self.assertEqual(['/nodes/'] * 2, self.server.paths)
+    
+    def test_values_list(self):
+        QuerySet.register('node-list', only='fields')
+        self.serve('nodes/?fields=name%2Curl', [self.node(1, name='node1'), self.node(2)])
+        self.serve('nodes/2/', self.node(2, name='node2', arch='i686'))
+        # missing fields are loaded from the resource url
+        self.assertEqual(['node1', 'node2'], list(self.nodes.all().values_list('name')))
+        self.assertEqual(['/nodes/?fields=name%2Curl', '/nodes/2/'], self.server.paths)
@@ -1,3 +1,4 @@
+import gc
 import unittest
 
 from orm.api import Api
@@ -59,6 +60,12 @@ class ResourceTests(unittest.TestCase):
         self.test_create()
         self.assertTrue(self.node.group.name)
     
+    def test_identity_map(self):
+        self.test_create()
+        self.assertIs(self.retrieved, self.api.retrieve(self.node.url))
+        self.assertIs(self.group, self.retrieved.group)
+        self.assertIs(self.retrieved, self.api.identity_map[self.node.url])
+    
     def test_conditional_request(self):
         self.test_create()
         self.node.retrieve()
@@ -211,3 +218,19 @@ class ResourceSetTests(unittest.TestCase):
     def test_uniquenes(self):
         groups = ResourceSet([self.group, self.group, self.group, self.group])
         self.assertEqual(1, len(groups))
+
+
+class IdentityMapTests(unittest.TestCase):
+    def test_build(self):
+        api = Api('http://example.com/api/')
+        url = 'http://example.com/api/nodes/1/'
+        node = Resource.build(api, url=url, name='node1')
+        self.assertIs(node, Resource.build(api, url=url, arch='i686'))
+        self.assertEqual(('node1', 'i686'), (node.name, node.arch))
+        self.assertIs(node, api.identity_map[url])
+        self.assertIsNot(node, Resource.build(api, name='node1'))
+        # the map does not keep resources alive
+        del node
+        gc.collect()
+        self.assertNotIn(url, api.identity_map)
+        self.assertEqual('node2', Resource.build(api, url=url, name='node2').name)
@@ -0,0 +1,136 @@
+import json
+import unittest
+
+from orm.api import Api
+from orm.engines import ThreadEngine
+from orm.managers import Manager
+from orm.resources import Resource
+from orm.serializers import (JSONStream, JSONCodec, MsgPackCodec, UJSONCodec, find_codec,
+        get_codec, msgpack, ujson)
+
+from .utils import RangeServer
+
+
+def chunked(content, size):
+    return [content[i:i+size] for i in range(0, len(content), size)]
+
+
+class JSONStreamTests(unittest.TestCase):
+    def test_array(self):
+        objects = [{'url': 'http://example.com/nodes/%d/' % i, 'id': i, 'ratio': i/3.0,
+                    'tags': ['a', None, True]} for i in range(50)]
+        content = json.dumps(objects, indent=2)
+        for size in (1, 7, 64, len(content)):
+            stream = JSONStream(chunked(content, size))
+            self.assertTrue(stream.is_array)
+            self.assertEqual(objects, list(stream))
+    
+    def test_numbers(self):
+        stream = JSONStream(['[1', '23, 4', '.5e1 ,fal', 'se, nu', 'll ]'])
+        self.assertEqual([123, 45.0, False, None], list(stream))
+    
+    def test_lazy(self):
+        chunks = iter(['[{"id": 1}, ', '{"id": 2}', ']'])
+        stream = iter(JSONStream(chunks))
+        self.assertEqual({'id': 1}, next(stream))
+        self.assertEqual(['{"id": 2}', ']'], list(chunks))
+    
+    def test_value(self):
+        self.assertEqual({'id': 1}, JSONStream(['  {"id"', ': 1}']).value())
+        self.assertEqual({}, JSONStream([]).value())
+        self.assertEqual([], list(JSONStream([' [ ', ' ]'])))
+    
+    def test_malformed(self):
+        self.assertRaises(ValueError, list, JSONStream(['[1 2]']))
+        self.assertRaises(ValueError, list, JSONStream(['[{"id": 1']))
+
+
+class CodecTests(unittest.TestCase):
+    def setUp(self):
+        self.api = Api('http://example.com/api/')
+        self.objects = [{'url': 'http://example.com/nodes/%d/' % i, 'id': i,
+                         'name': u'n\xf2de', 'ratio': i/3.0, 'tags': [None, True]} for i in range(20)]
+    
+    def assertCodec(self, codec):
+        content = codec.encode(self.objects)
+        self.assertEqual(self.objects, codec.decode(content))
+        chunks = [content[i:i+5] for i in range(0, len(content), 5)]
+        self.assertEqual(self.objects, list(codec.iter_decode(chunks)))
+        self.assertEqual(self.objects[0], codec.iter_decode([codec.encode(self.objects[0])]))
+        self.assertEqual({}, codec.decode(''))
+    
+    def test_json(self):
+        self.assertCodec(JSONCodec())
+    
+    @unittest.skipIf(ujson is None, 'ujson not installed')
+    def test_ujson(self):
+        self.assertCodec(UJSONCodec())
+        self.assertIsInstance(get_codec('application/json; charset=utf-8'), UJSONCodec)
+    
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack(self):
+        self.assertCodec(MsgPackCodec())
+        self.assertIsInstance(get_codec('msgpack'), MsgPackCodec)
+        self.assertIs(MsgPackCodec, find_codec('application/x-msgpack'))
+    
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack_str(self):
+        content = {'name': 'node', 'tags': ['a', u'b\xf2']}
+        json_codec, msgpack_codec = JSONCodec(), MsgPackCodec()
+        expected = json_codec.decode(json_codec.encode(content))
+        decoded = msgpack_codec.decode(msgpack_codec.encode(content))
+        self.assertEqual(expected, decoded)
+        self.assertEqual([unicode] * 3, map(type, [decoded['name']] + decoded['tags']))
+        # str type, not bin, on the wire
+        self.assertEqual('\xa4node', msgpack_codec.encode('node'))
+    
+    def test_resources(self):
+        node = Resource(self.api, url='http://example.com/nodes/1/', name='node')
+        group = Resource(self.api, url='http://example.com/groups/1/', node=node)
+        content = get_codec('json').encode({'group': group, 'nodes': [node]})
+        expected = {
+            'group': {'url': group.url, 'node': {'url': node.url, 'name': 'node'}},
+            'nodes': [{'url': node.url, 'name': 'node'}],
+        }
+        self.assertEqual(expected, json.loads(content))
+    
+    def test_negotiation(self):
+        self.assertIs(self.api.codec, self.api.get_codec('text/html'))
+        self.assertIsInstance(self.api.get_codec('application/json'), JSONCodec)
+        self.assertRaises(ValueError, get_codec, 'text/html')
+    
+    def test_legacy_hooks(self):
+        class LegacyApi(Api):
+            CONTENT_TYPE = 'text/plain'
+            DEFAULT_HEADERS = {'accept': CONTENT_TYPE, 'content-type': CONTENT_TYPE}
+            
+            def serialize_response(self, content):
+                return dict(line.split('=') for line in content.splitlines())
+        
+        class Response(object):
+            content = 'name=node\nid=1'
+            headers = {'content-type': 'text/plain'}
+        
+        api = LegacyApi('http://example.com/api/')
+        self.assertEqual({'name': 'node', 'id': '1'}, api.response_content(Response()))
+        self.assertEqual({'name': 'node', 'id': '1'}, api.decode_response(Response()))
+        self.assertEqual(LegacyApi.DEFAULT_HEADERS, api.get_default_headers())
+        self.assertIsInstance(api.get_codec('application/json'), JSONCodec)
+        self.assertRaises(NotImplementedError, api.serialize_request, {})
+
+
+class DecodeResponseTests(unittest.TestCase):
+    def test_collapsed_retrieve(self):
+        objects = [{'url': 'http://example.com/nodes/%d/' % i, 'id': i} for i in range(50)]
+        server = RangeServer(json.dumps(objects))
+        self.addCleanup(server.shutdown)
+        server.delay = 0.1
+        api = Api(server.url, engine=ThreadEngine(size=5))
+        api._has_retrieved = True
+        api.nodes = Manager(server.url + 'nodes/', 'node-list', api)
+        # streamed retrieve() requests are collapsed and share a buffered body
+        tasks = api.engine.run(lambda i: api.retrieve(server.url + 'nodes/'), range(5))
+        for i, task in tasks:
+            self.assertEqual(range(50), [node.id for node in task.get()])
+        self.assertEqual(1, len(server.ranges))
+        self.assertEqual(4, api.stats['collapsed'])
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from orm.api import Api
+from orm.engines import GeventEngine, ThreadEngine
+from orm.managers import Manager
+from orm.resources import Collection, Resource
+from orm.transfers import Bandwidth
+
+from .utils import RangeServer
+
+
+class Templates(Collection):
+    def __init__(self, resources):
+        self.resources = resources
+
+
+class TransferTests(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(2**18)
+        self.server = RangeServer(self.content)
+        self.addCleanup(self.server.shutdown)
+        self.api = Api(self.server.url, engine=ThreadEngine(size=4))
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        sha256 = hashlib.sha256(self.content).hexdigest()
+        self.templates = Templates([
+            Resource(self.api, url=self.server.url + 'templates/%d/' % i,
+                     image_uri=self.server.url + 'image%d.tgz' % i, image_sha256=sha256)
+            for i in range(5)
+        ] + [Resource(self.api, url=self.server.url + 'templates/5/', name='no image')])
+        for template in self.templates.resources:
+            template._has_retrieved = True
+    
+    def test_bandwidth(self):
+        bandwidth = Bandwidth(2**20, ThreadEngine())
+        start = time.time()
+        threads = [
+            threading.Thread(target=bandwidth.consume, args=(2**17,)) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.5)
+    
+    def test_bandwidth_gevent(self):
+        engine = GeventEngine(size=4, patch=False)
+        self.addCleanup(engine.close)
+        bandwidth = Bandwidth(2**20, engine)
+        start = time.time()
+        throttled = engine.spawn(bandwidth.consume, 2**19)
+        # the throttled greenlet sleeps cooperatively, time.sleep() would block the hub
+        self.assertLess(engine.spawn(time.time).get() - start, 0.25)
+        throttled.wait()
+        self.assertGreaterEqual(time.time() - start, 0.5)
+    
+    def test_download_segments(self):
+        self.server.delay = 0.2
+        transfers = self.templates.transfers('image', concurrency=1)
+        transfers.handlers = transfers.handlers[:2]
+        for handler in transfers.handlers:
+            handler.MIN_SEGMENT_SIZE = 2**16
+        start = time.time()
+        results = list(transfers.download(save_to=self.directory + '/'))
+        # 8 GETs of 0.2s, segments fetched one by one would take at least 1.6s
+        self.assertLess(time.time() - start, 1.4)
+        self.assertTrue(all(task.successful() for image, task in results))
+        self.assertEqual(8, len(self.server.ranges))
+    
+    def test_download(self):
+        templates = self.templates.resources
+        templates[1].image_sha256 = hashlib.sha256(b'').hexdigest()
+        transfers = self.templates.transfers('image', concurrency=2, bandwidth=2**21)
+        self.assertEqual(5, len(transfers.handlers))
+        start = time.time()
+        results = list(transfers.download(save_to=self.directory + '/'))
+        # 5 files of 256KiB at 2MiB/s
+        self.assertGreaterEqual(time.time() - start, 0.5)
+        failures = [(image.parent, task.exception) for image, task in results if task.exception]
+        self.assertEqual(1, len(failures))
+        self.assertIs(templates[1], failures[0][0])
+        self.assertIsInstance(failures[0][1], ValueError)
+        self.assertEqual(['image%d.tgz' % i for i in (0, 2, 3, 4)], sorted(os.listdir(self.directory)))
+        for image, task in results:
+            if task.successful():
+                with open(image.file.name, 'rb') as handler:
+                    self.assertEqual(self.content, handler.read())
+    
+    def test_upload(self):
+        path = os.path.join(self.directory, 'image.tgz')
+        with open(path, 'wb') as handler:
+            handler.write(self.content)
+        files = {}
+        for i, template in enumerate(self.templates.resources[:5]):
+            template.upload_image = Manager(self.server.url + 'upload/%d/' % i, 'upload', self.api)
+            files[template] = path
+        del files[template]
+        results = list(self.templates.transfers('image', concurrency=3).upload(files))
+        failures = [(image.parent, task.exception) for image, task in results if task.exception]
+        self.assertEqual(1, len(failures))
+        self.assertIs(template, failures[0][0])
+        self.assertIsInstance(failures[0][1], KeyError)
+        self.assertEqual(4, len(self.server.uploads))
+        for headers, body in self.server.uploads:
+            self.assertIn(self.content, body)
@@ -1,8 +1,15 @@
+import BaseHTTPServer
 import os
+import re
 import string
 import random
+import SocketServer
+import threading
+import time
 
 from orm.api import Api
+from orm.managers import Manager
+from orm.resources import Collection
 
 
 def login(self):
@@ -14,3 +21,112 @@ def login(self):
 
 def random_ascii(length):
     return ''.join([random.choice(string.hexdigits) for i in range(0, length)])
+
+
+class Nodes(Collection):
+    """ offline collection of the nodes endpoint built from a resources list """
+    def __init__(self, resources):
+        self.resources = resources
+        self.manager = Manager('http://example.com/api/nodes/', 'node-list', None)
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_GET(self):
+        server = self.server
+        time.sleep(server.delay)
+        content = server.content
+        start, end = 0, len(content) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('range', ''))
+        with server.lock:
+            server.ranges.append(match.group(0) if match else None)
+            server.paths.append(self.path)
+        if self.path in server.pages:
+            return self.send_page(server.pages[self.path])
+        if match and server.accept_ranges:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or end), end)
+            self.send_response(206)
+            self.send_header('content-range', 'bytes %d-%d/%d' % (start, end, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('content-length', str(end - start + 1))
+        self.end_headers()
+        length = end - start + 1
+        if server.fail_after is not None:
+            length = min(length, server.fail_after)
+        self.wfile.write(content[start:start+length])
+        if length <= end - start:
+            # interrupted transfer
+            self.close_connection = 1
+    
+    def send_page(self, page):
+        content, headers = page if isinstance(page, tuple) else (page, {})
+        headers = dict({'content-type': 'application/json'}, **headers)
+        if 'etag' in headers and self.headers.get('if-none-match') == headers['etag']:
+            self.send_response(304)
+            content = ''
+        else:
+            self.send_response(200)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('content-length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+    
+    def do_POST(self):
+        if self.headers.get('transfer-encoding') == 'chunked':
+            body = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    break
+            body = ''.join(body)
+        else:
+            body = self.rfile.read(int(self.headers['content-length']))
+        with self.server.lock:
+            self.server.uploads.append((dict(self.headers), body))
+        self.send_response(201)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', '2')
+        self.end_headers()
+        self.wfile.write('{}')
+
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in file server with Range support, every request path serves
+    content and requested ranges are recorded, fail_after closes responses
+    after that many bytes, delay seconds before answering GET requests and
+    posted (headers, body) are recorded in uploads
+    
+    pages maps request paths (query string included) to a JSON body or to a
+    (body, headers) pair served instead of content, a matching If-None-Match
+    gets a 304. GET request paths are recorded in paths.
+    """
+    daemon_threads = True
+    
+    def __init__(self, content, accept_ranges=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+        self.content = content
+        self.accept_ranges = accept_ranges
+        self.fail_after = None
+        self.delay = 0
+        self.ranges = []
+        self.paths = []
+        self.pages = {}
+        self.uploads = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+    
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
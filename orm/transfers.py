@@ -0,0 +1,109 @@
+import time
+
+from .engines import NullLimit, SerialEngine
+from .files import FileHandler
+
+
+class Bandwidth(object):
+    """
+    aggregate rate limit in bytes per second shared by concurrent transfers,
+    consume() sleeps on the engine until the transferred bytes fit in the rate
+    """
+    def __init__(self, rate, engine):
+        self.rate = float(rate)
+        self.engine = engine
+        self._lock = engine.lock()
+        # time at which all consumed bytes are paid off
+        self._until = 0
+    
+    def consume(self, size):
+        with self._lock:
+            now = time.time()
+            self._until = max(now, self._until) + size / self.rate
+            delay = self._until - now
+        if delay > 0:
+            self.engine.sleep(delay)
+    
+    def throttle(self, chunks):
+        """ yields chunks consuming their size """
+        for chunk in chunks:
+            self.consume(len(chunk))
+            yield chunk
+    
+    def progress(self):
+        """ upload progress(sent, total) callback consuming the sent bytes """
+        consumed = [0]
+        def progress(sent, total):
+            self.consume(sent - consumed[0])
+            consumed[0] = sent
+        return progress
+
+
+class Transfers(object):
+    """
+    Concurrent downloads and uploads of the FileHandlers of a collection
+    
+    concurrency bounds the simultaneous transfers (the engine size otherwise)
+    and bandwidth caps their aggregate rate in bytes per second. Iterating
+    the results runs the transfers and yields (handler, task) as they
+    complete, failures are reported on task.exception instead of raised.
+    Whole file digests are verified out of the engine with engine.offload().
+    Range segments of every download are fetched on a separate engine of the
+    same kind, spawns from the engine workers would run inline one by one.
+        
+        transfers = templates.transfers('image', concurrency=4, bandwidth=2**20)
+        for image, task in transfers.download('/var/lib/images/'):
+            if task.exception is not None:
+                print image.parent, task.exception
+    """
+    def __init__(self, handlers, concurrency=None, bandwidth=None):
+        self.handlers = list(handlers)
+        self.concurrency = concurrency
+        if self.handlers:
+            self.engine = self.handlers[0].parent.api.engine
+        else:
+            self.engine = SerialEngine()
+        self.bandwidth = Bandwidth(bandwidth, self.engine) if bandwidth else None
+    
+    def run(self, func):
+        """ applies func to every handler within the concurrency bound """
+        limit = self.engine.semaphore(self.concurrency) if self.concurrency else NullLimit()
+        def transfer(handler):
+            with limit:
+                return func(handler)
+        return self.engine.as_completed(transfer, self.handlers)
+    
+    def download(self, save_to=None, chunk_size=None, segments=None):
+        """
+        retrieves every file into save_to (a directory when it ends with '/')
+        or into handler.content, like FileHandler.retrieve()
+        """
+        size = (self.concurrency or self.engine.size) * (segments or FileHandler.SEGMENTS)
+        engine = self.engine.derive(size)
+        def download(handler):
+            handler.retrieve(save_to=save_to, chunk_size=chunk_size, segments=segments,
+                    bandwidth=self.bandwidth, engine=engine)
+            return handler
+        try:
+            for result in self.run(download):
+                yield result
+        finally:
+            engine.close()
+    
+    def upload(self, files):
+        """
+        posts files[resource] (a path or a file object) to the upload_<field>
+        action of every resource, task.value is the action response
+        """
+        get_file = files if callable(files) else lambda handler: files[handler.parent]
+        def upload(handler):
+            action = getattr(handler.parent, 'upload_%s' % handler.field_name)
+            kwargs = {}
+            if self.bandwidth is not None:
+                kwargs['progress'] = self.bandwidth.progress()
+            file = get_file(handler)
+            if isinstance(file, basestring):
+                with open(file, 'rb') as file:
+                    return action(file, **kwargs)
+            return action(file, **kwargs)
+        return self.run(upload)
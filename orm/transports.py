@@ -0,0 +1,91 @@
+import cookielib
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .utils import ZeroDefaultDict
+
+
+class BlockCookiesPolicy(cookielib.DefaultCookiePolicy):
+    """
+    module-level requests functions never carry cookies between requests,
+    pooled sessions keep the same behaviour (token auth only)
+    """
+    def set_ok(self, cookie, request):
+        return False
+    
+    def return_ok(self, cookie, request):
+        return False
+
+
+class Transport(object):
+    """ sends HTTP requests, subclass for custom wire behaviour """
+    def request(self, method, *args, **kwargs):
+        """ performs a request using requests.<method>-like arguments """
+        return getattr(requests, method)(*args, **kwargs)
+    
+    def get_stats(self):
+        """ transport related counters, merged into Api.stats """
+        return {}
+    
+    def close(self):
+        pass
+
+
+class SessionTransport(Transport):
+    """
+    Pooled transport with keep-alive connections backed by a requests.Session
+    
+    Pool sizes are configurable globally and per host, i.e.
+        SessionTransport(pool_maxsize=20, host_pool_sizes={
+            'https://controller.example.com/': 100,
+        })
+    Prefixes without scheme are mounted for both http and https
+    """
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+                 max_retries=0, host_pool_sizes=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.cookies.set_policy(BlockCookiesPolicy())
+        self.mount('http://', pool_maxsize)
+        self.mount('https://', pool_maxsize)
+        for prefix, pool_maxsize in (host_pool_sizes or {}).iteritems():
+            self.mount(prefix, pool_maxsize)
+    
+    def mount(self, prefix, pool_maxsize):
+        """ mounts a new connection pool adapter for urls starting with prefix """
+        if '://' in prefix:
+            prefixes = [prefix]
+        else:
+            prefixes = ['http://' + prefix, 'https://' + prefix]
+        for prefix in prefixes:
+            adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                    pool_maxsize=pool_maxsize, pool_block=self.pool_block,
+                    max_retries=self.max_retries)
+            self.session.mount(prefix, adapter)
+    
+    def request(self, method, *args, **kwargs):
+        return getattr(self.session, method)(*args, **kwargs)
+    
+    def get_stats(self):
+        """ aggregated connection pool statistics """
+        stats = ZeroDefaultDict()
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    # Evicted meanwhile
+                    continue
+                stats['pool_hosts'] += 1
+                stats['pool_connections'] += pool.num_connections
+                stats['pool_requests'] += pool.num_requests
+        stats['pool_reused'] = stats['pool_requests'] - stats['pool_connections']
+        return stats
+    
+    def close(self):
+        """ closes all pooled connections """
+        self.session.close()
@@ -22,6 +22,11 @@ setup(
         'requests',
         'gevent',
     ],
+    extras_require={
+        'ujson': ['ujson'],
+        'msgpack': ['msgpack'],
+        'numpy': ['numpy'],
+    },
     classifiers = [
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',